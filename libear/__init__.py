@@ -13,52 +13,208 @@ import tempfile
 import shutil
 import contextlib
 import logging
+import functools
+import hashlib
+import json
+import multiprocessing.pool
+import platform
+import time
 
 __all__ = ['build_libear']
 
+# Cache entries which were not used for this long are removed. (Seconds.)
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# Number of feature checks run at the same time.
+CONFIGURE_CONCURRENCY = 8
+# Number of sub-directories removed at the same time.
+CLEANUP_CONCURRENCY = 8
+
 
 def build_libear(compiler, dst_dir):
-    """ Returns the full path to the 'libear' library. """
+    """ Returns the full path to the 'libear' library.
+
+    The library is taken from the cache when that's enabled, otherwise it's
+    built into the given directory. """
 
     try:
-        src_dir = os.path.dirname(os.path.realpath(__file__))
-        toolset = make_toolset(src_dir)
-        toolset.set_compiler(compiler)
-        toolset.set_language_standard('c99')
-        toolset.add_definitions(['-D_GNU_SOURCE'])
-
-        configure = do_configure(toolset)
-        configure.check_function_exists('execve', 'HAVE_EXECVE')
-        configure.check_function_exists('execv', 'HAVE_EXECV')
-        configure.check_function_exists('execvpe', 'HAVE_EXECVPE')
-        configure.check_function_exists('execvp', 'HAVE_EXECVP')
-        configure.check_function_exists('execvP', 'HAVE_EXECVP2')
-        configure.check_function_exists('exect', 'HAVE_EXECT')
-        configure.check_function_exists('execl', 'HAVE_EXECL')
-        configure.check_function_exists('execlp', 'HAVE_EXECLP')
-        configure.check_function_exists('execle', 'HAVE_EXECLE')
-        configure.check_function_exists('posix_spawn', 'HAVE_POSIX_SPAWN')
-        configure.check_function_exists('posix_spawnp', 'HAVE_POSIX_SPAWNP')
-        configure.check_symbol_exists('_NSGetEnviron', 'crt_externs.h',
-                                      'HAVE_NSGETENVIRON')
-        configure.write_by_template(
-            os.path.join(src_dir, 'config.h.in'),
-            os.path.join(dst_dir, 'config.h'))
-
-        target = create_shared_library('ear', toolset)
-        target.add_include(dst_dir)
-        target.add_sources('ear.c')
-        target.link_against(toolset.dl_libraries())
-        target.link_against(['pthread'])
-        target.build_release(dst_dir)
-
-        return os.path.join(dst_dir, target.name)
+        cache_dir = cache_directory()
+        key = cache_key(compiler) if cache_dir else None
+        if key:
+            build = functools.partial(compile_libear, compiler)
+            entry = cache_entry(os.path.join(cache_dir, 'libear'), key, build)
+            name = make_toolset(entry).shared_library_name('ear')
+            return os.path.join(entry, name)
+    except Exception:
+        logging.info("Could not use the library cache.", exc_info=True)
 
+    try:
+        return compile_libear(compiler, dst_dir)
     except Exception:
         logging.info("Could not build interception library.", exc_info=True)
         return None
 
 
+def compile_libear(compiler, dst_dir):
+    """ Builds the 'libear' library into the given directory and returns
+    the full path to it. """
+
+    src_dir = os.path.dirname(os.path.realpath(__file__))
+    toolset = make_toolset(src_dir)
+    toolset.set_compiler(compiler)
+    toolset.set_language_standard('c99')
+    toolset.add_definitions(['-D_GNU_SOURCE'])
+
+    configure = do_configure(toolset)
+    configure.check_function_exists('execve', 'HAVE_EXECVE')
+    configure.check_function_exists('execv', 'HAVE_EXECV')
+    configure.check_function_exists('execvpe', 'HAVE_EXECVPE')
+    configure.check_function_exists('execvp', 'HAVE_EXECVP')
+    configure.check_function_exists('execvP', 'HAVE_EXECVP2')
+    configure.check_function_exists('exect', 'HAVE_EXECT')
+    configure.check_function_exists('execl', 'HAVE_EXECL')
+    configure.check_function_exists('execlp', 'HAVE_EXECLP')
+    configure.check_function_exists('execle', 'HAVE_EXECLE')
+    configure.check_function_exists('posix_spawn', 'HAVE_POSIX_SPAWN')
+    configure.check_function_exists('posix_spawnp', 'HAVE_POSIX_SPAWNP')
+    configure.check_symbol_exists('_NSGetEnviron', 'crt_externs.h',
+                                  'HAVE_NSGETENVIRON')
+    configure.write_by_template(
+        os.path.join(src_dir, 'config.h.in'),
+        os.path.join(dst_dir, 'config.h'))
+
+    target = create_shared_library('ear', toolset)
+    target.add_include(dst_dir)
+    target.add_sources('ear.c')
+    target.link_against(toolset.dl_libraries())
+    target.link_against(['pthread'])
+    target.build_release(dst_dir)
+
+    return os.path.join(dst_dir, target.name)
+
+
+def cache_directory():
+    """ Returns the directory where the built libraries are cached.
+
+    The 'LIBEAR_CACHE_DIR' environment variable overrides the default
+    location, an empty value disables the cache. """
+
+    if 'LIBEAR_CACHE_DIR' in os.environ:
+        return os.environ['LIBEAR_CACHE_DIR'] or None
+    if sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.getenv('XDG_CACHE_HOME') or \
+            os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(base, 'scan-build')
+
+
+def cache_key(compiler):
+    """ Returns the cache key of the library built by the given compiler.
+
+    The key is a hash of the library sources, the build recipe (this file),
+    the compiler identity and the platform. It returns None when the
+    compiler executable is not found. """
+
+    identity = toolchain_identity(compiler)
+    if identity is None:
+        return None
+    digest = hashlib.sha256()
+    src_dir = os.path.dirname(os.path.realpath(__file__))
+    for name in ['ear.c', 'config.h.in', '__init__.py']:
+        with open(os.path.join(src_dir, name), 'rb') as handle:
+            digest.update(handle.read())
+    for value in identity:
+        digest.update(str(value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def toolchain_identity(compiler):
+    """ Returns the values which identify the compiler on this platform, or
+    None when the compiler executable is not found. """
+
+    executable = find_executable(compiler)
+    if executable is None:
+        return None
+    stat = os.stat(executable)
+    return [executable, stat.st_size, stat.st_mtime, sys.platform,
+            platform.machine()]
+
+
+def cache_entry(cache_dir, key, build):
+    """ Returns the directory of the cache entry, creates it when needed.
+
+    The entry is populated in a temporary directory, which is renamed to the
+    final name when it's done. Concurrent processes might build the same
+    entry, but only one of them wins, and the others are using that.
+
+    :param cache_dir:   the cache root directory,
+    :param key:         the name of the cache entry,
+    :param build:       method to populate the given directory.
+    :return: the path of the cache entry directory. """
+
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        logging.debug('Cache hit %s', entry)
+        try:
+            # the modification time tells when it was used last time.
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return entry
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    work_dir = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        build(work_dir)
+        os.rename(work_dir, entry)
+        logging.debug('Cache populated %s', entry)
+    except OSError:
+        # lost the race against a concurrent process
+        if not os.path.isdir(entry):
+            raise
+        logging.debug('Cache populated concurrently %s', entry)
+    finally:
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
+    prune_cache(cache_dir, CACHE_MAX_AGE)
+    return entry
+
+
+def prune_cache(cache_dir, max_age):
+    """ Removes the cache entries which were not used recently. (And left
+    over temporary directories from interrupted builds.) """
+
+    limit = time.time() - max_age
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                logging.debug('Cache prune %s', path)
+                shutil.rmtree(path)
+        except OSError:
+            pass
+
+
+def find_executable(name):
+    """ Returns the real path of the executable (searched in the PATH), or
+    None if it's not found. """
+
+    if os.path.dirname(name):
+        candidates = [name]
+    else:
+        candidates = [os.path.join(directory, name) for directory
+                      in os.getenv('PATH', os.defpath).split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+
 def execute(cmd, *args, **kwargs):
     """ Make subprocess execution silent. """
 
@@ -73,7 +229,31 @@ def temporary_directory(**kwargs):
     try:
         yield name
     finally:
-        shutil.rmtree(name)
+        remove_directory(name)
+
+
+def remove_directory(name):
+    """ Remove the directory tree.
+
+    The sub-directories are removed concurrently. The file removal is a
+    system call, which does not hold the interpreter lock, so this makes
+    the cleanup of large trees faster (especially on network file systems).
+
+    :param name: the directory to remove. """
+
+    children = [os.path.join(name, child) for child in os.listdir(name)]
+    subdirs = [child for child in children
+               if os.path.isdir(child) and not os.path.islink(child)]
+    if len(subdirs) > 1:
+        remove = functools.partial(shutil.rmtree, ignore_errors=True)
+        pool = multiprocessing.pool.ThreadPool(
+            min(len(subdirs), CLEANUP_CONCURRENCY))
+        try:
+            pool.map(remove, subdirs)
+        finally:
+            pool.close()
+            pool.join()
+    shutil.rmtree(name)
 
 
 class Toolset(object):
@@ -161,9 +341,78 @@ def make_toolset(src_dir):
 
 
 class Configure(object):
-    def __init__(self, toolset):
+    """ Runs the feature checks concurrently on a thread pool.
+
+    The checks are scheduled by the `check_*` methods, and the results are
+    collected by the `wait` method. When a cache file is given, the results
+    are taken from there, and the new results are saved into it. (The cache
+    file shall be specific to the toolset.) Only the successful checks are
+    cached, the failed ones might pass later (eg.: after a missing header
+    was installed), so those are checked again at every run. """
+
+    def __init__(self, toolset, cache_file=None):
         self.ctx = toolset
         self.results = {'APPLE': sys.platform == 'darwin'}
+        self.cache_file = cache_file
+        self.cache = self._load_cache()
+        self.pending = {}
+        self.pool = None
+
+    def _load_cache(self):
+        try:
+            if self.cache_file and os.path.isfile(self.cache_file):
+                with open(self.cache_file, 'r') as handle:
+                    return json.load(handle)
+        except (IOError, ValueError):
+            logging.debug('Could not read %s', self.cache_file)
+        return {}
+
+    def _save_cache(self):
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            descriptor, name = tempfile.mkstemp(dir=directory)
+            with os.fdopen(descriptor, 'w') as handle:
+                json.dump(self.cache, handle)
+            os.rename(name, self.cache_file)
+        except (IOError, OSError):
+            logging.debug('Could not write %s', self.cache_file)
+
+    def _check(self, name, subject, source):
+        if self.cache.get(source):
+            logging.debug('Checking %s -- found (cached)', subject)
+            self.results.update({name: True})
+            return
+
+        def check():
+            logging.debug('Checking %s', subject)
+            found = self._try_to_compile_and_link(source)
+            logging.debug('Checking %s -- %s', subject,
+                          'found' if found else 'not found')
+            return found
+
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(
+                CONFIGURE_CONCURRENCY)
+        self.pending.update({name: (source, self.pool.apply_async(check))})
+
+    def wait(self):
+        """ Collects the results of the scheduled checks. """
+
+        if self.pool is None:
+            return
+        for name, (source, result) in self.pending.items():
+            found = result.get()
+            if found:
+                self.cache.update({source: True})
+            self.results.update({name: found})
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.pending = {}
+        if self.cache_file:
+            self._save_cache()
 
     def _try_to_compile_and_link(self, source):
         try:
@@ -182,24 +431,18 @@ class Configure(object):
         template = "int FUNCTION(); int main() { return FUNCTION(); }"
         source = template.replace("FUNCTION", function)
 
-        logging.debug('Checking function %s', function)
-        found = self._try_to_compile_and_link(source)
-        logging.debug('Checking function %s -- %s', function,
-                      'found' if found else 'not found')
-        self.results.update({name: found})
+        self._check(name, 'function ' + function, source)
 
     def check_symbol_exists(self, symbol, include, name):
         template = """#include <INCLUDE>
                       int main() { return ((int*)(&SYMBOL))[0]; }"""
         source = template.replace('INCLUDE', include).replace("SYMBOL", symbol)
 
-        logging.debug('Checking symbol %s', symbol)
-        found = self._try_to_compile_and_link(source)
-        logging.debug('Checking symbol %s -- %s', symbol,
-                      'found' if found else 'not found')
-        self.results.update({name: found})
+        self._check(name, 'symbol ' + symbol, source)
 
     def write_by_template(self, template, output):
+        self.wait()
+
         def transform(line, definitions):
 
             pattern = re.compile(r'^#cmakedefine\s+(\S+)')
@@ -220,7 +463,16 @@ class Configure(object):
 
 
 def do_configure(toolset):
-    return Configure(toolset)
+    cache_dir = cache_directory()
+    identity = toolchain_identity(toolset.compiler) if cache_dir else None
+    if identity is None:
+        return Configure(toolset)
+
+    digest = hashlib.sha256()
+    for value in identity + toolset.c_flags:
+        digest.update(str(value).encode('utf-8'))
+    name = digest.hexdigest() + '.json'
+    return Configure(toolset, os.path.join(cache_dir, 'configure', name))
 
 
 class SharedLibrary(object):
@@ -16,7 +16,12 @@
  * the job of the dynamic linker.
  *
  * The only input for the log writing is about the destination directory.
- * This is passed as environment variable.
+ * This is passed as environment variable. An optional environment variable
+ * selects the transport: every call is written into a separate file,
+ * appended as a single line into a shared log file, sent to a collector
+ * process over a unix domain socket, or stored as a binary record in a
+ * memory mapped arena file. Another optional environment variable can limit
+ * the reports to the compiler calls (matched by the executable name).
  */
 
 #include "config.h"
@@ -27,6 +32,14 @@
 #include <stdio.h>
 #include <string.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <fnmatch.h>
+#include <errno.h>
+#include <stdint.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
 #include <dlfcn.h>
 #include <pthread.h>
 
@@ -45,10 +58,34 @@ extern char **environ;
 #ifdef APPLE
 # define ENV_FLAT    "DYLD_FORCE_FLAT_NAMESPACE"
 # define ENV_PRELOAD "DYLD_INSERT_LIBRARIES"
-# define ENV_SIZE 3
+# define ENV_REQUIRED 3
 #else
 # define ENV_PRELOAD "LD_PRELOAD"
-# define ENV_SIZE 2
+# define ENV_REQUIRED 2
+#endif
+// these are optional, but passed to the children processes when present.
+#define ENV_TRANSPORT "INTERCEPT_BUILD_TRANSPORT"
+#define ENV_TRANSPORT_IDX (ENV_REQUIRED + 0)
+#define ENV_COMPILERS "INTERCEPT_BUILD_COMPILERS"
+#define ENV_COMPILERS_IDX (ENV_REQUIRED + 1)
+#define ENV_SIZE (ENV_REQUIRED + 2)
+
+#define TRACE_LOG_NAME "execution.log"
+#define TRACE_SOCKET_NAME "intercept.sock"
+#define TRACE_ARENA_NAME "execution.arena"
+#define TRANSPORT_LOG "log"
+#define TRANSPORT_SOCKET "socket"
+#define TRANSPORT_ARENA "arena"
+
+// the arena file layout shall be sync with the reader in intercept module.
+#define ARENA_MAGIC 0x41524145u
+#define ARENA_VERSION 2u
+#define ARENA_COMMITTED 0x43524145u
+
+#ifdef MSG_NOSIGNAL
+# define SEND_FLAGS MSG_NOSIGNAL
+#else
+# define SEND_FLAGS 0
 #endif
 
 #define DLSYM(TYPE_, VAR_, SYMBOL_)                                            \
@@ -65,12 +102,55 @@ extern char **environ;
 
 typedef char const * bear_env_t[ENV_SIZE];
 
+typedef struct {
+    char *data;
+    size_t length;
+    size_t capacity;
+} bear_buffer_t;
+
+// the arena is a file created by the intercept module, which is mapped into
+// the memory of every process. the space for a record is reserved by an
+// atomic write of the record size (at the offset, when it's still zero),
+// then the offset is moved after the record. (any process which finds a
+// reserved record at the offset moves the offset.) therefore processes
+// write concurrently, and the size of a record is known even when its
+// writer was killed before the record was committed.
+typedef struct {
+    uint32_t magic;
+    uint32_t version;
+    uint32_t capacity;
+    uint32_t offset;
+} bear_arena_header_t;
+
+// a record is followed by 'length' bytes of payload: the working directory
+// and the arguments, each terminated by a zero byte. the 'size' covers the
+// record header, the payload and the padding for the alignment.
+typedef struct {
+    uint32_t size;
+    uint32_t state;
+    uint32_t pid;
+    uint32_t argc;
+    uint32_t length;
+    uint32_t reserved;
+} bear_arena_record_t;
+
 static int bear_capture_env_t(bear_env_t *env);
 static void bear_release_env_t(bear_env_t *env);
 static char const **bear_update_environment(char *const envp[], bear_env_t *env);
 static char const **bear_update_environ(char const **in, char const *key, char const *value);
 static void bear_report_call(char const *const argv[]);
-static void bear_write_json_string(char const *word, FILE *stream);
+static int bear_is_compiler_call(char const *const argv[]);
+static char const **bear_strings_split(char const *in, char separator);
+static void bear_write_trace_file(char const *out_dir, bear_buffer_t const *record);
+static void bear_write_trace_log(char const *out_dir, bear_buffer_t const *record);
+static int bear_send_trace(char const *out_dir, bear_buffer_t const *record);
+static int bear_write_trace_arena(char const *out_dir, char const *const argv[], char const *cwd);
+static void bear_report_json(char const *out_dir, char const *transport, char const *const argv[], char const *cwd);
+static void bear_write_all(int fd, bear_buffer_t const *record);
+static void bear_write_json_record(char const *const argv[], char const *cwd, bear_buffer_t *record);
+static void bear_write_json_string(char const *word, bear_buffer_t *record);
+static void bear_buffer_append(bear_buffer_t *buffer, char const *data, size_t length);
+static void bear_buffer_release(bear_buffer_t *buffer);
 static char const **bear_strings_build(char const *arg, va_list *ap);
 static char const **bear_strings_copy(char const **const in);
 static char const **bear_strings_append(char const **in, char const *e);
@@ -84,15 +164,14 @@ static bear_env_t env_names =
 #ifdef ENV_FLAT
     , ENV_FLAT
 #endif
+    , ENV_TRANSPORT
+    , ENV_COMPILERS
     };
 
-static bear_env_t initial_env =
-    { 0
-    , 0
-#ifdef ENV_FLAT
-    , 0
-#endif
-    };
+static bear_env_t initial_env = { 0 };
+
+// the compiler executable name patterns, when the reports are filtered.
+static char const **compiler_patterns = 0;
 
 static int initialized = 0;
 static pthread_mutex_t mutex = PTHREAD_MUTEX_INITIALIZER;
@@ -144,14 +223,19 @@ static void on_load(void) {
 #ifdef HAVE_NSGETENVIRON
     environ = *_NSGetEnviron();
 #endif
-    if (!initialized)
+    if (!initialized) {
         initialized = bear_capture_env_t(&initial_env);
+        if (initial_env[ENV_COMPILERS_IDX])
+            compiler_patterns = bear_strings_split(initial_env[ENV_COMPILERS_IDX], ':');
+    }
     pthread_mutex_unlock(&mutex);
 }
 
 static void on_unload(void) {
     pthread_mutex_lock(&mutex);
     bear_release_env_t(&initial_env);
+    bear_strings_release(compiler_patterns);
+    compiler_patterns = 0;
     initialized = 0;
     pthread_mutex_unlock(&mutex);
 }
@@ -412,19 +496,156 @@ static void bear_report_call(char const *const argv[]) {
         return;
 
     pthread_mutex_lock(&mutex);
+    // skip the non compiler calls before doing any io.
+    if (!bear_is_compiler_call(argv)) {
+        pthread_mutex_unlock(&mutex);
+        return;
+    }
     const char *cwd = getcwd(NULL, 0);
     if (0 == cwd) {
         perror("bear: getcwd");
         exit(EXIT_FAILURE);
     }
     char const * const out_dir = initial_env[0];
-    // generate report file path. file name will be "<pid>_<idx>.json"
+    char const * const transport = initial_env[ENV_TRANSPORT_IDX];
+    if (transport && (0 == strcmp(transport, TRANSPORT_ARENA))) {
+        // when the arena is full, the record goes to the log.
+        if (-1 == bear_write_trace_arena(out_dir, argv, cwd))
+            bear_report_json(out_dir, TRANSPORT_LOG, argv, cwd);
+    } else
+        bear_report_json(out_dir, transport, argv, cwd);
+
+    free((void *)cwd);
+    pthread_mutex_unlock(&mutex);
+}
+
+static int bear_is_compiler_call(char const *const argv[]) {
+    // without patterns every call is reported.
+    if (0 == compiler_patterns)
+        return 1;
+    if ((0 == argv) || (0 == argv[0]))
+        return 0;
+    // the patterns are matched against the executable name only.
+    char const *const separator = strrchr(argv[0], '/');
+    char const *const executable = (separator) ? separator + 1 : argv[0];
+    for (char const *const *it = compiler_patterns; *it; ++it) {
+        if (0 == fnmatch(*it, executable, 0))
+            return 1;
+    }
+    return 0;
+}
+
+static void bear_report_json(char const *out_dir, char const *transport, char const *const argv[], char const *cwd) {
+    // the record is assembled in memory, and written with a single call.
+    bear_buffer_t record = { 0, 0, 0 };
+    bear_write_json_record(argv, cwd, &record);
+
+    if (transport && (0 == strcmp(transport, TRANSPORT_SOCKET))) {
+        // when the collector is not reachable, the record goes to the log.
+        if (-1 == bear_send_trace(out_dir, &record))
+            bear_write_trace_log(out_dir, &record);
+    } else if (transport && (0 == strcmp(transport, TRANSPORT_LOG)))
+        bear_write_trace_log(out_dir, &record);
+    else
+        bear_write_trace_file(out_dir, &record);
+
+    bear_buffer_release(&record);
+}
+
+static int bear_write_trace_arena(char const *out_dir, char const *const argv[], char const *cwd) {
+    size_t const path_max_length = strlen(out_dir) + sizeof(TRACE_ARENA_NAME) + 1;
+    char filename[path_max_length];
+    if (-1 == snprintf(filename, path_max_length, "%s/%s", out_dir, TRACE_ARENA_NAME)) {
+        perror("bear: snprintf");
+        exit(EXIT_FAILURE);
+    }
+    int flags = O_RDWR;
+#ifdef O_CLOEXEC
+    flags |= O_CLOEXEC;
+#endif
+    int const fd = open(filename, flags);
+    if (-1 == fd)
+        return -1;
+    struct stat info;
+    if ((-1 == fstat(fd, &info)) || ((size_t)info.st_size < sizeof(bear_arena_header_t))) {
+        close(fd);
+        return -1;
+    }
+    size_t const mapped_length = (size_t)info.st_size;
+    void *const mapped = mmap(0, mapped_length, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    close(fd);
+    if (MAP_FAILED == mapped)
+        return -1;
+
+    int result = -1;
+    bear_arena_header_t *const header = (bear_arena_header_t *)mapped;
+    if ((ARENA_MAGIC == header->magic) && (ARENA_VERSION == header->version) &&
+        (header->capacity <= mapped_length)) {
+        // calculate the size of the record
+        size_t length = strlen(cwd) + 1;
+        size_t argc = 0;
+        for (char const *const *it = argv; (it) && (*it); ++it, ++argc)
+            length += strlen(*it) + 1;
+        size_t const size = (sizeof(bear_arena_record_t) + length + 7) & ~(size_t)7;
+        // reserve the space. when the record does not fit, the arena is full
+        // and nothing is reserved. (the rest of the arena stays zero, which
+        // is the end of the records for the reader.)
+        bear_arena_record_t *record = 0;
+        uint32_t offset = __atomic_load_n(&header->offset, __ATOMIC_ACQUIRE);
+        while ((0 == record) && (size <= header->capacity) &&
+               (offset <= header->capacity - size)) {
+            bear_arena_record_t *const candidate =
+                (bear_arena_record_t *)((char *)mapped + offset);
+            uint32_t reserved = 0;
+            if (__atomic_compare_exchange_n(&candidate->size, &reserved, (uint32_t)size,
+                                            0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+                record = candidate;
+                reserved = (uint32_t)size;
+            }
+            // move the offset after the reserved record. (it fails when
+            // other process did it already, which is fine.)
+            uint32_t expected = offset;
+            __atomic_compare_exchange_n(&header->offset, &expected, offset + reserved,
+                                        0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE);
+            offset = __atomic_load_n(&header->offset, __ATOMIC_ACQUIRE);
+        }
+        if (record) {
+            record->pid = (uint32_t)getpid();
+            record->argc = (uint32_t)argc;
+            record->length = (uint32_t)length;
+            char *payload = (char *)(record + 1);
+            size_t const cwd_length = strlen(cwd) + 1;
+            memcpy(payload, cwd, cwd_length);
+            payload += cwd_length;
+            for (char const *const *it = argv; (it) && (*it); ++it) {
+                size_t const arg_length = strlen(*it) + 1;
+                memcpy(payload, *it, arg_length);
+                payload += arg_length;
+            }
+            // the reader takes the record only when it's committed.
+            __atomic_store_n(&record->state, ARENA_COMMITTED, __ATOMIC_RELEASE);
+            result = 0;
+        }
+    }
+    munmap(mapped, mapped_length);
+    return result;
+}
+
+static void bear_write_trace_file(char const *out_dir, bear_buffer_t const *record) {
+    // generate report file path. file name will be "<x>/<y>/<pid>_<idx>.json"
     // it needs to append an index field, since pid is not unique. (many
     // compiler wrapper just exec another file, therefore sharing pid.)
-    size_t const path_max_length = strlen(out_dir) + 32;
+    // the files are spread into two levels of sub-directories, which are
+    // named after the hash of the pid. (a flat directory with millions of
+    // files is slow on many file systems.)
+    unsigned const hash = (unsigned)getpid() * 2654435761u;
+    unsigned const first = (hash >> 28) & 0xf;
+    unsigned const second = (hash >> 24) & 0xf;
+    size_t const path_max_length = strlen(out_dir) + 40;
     char filename[path_max_length];
     for (int idx = 0; idx < 100; ++idx) {
-        if (-1 == snprintf(filename, path_max_length, "%s/%d_%d.json", out_dir, getpid(), idx)) {
+        if (-1 == snprintf(filename, path_max_length, "%s/%x/%x/%d_%d.json",
+                           out_dir, first, second, getpid(), idx)) {
             perror("bear: snprintf");
             exit(EXIT_FAILURE);
         }
@@ -432,58 +653,193 @@ static void bear_report_call(char const *const argv[]) {
             break;
         }
     }
-    FILE * fd = fopen(filename, "w+");
-    if (0 == fd) {
-        perror("bear: fopen");
+    int fd = open(filename, O_WRONLY | O_CREAT | O_TRUNC, 0666);
+    if ((-1 == fd) && (ENOENT == errno)) {
+        // the sub-directories are created by the first writer.
+        char dirname[path_max_length];
+        snprintf(dirname, path_max_length, "%s/%x", out_dir, first);
+        if ((-1 == mkdir(dirname, 0777)) && (EEXIST != errno))
+            perror("bear: mkdir");
+        snprintf(dirname, path_max_length, "%s/%x/%x", out_dir, first, second);
+        if ((-1 == mkdir(dirname, 0777)) && (EEXIST != errno))
+            perror("bear: mkdir");
+        fd = open(filename, O_WRONLY | O_CREAT | O_TRUNC, 0666);
+    }
+    if (-1 == fd) {
+        perror("bear: open");
         exit(EXIT_FAILURE);
     }
-    // dump the content in JSON format
-    fprintf(fd, "{ \"pid\": %d, \"cmd\": [", getpid());
-    for (char const *const *it = argv; (it) && (*it); ++it) {
-        if (it != argv) {
-            fputc(',', fd);
+    bear_write_all(fd, record);
+    if (close(fd)) {
+        perror("bear: close");
+        exit(EXIT_FAILURE);
+    }
+}
+
+static void bear_write_trace_log(char const *out_dir, bear_buffer_t const *record) {
+    // all processes append to the same file. the O_APPEND flag makes the
+    // seek and the write atomic, so records from concurrent processes are
+    // not mixed up. (as long as the record is written by a single call.)
+    size_t const path_max_length = strlen(out_dir) + sizeof(TRACE_LOG_NAME) + 1;
+    char filename[path_max_length];
+    if (-1 == snprintf(filename, path_max_length, "%s/%s", out_dir, TRACE_LOG_NAME)) {
+        perror("bear: snprintf");
+        exit(EXIT_FAILURE);
+    }
+    int flags = O_WRONLY | O_CREAT | O_APPEND;
+#ifdef O_CLOEXEC
+    flags |= O_CLOEXEC;
+#endif
+    int const fd = open(filename, flags, 0666);
+    if (-1 == fd) {
+        perror("bear: open");
+        exit(EXIT_FAILURE);
+    }
+    bear_write_all(fd, record);
+    if (close(fd)) {
+        perror("bear: close");
+        exit(EXIT_FAILURE);
+    }
+}
+
+static int bear_send_trace(char const *out_dir, bear_buffer_t const *record) {
+    // the collector is listening on a unix domain socket in the output
+    // directory. it reads the record till the connection is closed.
+    struct sockaddr_un address;
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    int const length = snprintf(address.sun_path, sizeof(address.sun_path),
+                                "%s/%s", out_dir, TRACE_SOCKET_NAME);
+    if ((length < 0) || ((size_t)length >= sizeof(address.sun_path)))
+        return -1;
+
+    int const fd = socket(AF_UNIX, SOCK_STREAM, 0);
+    if (-1 == fd)
+        return -1;
+    fcntl(fd, F_SETFD, FD_CLOEXEC);
+#ifdef SO_NOSIGPIPE
+    int const on = 1;
+    setsockopt(fd, SOL_SOCKET, SO_NOSIGPIPE, &on, sizeof(on));
+#endif
+    if (-1 == connect(fd, (struct sockaddr const *)&address, sizeof(address))) {
+        close(fd);
+        return -1;
+    }
+    size_t sent = 0;
+    while (sent < record->length) {
+        ssize_t const result =
+            send(fd, record->data + sent, record->length - sent, SEND_FLAGS);
+        if (-1 == result) {
+            if (EINTR == errno)
+                continue;
+            close(fd);
+            return -1;
         }
-        bear_write_json_string(*it, fd);
+        sent += (size_t)result;
     }
-    fputs("], \"cwd\": ", fd);
-    bear_write_json_string(cwd, fd);
-    fputc('}', fd);
-    if (fclose(fd)) {
-        perror("bear: fclose");
+    close(fd);
+    return 0;
+}
+
+static void bear_write_all(int fd, bear_buffer_t const *record) {
+    size_t written = 0;
+    while (written < record->length) {
+        ssize_t const result =
+            write(fd, record->data + written, record->length - written);
+        if (-1 == result) {
+            if (EINTR == errno)
+                continue;
+            perror("bear: write");
+            exit(EXIT_FAILURE);
+        }
+        written += (size_t)result;
+    }
+}
+
+static void bear_write_json_record(char const *const argv[], char const *cwd, bear_buffer_t *record) {
+    char pid[32];
+    int const pid_length = snprintf(pid, sizeof(pid), "%d", getpid());
+    if (pid_length < 0) {
+        perror("bear: snprintf");
         exit(EXIT_FAILURE);
     }
-    free((void *)cwd);
-    pthread_mutex_unlock(&mutex);
+    // dump the content in JSON format, one record per line.
+    bear_buffer_append(record, "{ \"pid\": ", 9);
+    bear_buffer_append(record, pid, (size_t)pid_length);
+    bear_buffer_append(record, ", \"cmd\": [", 10);
+    for (char const *const *it = argv; (it) && (*it); ++it) {
+        if (it != argv) {
+            bear_buffer_append(record, ",", 1);
+        }
+        bear_write_json_string(*it, record);
+    }
+    bear_buffer_append(record, "], \"cwd\": ", 10);
+    bear_write_json_string(cwd, record);
+    bear_buffer_append(record, "}\n", 2);
 }
 
-static void bear_write_json_string(char const *word, FILE *fd) {
-    fputc('"', fd);
+static void bear_write_json_string(char const *word, bear_buffer_t *record) {
+    bear_buffer_append(record, "\"", 1);
     for (char const * it = word; *it; ++it) {
+        // copy the characters which need no escaping at once.
+        size_t const plain = strcspn(it, "\b\f\n\r\t\"\\");
+        if (plain) {
+            bear_buffer_append(record, it, plain);
+            it += plain;
+            if (0 == *it)
+                break;
+        }
         char const current = *it;
         switch (current) {
         case '\b':
-            fputs("\\b", fd);
+            bear_buffer_append(record, "\\b", 2);
             break;
         case '\f':
-            fputs("\\f", fd);
+            bear_buffer_append(record, "\\f", 2);
             break;
         case '\n':
-            fputs("\\n", fd);
+            bear_buffer_append(record, "\\n", 2);
             break;
         case '\r':
-            fputs("\\r", fd);
+            bear_buffer_append(record, "\\r", 2);
             break;
         case '\t':
-            fputs("\\t", fd);
+            bear_buffer_append(record, "\\t", 2);
             break;
         case '"':
         case '\\':
-            fputc('\\', fd);
+            bear_buffer_append(record, "\\", 1);
         default:
-            fputc(current, fd);
+            bear_buffer_append(record, &current, 1);
+        }
+    }
+    bear_buffer_append(record, "\"", 1);
+}
+
+/* growing memory buffer to assemble the report before writing it. */
+
+static void bear_buffer_append(bear_buffer_t *buffer, char const *data, size_t length) {
+    if (buffer->length + length > buffer->capacity) {
+        size_t capacity = (buffer->capacity) ? buffer->capacity : 1024;
+        while (buffer->length + length > capacity)
+            capacity *= 2;
+        char *result = realloc(buffer->data, capacity);
+        if (0 == result) {
+            perror("bear: realloc");
+            exit(EXIT_FAILURE);
         }
+        buffer->data = result;
+        buffer->capacity = capacity;
     }
-    fputc('"', fd);
+    memcpy(buffer->data + buffer->length, data, length);
+    buffer->length += length;
+}
+
+static void bear_buffer_release(bear_buffer_t *buffer) {
+    free((void *)buffer->data);
+    buffer->data = 0;
+    buffer->length = 0;
+    buffer->capacity = 0;
 }
 
 /* update environment assure that chilren processes will copy the desired
@@ -495,7 +851,8 @@ static int bear_capture_env_t(bear_env_t *env) {
         char const * const env_value = getenv(env_names[it]);
         char const * const env_copy = (env_value) ? strdup(env_value) : env_value;
         (*env)[it] = env_copy;
-        status &= (env_copy) ? 1 : 0;
+        if (it < ENV_REQUIRED)
+            status &= (env_copy) ? 1 : 0;
     }
     return status;
 }
@@ -509,8 +866,9 @@ static void bear_release_env_t(bear_env_t *env) {
 
 static char const **bear_update_environment(char *const envp[], bear_env_t *env) {
     char const **result = bear_strings_copy((char const **)envp);
-    for (size_t it = 0; it < ENV_SIZE && (*env)[it]; ++it)
-        result = bear_update_environ(result, env_names[it], (*env)[it]);
+    for (size_t it = 0; it < ENV_SIZE; ++it)
+        if ((*env)[it])
+            result = bear_update_environ(result, env_names[it], (*env)[it]);
     return result;
 }
 
@@ -573,6 +931,27 @@ static char const **bear_strings_build(char const *const arg, va_list *args) {
     return result;
 }
 
+static char const **bear_strings_split(char const *const in, char separator) {
+    char const **result = bear_strings_copy(0);
+    char const *begin = in;
+    for (char const *it = in; ; ++it) {
+        if ((separator == *it) || (0 == *it)) {
+            if (it != begin) {
+                char *const copy = strndup(begin, (size_t)(it - begin));
+                if (0 == copy) {
+                    perror("bear: strndup");
+                    exit(EXIT_FAILURE);
+                }
+                result = bear_strings_append(result, copy);
+            }
+            if (0 == *it)
+                break;
+            begin = it + 1;
+        }
+    }
+    return result;
+}
+
 static char const **bear_strings_copy(char const **const in) {
     size_t const size = bear_strings_length(in);
 
@@ -11,12 +11,29 @@ import logging
 import os
 import os.path
 import re
-import shlex
 import subprocess
 import sys
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
 ENVIRONMENT_KEY = 'INTERCEPT_BUILD'
 
+# Lexical elements of a command string, the same as `shlex.split` takes.
+SHELL_SPACES = re.compile(r'[ \t\r\n]+')
+SHELL_SPECIAL = re.compile(r'[\\\'"]')
+SHELL_WORD = re.compile(
+    r'(?:[^ \t\r\n\\\'"]+|\'[^\']*\'|"(?:[^"\\]|\\.)*"|\\.)+', re.DOTALL)
+SHELL_WORD_PARTS = re.compile(
+    r'(?P<plain>[^\\\'"]+)'
+    r"|'(?P<single>[^']*)'"
+    r'|"(?P<double>(?:[^"\\]|\\.)*)"'
+    r'|\\(?P<escaped>.)', re.DOTALL)
+SHELL_QUOTED_ESCAPE = re.compile(r'\\(["\\])')
+SHELL_ESCAPE = re.compile(r'\\([\\ $%&\(\)\[\]\{\}\*|<>@?!])')
+
 Execution = collections.namedtuple('Execution', ['pid', 'cwd', 'cmd'])
 
 
@@ -27,10 +44,60 @@ def shell_split(string):
         """ Gets rid of the escaping characters. """
 
         if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] == '"':
-            return re.sub(r'\\(["\\])', r'\1', arg[1:-1])
-        return re.sub(r'\\([\\ $%&\(\)\[\]\{\}\*|<>@?!])', r'\1', arg)
+            return SHELL_QUOTED_ESCAPE.sub(r'\1', arg[1:-1])
+        elif '\\' in arg:
+            return SHELL_ESCAPE.sub(r'\1', arg)
+        return arg
+
+    # most commands does not have quoted or escaped arguments
+    if not SHELL_SPECIAL.search(string):
+        return [token for token in SHELL_SPACES.split(string) if token]
+    return [unescape(token) for token in shell_tokens(string)]
+
+
+def shell_tokens(string):
+    """ Splits the command string into words like `shlex.split` does.
+
+    The quoting and escaping rules are the POSIX shell ones, but without
+    comments. (This is much faster than the `shlex` module.)
+
+    :param string:  the command string
+    :return: list of the words. """
+
+    def unquote(word):
+        """ Removes the quotes and the escaping backslashes. """
+
+        if not SHELL_SPECIAL.search(word):
+            return word
+        parts = []
+        for match in SHELL_WORD_PARTS.finditer(word):
+            if match.lastgroup == 'double':
+                parts.append(SHELL_QUOTED_ESCAPE.sub(r'\1', match.group(
+                    'double')))
+            else:
+                parts.append(match.group(match.lastgroup))
+        return ''.join(parts)
+
+    result = []
+    position = 0
+    for match in SHELL_WORD.finditer(string):
+        # only whitespace can be between the words
+        if string[position:match.start()].strip(' \t\r\n'):
+            break
+        result.append(unquote(match.group()))
+        position = match.end()
+    else:
+        if not string[position:].strip(' \t\r\n'):
+            return result
+    rest = string[position:].lstrip(' \t\r\n')
+    raise ValueError('No escaped character' if rest.endswith('\\')
+                     else 'No closing quotation')
 
-    return [unescape(token) for token in shlex.split(string)]
+
+def shell_join(arguments):
+    """ Takes a command as list and returns as a shell quoted string. """
+
+    return ' '.join(shell_quote(argument) for argument in arguments)
 
 
 def run_build(command, *args, **kwargs):
@@ -46,11 +113,12 @@ def run_build(command, *args, **kwargs):
     return exit_code
 
 
-def run_command(command, cwd=None):
+def run_command(command, cwd=None, env=None):
     """ Run a given command and report the execution.
 
     :param command: array of tokens
     :param cwd: the working directory where the command will be executed
+    :param env: the environment of the command (default is the current)
     :return: output of the command
     """
     def decode_when_needed(result):
@@ -62,6 +130,7 @@ def run_command(command, cwd=None):
         logging.debug('exec command %s in %s', command, directory)
         output = subprocess.check_output(command,
                                          cwd=directory,
+                                         env=env,
                                          stderr=subprocess.STDOUT)
         return decode_when_needed(output).splitlines()
     except subprocess.CalledProcessError as ex:
@@ -131,66 +200,6 @@ def command_entry_point(function):
     return wrapper
 
 
-def wrapper_entry_point(function):
-    """ Implements compiler wrapper base functionality.
-
-    A compiler wrapper executes the real compiler, then implement some
-    functionality, then returns with the real compiler exit code.
-
-    :param function: the extra functionality what the wrapper want to
-    do on top of the compiler call. If it throws exception, it will be
-    caught and logged.
-    :return: the exit code of the real compiler.
-
-    The :param function: will receive the following arguments:
-
-    :param result:       the exit code of the compilation.
-    :param execution:    the command executed by the wrapper. """
-
-    def is_cxx_wrapper():
-        """ Find out was it a C++ compiler call. Compiler wrapper names
-        contain the compiler type. C++ compiler wrappers ends with `c++`,
-        but might have `.exe` extension on windows. """
-
-        wrapper_command = os.path.basename(sys.argv[0])
-        return re.match(r'(.+)c\+\+(.*)', wrapper_command)
-
-    def run_compiler(executable):
-        """ Execute compilation with the real compiler. """
-
-        command = executable + sys.argv[1:]
-        logging.debug('compilation: %s', command)
-        result = subprocess.call(command)
-        logging.debug('compilation exit code: %d', result)
-        return result
-
-    @functools.wraps(function)
-    def wrapper():
-        """ It executes the compilation and calls the wrapped method. """
-
-        # get relevant parameters from environment
-        parameters = json.loads(os.environ[ENVIRONMENT_KEY])
-        reconfigure_logging(parameters['verbose'])
-        # execute the requested compilation and crash if anything goes wrong
-        cxx = is_cxx_wrapper()
-        compiler = parameters['cxx'] if cxx else parameters['cc']
-        result = run_compiler(compiler)
-        # call the wrapped method and ignore it's return value
-        try:
-            call = Execution(
-                pid=os.getpid(),
-                cwd=os.getcwd(),
-                cmd=['c++' if cxx else 'cc'] + sys.argv[1:])
-            function(result, call)
-        except:
-            logging.exception('Compiler wrapper failed complete.')
-        finally:
-            # always return the real compiler exit code
-            return result
-
-    return wrapper
-
-
 def wrapper_environment(args):
     """ Set up environment for interpose compiler wrapper."""
 
@@ -19,26 +19,42 @@ import logging
 import multiprocessing
 import tempfile
 import functools
+import itertools
 import subprocess
 import platform
 import contextlib
 import datetime
-
-from libscanbuild import command_entry_point, wrapper_entry_point, \
-    wrapper_environment, run_build, run_command
+import threading
+import socket
+import shutil
+import signal
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from libear import temporary_directory
+from libscanbuild import command_entry_point, wrapper_environment, \
+    run_build, run_command, shell_split, Execution
 from libscanbuild.arguments import parse_args_for_scan_build, \
     parse_args_for_analyze_build
 from libscanbuild.intercept import capture
 from libscanbuild.report import document
-from libscanbuild.compilation import Compilation, classify_source, \
-    CompilationDatabase
+from libscanbuild.compilation import classify_source, Compilation, \
+    CompilationDatabase, ArgumentTable, KEEP, SKIP
+from libscanbuild.daemon import install_clients, Server, SERVER_SOCKET_FILE
+from libscanbuild.jobserver import JobServer, JobLimit
 from libscanbuild.clang import get_version, get_arguments
+from libscanbuild.wrapper import analyze_compiler_wrapper, \
+    ANALYZE_ENVIRONMENT_KEY as ENVIRONMENT_KEY, SPECULATIVE_ENVIRONMENT_KEY, \
+    LOAD_AVERAGE_ENVIRONMENT_KEY
 
 __all__ = ['scan_build', 'analyze_build', 'analyze_compiler_wrapper']
 
 COMPILER_WRAPPER_CC = 'analyze-cc'
 COMPILER_WRAPPER_CXX = 'analyze-c++'
-ENVIRONMENT_KEY = 'ANALYZE_BUILD'
+ANALYZER_NICENESS = 10  # the analyzer runs while building with this
+ANALYZER_QUEUE_FACTOR = 4  # pending analyzer runs per worker process
 
 
 @command_entry_point
@@ -52,12 +68,28 @@ def scan_build():
         # is not required. but we need to set up everything for the
         # wrappers, because 'configure' needs to capture the CC/CXX values
         # for the Makefile.
-        if args.intercept_first:
+        if args.intercept_first and args.pipelined and \
+                need_analyzer(args.build):
+            # run the analyzer against the commands as they are captured
+            with analyzer_pipeline(args) as submit:
+                exit_code, _ = capture(args, listener=submit)
+        elif args.intercept_first:
             # run build command with intercept module
             exit_code, compilations = capture(args)
             if need_analyzer(args.build):
                 # run the analyzer against the captured commands
                 run_analyzer_parallel(compilations, args)
+        elif args.daemon and args.pipelined and need_analyzer(args.build):
+            # the compiler wrappers are not waiting for the analyzer, the
+            # analyzer runs against the queued compilations while building
+            with analyzer_pipeline(args) as submit, \
+                    analyzer_server(args, submit) as environment:
+                exit_code = run_build(args.build, env=environment)
+        elif args.daemon:
+            # run build command with compiler wrappers, which are clients
+            # of the analyzer server
+            with analyzer_server(args) as environment:
+                exit_code = run_build(args.build, env=environment)
         else:
             # run build command and analyzer with compiler wrappers
             environment = setup_environment(args)
@@ -76,7 +108,13 @@ def analyze_build():
     # will re-assign the report directory as new output
     with report_directory(args.output, args.keep_empty) as args.output:
         # run the analyzer against a compilation db
-        compilations = CompilationDatabase.load(args.cdb)
+        if args.files:
+            compilations = find_compilations(args.cdb, args.files)
+        else:
+            # the entries are converted on the task feeder thread of the
+            # analyzer pool, that shall not start another process pool.
+            # (The analyzer is slower than the conversion anyway.)
+            compilations = CompilationDatabase.load(args.cdb, processes=1)
         run_analyzer_parallel(compilations, args)
         # cover report generation and bug counting
         number_of_bugs = document(args)
@@ -84,6 +122,22 @@ def analyze_build():
         return number_of_bugs if args.status_bugs else 0
 
 
+def find_compilations(filename, sources):
+    """ Generates the compilations of the given source files.
+
+    :param filename:    the compilation database file name
+    :param sources:     the source file names
+    :return: generator of the compilations. """
+
+    for source in sources:
+        found = False
+        for compilation in CompilationDatabase.find(filename, source):
+            found = True
+            yield compilation
+        if not found:
+            logging.warning('%s is not in the compilation database', source)
+
+
 def need_analyzer(args):
     """ Check the intent of the build command.
 
@@ -168,11 +222,118 @@ def run_analyzer_parallel(compilations, args):
     parameters = (dict(compilation.to_analyzer(), **consts)
                   for compilation in compilations)
     # when verbose output requested execute sequentially
-    pool = multiprocessing.Pool(1 if args.verbose > 2 else None)
-    for current in pool.imap_unordered(run, parameters):
-        logging_analyzer_output(current)
-    pool.close()
-    pool.join()
+    processes = 1 if args.verbose > 2 else analyzer_processes(args)
+    # the pool would read the whole input at once, limit the pending runs
+    # to keep the memory use low with a huge compilation database
+    window = threading.Semaphore(processes * ANALYZER_QUEUE_FACTOR)
+    limit = job_limit(args)
+    stopped = threading.Event()
+
+    def throttled(iterator):
+        for current in iterator:
+            window.acquire()
+            limit.acquire()
+            if stopped.is_set():
+                return
+            yield current
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for current in pool.imap_unordered(run_safely, throttled(parameters)):
+            limit.release()
+            window.release()
+            logging_analyzer_output(current)
+        pool.close()
+    except BaseException:
+        # the task feeder might wait for a slot, wake it up to stop.
+        stopped.set()
+        limit.close()
+        window.release()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        limit.close()
+
+
+@contextlib.contextmanager
+def analyzer_pipeline(args):
+    """ Runs the analyzer against the compilations as they are submitted.
+
+    The analyzer processes run with lower priority (the build shall not be
+    slowed down by them). The submitted compilations are queued, and those
+    are given to the analyzer processes when the job limit allows it. The
+    context exits when all submitted analyzer runs are finished.
+
+    :param args:    the parsed and validated command line arguments
+    :return: a method to submit a compilation (it's thread safe). """
+
+    logging.debug('run analyzer against compilations while building')
+    consts = analyze_parameters(args)
+    # when verbose output requested execute sequentially
+    pool = multiprocessing.Pool(
+        1 if args.verbose > 2 else analyzer_processes(args),
+        initializer=lower_priority)
+    limit = job_limit(args)
+    waiting = queue.Queue()
+    pending = []
+
+    def submit(compilation, environment=None):
+        parameters = dict(compilation.to_analyzer(), **consts)
+        if environment is not None:
+            parameters['environment'] = environment
+        waiting.put(parameters)
+
+    def finished(result):
+        try:
+            logging_analyzer_output(result)
+        finally:
+            limit.release()
+
+    def dispatch():
+        for parameters in iter(waiting.get, None):
+            limit.acquire()
+            pending.append(pool.apply_async(run_safely, (parameters, ),
+                                            callback=finished))
+
+    dispatcher = threading.Thread(target=dispatch)
+    dispatcher.daemon = True
+    dispatcher.start()
+    try:
+        yield submit
+    finally:
+        waiting.put(None)
+        dispatcher.join()
+        pool.close()
+        pool.join()
+        limit.close()
+    # propagate the failures of the analyzer runs.
+    for result in pending:
+        result.get()
+
+
+def analyzer_processes(args):
+    """ Returns the number of analyzer processes to run at the same time.
+    """
+
+    return args.jobs or multiprocessing.cpu_count()
+
+
+def job_limit(args):
+    """ Creates the limit of the concurrent analyzer runs. When this command
+    is run by GNU make, the analyzer runs are jobs of the make jobserver.
+    The load average limit is taken from the command line. """
+
+    return JobLimit(JobServer.from_environment(), args.load_average)
+
+
+def lower_priority():
+    """ Makes the current process nicer to others. """
+
+    try:
+        os.nice(ANALYZER_NICENESS)
+    except (AttributeError, OSError):
+        pass
 
 
 def setup_environment(args):
@@ -191,28 +352,201 @@ def setup_environment(args):
         environment.update({
             ENVIRONMENT_KEY: json.dumps(analyze_parameters(args))
         })
+        if args.speculative:
+            environment.update({
+                SPECULATIVE_ENVIRONMENT_KEY: str(analyzer_processes(args))
+            })
+        if args.load_average:
+            environment.update({
+                LOAD_AVERAGE_ENVIRONMENT_KEY: str(args.load_average)
+            })
     else:
         logging.debug('wrapper should not run analyzer')
     return environment
 
 
-@command_entry_point
-@wrapper_entry_point
-def analyze_compiler_wrapper(result, execution):
-    """ Entry point for `analyze-cc` and `analyze-c++` compiler wrappers. """
-
-    # don't run analyzer when compilation fails. or when it's not requested.
-    if result or not os.getenv(ENVIRONMENT_KEY):
-        return
-    # collect the needed parameters from environment
+@contextlib.contextmanager
+def analyzer_server(args, submit=None):
+    """ Runs the server of the compiler wrappers in daemon mode.
+
+    The wrappers send the successful compiler calls (with their working
+    directory and environment) to the server, and wait for the server to
+    close the connection. Without the submit method, the analyzer runs on
+    the server before that. With the submit method, the compilations are
+    only queued, so the build does not wait for the analyzer. When the
+    analyzer is not needed, the server is not started and the wrappers just
+    execute the compiler.
+
+    :param args:    the parsed and validated command line arguments
+    :param submit:  method to queue a compilation (with its environment)
+    :return: the environment of the build command. """
+
+    with temporary_directory(prefix='scan-build-') as tmp_dir:
+        address = None
+        server = None
+        if need_analyzer(args.build):
+            consts = analyze_parameters(args)
+            slots = threading.Semaphore(analyzer_processes(args))
+            limit = job_limit(args)
+
+            def handler(request):
+                execution = Execution(pid=request['pid'],
+                                      cwd=request['cwd'],
+                                      cmd=request['cmd'])
+                for entry in Compilation.from_call(execution):
+                    if submit:
+                        submit(entry, request['environment'])
+                        continue
+                    current = dict(entry.to_analyzer(),
+                                   environment=request['environment'],
+                                   **consts)
+                    with slots:
+                        limit.acquire()
+                        try:
+                            logging_analyzer_output(run(current))
+                        finally:
+                            limit.release()
+
+            address = os.path.join(tmp_dir, SERVER_SOCKET_FILE)
+            try:
+                server = Server(address, handler)
+            except socket.error:
+                logging.warning('could not start analyzer server',
+                                exc_info=True)
+        else:
+            logging.debug('wrapper should not run analyzer')
+
+        if address and server is None:
+            # the compiler wrappers run the analyzer themselves
+            yield setup_environment(args)
+            return
+        cc, cxx = install_clients(
+            tmp_dir, (COMPILER_WRAPPER_CC, COMPILER_WRAPPER_CXX),
+            (shell_split(args.cc), shell_split(args.cxx)), 'analyze', address)
+        environment = dict(os.environ)
+        environment.update({'CC': cc, 'CXX': cxx})
+        if server is None:
+            yield environment
+            return
+        server.start()
+        try:
+            yield environment
+        finally:
+            server.stop()
+
+
+def analyze_compilations(compilations):
+    """ Runs the analyzer against the compilations of a compiler wrapper
+    call. (The analyzer parameters are taken from the environment.) """
+
     parameters = json.loads(os.environ[ENVIRONMENT_KEY])
-    # don't run analyzer when the command is not a compilation.
-    # (filtering non compilations is done by the generator.)
-    for entry in Compilation.from_call(execution):
+    for entry in compilations:
         current = dict(entry.to_analyzer(), **parameters)
         logging_analyzer_output(run(current))
 
 
+def analyze_compilations_speculatively(compilations, wait):
+    """ Runs the analyzer against the compilations of a compiler wrapper
+    call, while the compiler is running.
+
+    The analyzer runs in a child process (in its own process group), and
+    writes the outputs into a temporary directory (inside the report
+    directory). When the compilation was successful, the analyzer is waited
+    for, and the outputs are moved to the report directory. When the
+    compilation fails, the analyzer processes are terminated.
+
+    :param compilations:    the compilations to analyze
+    :param wait:            method to wait for the compiler exit code
+    :return: the exit code of the compiler. """
+
+    parameters = json.loads(os.environ[ENVIRONMENT_KEY])
+    output_dir = parameters['output_dir']
+    speculative_dir = tempfile.mkdtemp(prefix='speculative-', dir=output_dir)
+    receiver, sender = multiprocessing.Pipe(False)
+    analyzer = multiprocessing.Process(
+        target=analyze_speculatively,
+        args=(compilations, dict(parameters, output_dir=speculative_dir),
+              sender))
+    try:
+        analyzer.start()
+        sender.close()
+        set_process_group(analyzer.pid)
+        result = wait()
+        # don't report the analyzer result when compilation fails.
+        if not result:
+            try:
+                outputs = receiver.recv()
+            except EOFError:
+                logging.warning('analyzer process failed: %s',
+                                analyzer.exitcode)
+                outputs = []
+            analyzer.join()
+            for output in outputs:
+                logging_analyzer_output(output)
+            move_reports(speculative_dir, output_dir)
+        return result
+    finally:
+        receiver.close()
+        if analyzer.is_alive():
+            terminate_process_group(analyzer)
+        shutil.rmtree(speculative_dir, ignore_errors=True)
+
+
+def analyze_speculatively(compilations, parameters, sender):
+    """ Runs the analyzer against the compilations. (This is the child
+    process of the speculative analysis.)
+
+    :param compilations:    the compilations to analyze
+    :param parameters:      the analyzer parameters
+    :param sender:          the connection to send the analyzer outputs """
+
+    set_process_group(0)
+    outputs = [run(dict(entry.to_analyzer(), **parameters))
+               for entry in compilations]
+    sender.send(outputs)
+    sender.close()
+
+
+def set_process_group(pid):
+    """ Makes the process the leader of a new process group. (Both the
+    parent and the child calls it, to not depend on which runs first.) """
+
+    if hasattr(os, 'setpgid'):
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass  # the child is not running anymore.
+
+
+def terminate_process_group(process):
+    """ Terminates the process and its children, and waits for it. """
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, OSError):
+        process.terminate()
+    process.join()
+
+
+def move_reports(source_dir, target_dir):
+    """ Moves the analyzer outputs (with their sub-directories) from one
+    directory to another. """
+
+    for root, _, files in os.walk(source_dir):
+        destination = os.path.join(target_dir,
+                                   os.path.relpath(root, source_dir))
+        if files and not os.path.isdir(destination):
+            try:
+                os.makedirs(destination)
+            except OSError:
+                # other wrapper process might created it meanwhile.
+                if not os.path.isdir(destination):
+                    raise
+        for name in files:
+            os.rename(os.path.join(root, name),
+                      os.path.join(destination, name))
+
+
 @contextlib.contextmanager
 def report_directory(hint, keep):
     """ Responsible for the report directory.
@@ -298,6 +632,19 @@ def run(opts):
         return None
 
 
+def run_safely(opts):
+    """ Runs the analyzer, and logs the failures instead of raising them.
+
+    (The analyzer pipeline gives back the job slot from the result callback,
+    which is not called when the run raises.) """
+
+    try:
+        return run(opts)
+    except Exception:
+        logging.error("Problem occured during analyzis.", exc_info=1)
+        return None
+
+
 def logging_analyzer_output(opts):
     """ Display error message from analyzer. """
 
@@ -341,10 +688,11 @@ def report_failure(opts):
     os.close(handle)
     # Execute Clang again, but run the syntax check only.
     cwd = opts['directory']
+    env = opts.get('environment')
     cmd = get_arguments(
         [opts['clang'], '-fsyntax-only', '-E'
-         ] + opts['flags'] + [opts['source'], '-o', name], cwd)
-    run_command(cmd, cwd=cwd)
+         ] + opts['flags'] + [opts['source'], '-o', name], cwd, env)
+    run_command(cmd, cwd=cwd, env=env)
     # write general information about the crash
     with open(name + '.info.txt', 'w') as handle:
         handle.write(opts['source'] + os.linesep)
@@ -378,11 +726,12 @@ def run_analyzer(opts, continuation=report_failure):
 
     try:
         cwd = opts['directory']
+        env = opts.get('environment')
         cmd = get_arguments([opts['clang'], '--analyze'] +
                             opts['direct_args'] + opts['flags'] +
                             [opts['source'], '-o', target()],
-                            cwd)
-        output = run_command(cmd, cwd=cwd)
+                            cwd, env)
+        output = run_command(cmd, cwd=cwd, env=env)
         return {'error_output': output, 'exit_code': 0}
     except subprocess.CalledProcessError as ex:
         result = {'error_output': ex.output, 'exit_code': ex.returncode}
@@ -485,6 +834,16 @@ IGNORED_FLAGS = {
     '--serialize-diagnostics': 1
 }
 
+# The classifier of the compiler arguments for the analyzer run.
+ANALYZER_ARGUMENTS = ArgumentTable(
+    exact=itertools.chain(
+        ((arg, (SKIP, count)) for arg, count in IGNORED_FLAGS.items()),
+        [('-arch', ('arch', 1)), ('-x', ('language', 1))]),
+    # we don't care about extra warnings, but we should suppress ones
+    # that we don't want to see.
+    prefixes=[('-Wno-', (KEEP, 0)), ('-W', (SKIP, 0))],
+    default=KEEP)
+
 
 @require(['flags'])
 def classify_parameters(opts, continuation=arch_check):
@@ -501,21 +860,17 @@ def classify_parameters(opts, continuation=arch_check):
     # iterate on the compile options
     args = iter(opts['flags'])
     for arg in args:
+        action, count = ANALYZER_ARGUMENTS.classify(arg)
         # take arch flags into a separate basket
-        if arg == '-arch':
+        if action == 'arch':
             result['arch_list'].append(next(args))
         # take language
-        elif arg == '-x':
+        elif action == 'language':
             result['language'] = next(args)
         # ignore some flags
-        elif arg in IGNORED_FLAGS:
-            count = IGNORED_FLAGS[arg]
+        elif action == SKIP:
             for _ in range(count):
                 next(args)
-        # we don't care about extra warnings, but we should suppress ones
-        # that we don't want to see.
-        elif re.match(r'^-W.+', arg) and not re.match(r'^-Wno-.+', arg):
-            pass
         # and consider everything else as compilation flag.
         else:
             result['flags'].append(arg)
@@ -20,6 +20,7 @@ import logging
 import tempfile
 from libscanbuild import reconfigure_logging
 from libscanbuild.clang import get_checkers
+from libscanbuild.daemon import is_daemon_supported
 
 __all__ = ['parse_args_for_intercept_build', 'parse_args_for_analyze_build',
            'parse_args_for_scan_build']
@@ -35,8 +36,12 @@ def parse_args_for_intercept_build():
     logging.debug('Raw arguments %s', sys.argv)
 
     # short validation logic
-    if not args.build:
+    if args.export or args.find:
+        if not os.path.exists(args.cdb):
+            parser.error(message='compilation database is missing')
+    elif not args.build:
         parser.error(message='missing build command')
+    normalize_daemon(args)
 
     logging.debug('Parsed arguments: %s', args)
     return args
@@ -97,6 +102,20 @@ def normalize_args_for_analyze(args, from_build_command):
     if from_build_command:
         # add cdb parameter invisibly to make report module working.
         args.cdb = 'compile_commands.json'
+        args.files = []
+        normalize_daemon(args)
+
+
+def normalize_daemon(args):
+    """ Turn off the daemon mode of the compiler wrappers, when it's not
+    available on the current platform.
+
+    :param args: Parsed argument object. (Will be mutated.) """
+
+    if args.daemon and not is_daemon_supported():
+        logging.warning('Daemon mode is not available, compiler wrappers '
+                        'run without it.')
+        args.daemon = False
 
 
 def validate_args_for_analyze(parser, args, from_build_command):
@@ -121,6 +140,8 @@ def validate_args_for_analyze(parser, args, from_build_command):
         parser.error(message='missing build command')
     elif not from_build_command and not os.path.exists(args.cdb):
         parser.error(message='compilation database is missing')
+    elif args.jobs is not None and args.jobs < 1:
+        parser.error(message='number of jobs shall be positive')
 
 
 def create_intercept_parser():
@@ -131,6 +152,7 @@ def create_intercept_parser():
 
     parser_add_prefer_wrapper(parser)
     parser_add_compilers(parser)
+    parser_add_transport(parser)
 
     advanced = parser.add_argument_group('advanced options')
     group = advanced.add_mutually_exclusive_group()
@@ -139,8 +161,50 @@ def create_intercept_parser():
         action='store_true',
         help="""Extend existing compilation database with new entries.
         Duplicate entries are detected and not present in the final output.
-        The output is not continuously updated, it's done when the build
-        command finished. """)
+        The new entries are appended to the file in place (the file is
+        rewritten only when entries are removed). The compilation database
+        is locked while it's updated, so builds can run concurrently with
+        the same output file.""")
+    advanced.add_argument(
+        '--replace-stale',
+        action='store_true',
+        help="""With '--append', remove the previous entries of the source
+        files which were compiled again (with different flags), instead of
+        keeping all variants of them.""")
+    advanced.add_argument(
+        '--flush-interval',
+        metavar='<seconds>',
+        type=int,
+        help="""Write the compilation database periodically while the build
+        is running, therefore a killed or timed out build leaves the entries
+        found so far behind. (The output file is replaced with a partial
+        result meanwhile, so this is not enabled by default.)""")
+    advanced.add_argument(
+        '--compact',
+        action='store_true',
+        help="""Write the compilation database entries one per line, without
+        indentation. (The file is smaller and faster to parse.)""")
+    advanced.add_argument(
+        '--use-command',
+        action='store_true',
+        help="""Write the compiler calls as a single shell quoted 'command'
+        string, instead of the 'arguments' list.""")
+
+    queries = parser.add_argument_group('compilation database queries')
+    group = queries.add_mutually_exclusive_group()
+    group.add_argument(
+        '--export',
+        metavar='<file>',
+        help="""Write the entries of the compilation database (given by the
+        '--cdb' flag) into the given file, and exit without running a build.
+        The file format is selected by the file name extension, just like
+        for the '--cdb' flag.""")
+    group.add_argument(
+        '--find',
+        metavar='<source>',
+        help="""Print the compilation database entries of the given source
+        file, and exit without running a build. (The exit status is non
+        zero when there were no entries found.)""")
 
     parser.add_argument(
         dest='build', nargs=argparse.REMAINDER, help="""Command to run.""")
@@ -155,6 +219,7 @@ def create_analyze_parser(from_build_command):
     if from_build_command:
         parser_add_prefer_wrapper(parser)
         parser_add_compilers(parser)
+        parser_add_transport(parser)
 
         parser.add_argument(
             '--intercept-first',
@@ -164,8 +229,37 @@ def create_analyze_parser(from_build_command):
             Generally speaking it has better coverage on build commands.
             With '--override-compiler' it use compiler wrapper, but does
             not run the analyzer till the build is finished.""")
+        parser.add_argument(
+            '--pipelined',
+            action='store_true',
+            help="""With '--intercept-first', start to analyze the captured
+            compilations while the build is still running. With '--daemon',
+            the compiler wrappers do not wait for the analyzer, but queue the
+            compilations for it. The analyzer runs with lower scheduling
+            priority, so the build keeps its speed. The queued compilations
+            are analyzed before the report is generated.""")
+        parser.add_argument(
+            '--speculative',
+            action='store_true',
+            help="""With the compiler wrappers (and without '--daemon'), run
+            the analyzer while the compiler is running, instead of after
+            it. The analyzer result is discarded when the compilation
+            fails. The number of these wrappers is limited to the number of
+            processors of the machine, the rest of them run the analyzer
+            after the compiler.""")
     else:
         parser_add_cdb(parser)
+        parser.add_argument(
+            '--file',
+            metavar='<source>',
+            dest='files',
+            action='append',
+            default=[],
+            help="""Run the analyzer only against the compilations of this
+            source file. The entries are looked up by an index file (next
+            to the compilation database), which is created at the first
+            use and recreated when the compilation database changes.
+            (You can specify this option multiple times.)""")
 
     parser.add_argument(
         '--status-bugs',
@@ -182,6 +276,21 @@ def create_analyze_parser(from_build_command):
         help="""Do not run static analyzer against files found in this
         directory. (You can specify this option multiple times.)
         Could be useful when project contains 3rd party libraries.""")
+    parser.add_argument(
+        '--jobs',
+        metavar='<number>',
+        type=int,
+        help="""The number of analyzer processes to run at the same time.
+        (Default is the number of processors.) When '%(prog)s' itself is run
+        by GNU make with '-j', the analyzer processes are counted as jobs of
+        that make too. (The compiler wrappers do the same with the make they
+        were called from.)""")
+    parser.add_argument(
+        '--load-average',
+        metavar='<load>',
+        type=float,
+        help="""Do not start new analyzer processes while the load average
+        of the machine is above this.""")
 
     output = parser.add_argument_group('output control options')
     output.add_argument(
@@ -357,7 +466,10 @@ def parser_add_cdb(parser):
         '--cdb',
         metavar='<file>',
         default="compile_commands.json",
-        help="""The JSON compilation database.""")
+        help="""The JSON compilation database. When the file name extension
+        is '.db', '.sqlite' or '.sqlite3', the compilation database is
+        an SQLite database instead, which can be extended and queried
+        without reading the whole file.""")
 
 
 def parser_add_prefer_wrapper(parser):
@@ -366,6 +478,36 @@ def parser_add_prefer_wrapper(parser):
         action='store_true',
         help="""Always resort to the compiler wrapper even when better
         intercept methods are available.""")
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help="""Make the compiler wrappers thin clients of a server, which
+        is run by this command. The wrappers still run the compiler, but the
+        calls are recorded (or analyzed) by the server. It saves the start
+        of the Python package for every compiler call. (Not available on
+        Windows.)""")
+
+
+def parser_add_transport(parser):
+    parser.add_argument(
+        '--transport',
+        choices=['file', 'log', 'socket', 'arena'],
+        default='file',
+        help="""How the intercepted compiler calls are reported. With 'file'
+        every call is written into a separate file. With 'log' every call is
+        appended to a single log file, which is cheaper on builds with many
+        process executions. With 'socket' every call is sent to a collector
+        process over a Unix domain socket, nothing is written to the disk
+        per call. With 'arena' every call is stored as a binary record in a
+        memory mapped file (only with library preload, the compiler wrappers
+        and the overflow records go to the log file).""")
+    parser.add_argument(
+        '--compiler-filter',
+        action='store_true',
+        help="""Report only those process executions from the intercepting
+        library, which look like a compiler call. The library drops the
+        other calls, before writing the report. (By default every process
+        execution is reported.)""")
 
 
 def parser_add_compilers(parser):
@@ -389,6 +531,22 @@ def parser_add_compilers(parser):
         dest='cxx',
         default=os.getenv('CXX', 'c++'),
         help="""This is the same as "--use-cc" but for C++ code.""")
+    parser.add_argument(
+        '--cc-pattern',
+        metavar='<pattern>',
+        dest='cc_patterns',
+        action='append',
+        default=[],
+        help="""Shell wildcard pattern of C compiler executable names, which
+        are not recognized otherwise. (Eg.: wrappers of cross compilers.)
+        You can specify this option multiple times.""")
+    parser.add_argument(
+        '--cxx-pattern',
+        metavar='<pattern>',
+        dest='cxx_patterns',
+        action='append',
+        default=[],
+        help="""This is the same as "--cc-pattern" but for C++ compilers.""")
 
 
 class AppendCommaSeparated(argparse.Action):
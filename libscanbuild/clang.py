@@ -28,17 +28,18 @@ def get_version(clang):
     return output[0]
 
 
-def get_arguments(command, cwd):
+def get_arguments(command, cwd, env=None):
     """ Capture Clang invocation.
 
     :param command: the compilation command
     :param cwd:     the current working directory
+    :param env:     the environment of the compilation (default is current)
     :return:        the detailed front-end invocation command """
 
     cmd = command[:]
     cmd.insert(1, '-###')
 
-    output = run_command(cmd, cwd=cwd)
+    output = run_command(cmd, cwd=cwd, env=env)
     # The relevant information is in the last line of the output.
     # Don't check if finding last line fails, would throw exception anyway.
     last_line = output[-1]
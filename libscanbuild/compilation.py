@@ -8,11 +8,116 @@
 import re
 import os
 import collections
+import contextlib
+import fnmatch
+import hashlib
+import io
+import itertools
 import logging
 import json
-from libscanbuild import Execution, shell_split
+import mmap
+import multiprocessing
+import pickle
+import struct
+import sys
+import threading
+from libscanbuild import Execution, shell_split, shell_join
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['classify_source', 'compiler_globs', 'register_compiler_patterns',
+           'ArgumentTable',
+           'Compilation', 'CompilationDatabase', 'CompilationStore']
+
+# Number of compilations kept in memory by the CompilationStore.
+STORE_MEMORY_LIMIT = 100000
+# Number of compilations read from the disk at once by the CompilationStore.
+STORE_PAGE_SIZE = 1000
+# Compilation database file extensions which select the SQLite format.
+SQLITE_EXTENSIONS = frozenset(['.db', '.sqlite', '.sqlite3'])
+SQLITE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS compilations ('
+    ' digest BLOB PRIMARY KEY,'
+    ' file TEXT NOT NULL,'
+    ' directory TEXT NOT NULL,'
+    ' flags_digest BLOB NOT NULL,'
+    ' compiler TEXT NOT NULL,'
+    ' flags TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS compilations_file ON compilations (file)',
+    'CREATE INDEX IF NOT EXISTS compilations_directory '
+    'ON compilations (directory)',
+    'CREATE INDEX IF NOT EXISTS compilations_flags '
+    'ON compilations (flags_digest)'
+]
+# The lock file of the compilation database. (See `database_lock`.)
+LOCK_EXTENSION = '.lock'
+# The index file of a JSON compilation database. (See `build_index`.)
+INDEX_EXTENSION = '.index'
+INDEX_MAGIC = b'CDBINDX1'
+INDEX_KEY_SIZE = 8
+INDEX_HEADER = struct.Struct('=8sQdQ')  # magic, size, mtime, count
+INDEX_RECORD = struct.Struct('=8sQQ')  # key, offset, length
+# Number of compilation database entries converted at once.
+LOAD_BATCH_SIZE = 500
+# Number of directory listings kept by the SourceFiles.
+SOURCE_DIRECTORIES_LIMIT = 256
+# Number of characters read at once from the compilation database file.
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_DELIMITERS = frozenset([' ', '\t', '\n', '\r', ',', ']'])
+
+# Actions of the argument classifier. (See the ArgumentTable class.)
+KEEP = 'keep'  # take the argument (and the following ones) as flags
+SKIP = 'skip'  # drop the argument (and the following ones)
+STOP = 'stop'  # the command is not a compilation
+SOURCE = 'source'  # the argument might be a source file
+
+
+class ArgumentTable(object):
+    """ Table driven classifier for compiler arguments.
+
+    The classification result is a tuple of an action and the number of
+    the following arguments which belong to the current one. An argument
+    is looked up in the table of the exact matches first. Then among the
+    prefix rules, which start with the same two characters. (The longest
+    prefix wins, and the argument has to be longer than the prefix.)
+    Otherwise it gets the default action, or the positional action if it
+    does not start with a dash. """
+
+    def __init__(self, exact, prefixes=(), default=KEEP, positional=None):
+        """ :param exact:      map of argument to (action, count) tuples
+            :param prefixes:   list of (prefix, (action, count)) tuples
+            :param default:    action for the arguments not in the table
+            :param positional: action for the arguments without dash """
+
+        self.exact = dict(exact)
+        self.prefixes = collections.defaultdict(list)
+        for prefix, result in sorted(prefixes, key=lambda x: -len(x[0])):
+            self.prefixes[prefix[:2]].append((prefix, result))
+        self.default = (default, 0)
+        self.positional = (positional or default, 0)
+
+    def classify(self, arg):
+        """ Returns the (action, count) tuple for the given argument. """
+
+        result = self.exact.get(arg)
+        if result is not None:
+            return result
+        if not arg.startswith('-'):
+            return self.positional
+        for prefix, result in self.prefixes.get(arg[:2], ()):
+            if len(arg) > len(prefix) and arg.startswith(prefix):
+                return result
+        return self.default
 
-__all__ = ['classify_source', 'Compilation', 'CompilationDatabase']
 
 # Ignored compiler options map for compilation database creation.
 # The map is used in `_split_command` method. (Which does ignore and classify
@@ -51,41 +156,131 @@ IGNORED_FLAGS = {
     '-Xlinker': 1
 }
 
+# The classifier of the compiler arguments for compilation database creation.
+COMPILATION_ARGUMENTS = ArgumentTable(
+    exact=itertools.chain(
+        # some parameters could look like filename, take as compile option
+        ((arg, (KEEP, 1)) for arg in ['-D', '-I']),
+        ((arg, (SKIP, count)) for arg, count in IGNORED_FLAGS.items()),
+        # quit when compilation pass is not involved
+        ((arg, (STOP, 0))
+         for arg in ['-E', '-S', '-cc1', '-M', '-MM', '-###'])),
+    prefixes=[(prefix, (SKIP, 0)) for prefix in ['-l', '-L', '-Wl,']],
+    default=KEEP,
+    positional=SOURCE)
+
 # Known C/C++ compiler wrapper name patterns
-COMPILER_PATTERN_WRAPPER = re.compile(r'^(distcc|ccache)$')
+COMPILER_PATTERN_WRAPPER = r'distcc|ccache'
 
 # Known C compiler executable name patterns
-COMPILER_PATTERNS_CC = frozenset([
-    re.compile(r'^(|i|mpi)cc$'),
-    re.compile(r'^([^-]*-)*[mg]cc(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^([^-]*-)*clang(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^(g|)xlc$'),
-])
+COMPILER_PATTERNS_CC = [
+    r'(|i|mpi)cc',
+    r'([^-]*-)*[mg]cc(-\d+(\.\d+){0,2})?',
+    r'([^-]*-)*clang(-\d+(\.\d+){0,2})?',
+    r'(g|)xlc',
+]
 
 # Known C++ compiler executable name patterns
-COMPILER_PATTERNS_CXX = frozenset([
-    re.compile(r'^(c\+\+|cxx|CC)$'),
-    re.compile(r'^([^-]*-)*[mg]\+\+(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^([^-]*-)*clang\+\+(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^(icpc|mpiCC|mpicxx|mpic\+\+)$'),
-    re.compile(r'^(g|)xl(C|c\+\+)$'),
+COMPILER_PATTERNS_CXX = [
+    r'(c\+\+|cxx|CC)',
+    r'([^-]*-)*[mg]\+\+(-\d+(\.\d+){0,2})?',
+    r'([^-]*-)*clang\+\+(-\d+(\.\d+){0,2})?',
+    r'(icpc|mpiCC|mpicxx|mpic\+\+)',
+    r'(g|)xl(C|c\+\+)',
+]
+
+# All the patterns above in a single expression. The name of the matching
+# group tells the kind of the executable. (The wrapper takes precedence.)
+COMPILER_PATTERN = re.compile(
+    r'^(?:(?P<wrapper>{0})|(?P<c>{1})|(?P<cxx>{2}))$'.format(
+        COMPILER_PATTERN_WRAPPER,
+        '|'.join('(?:' + pattern + ')' for pattern in COMPILER_PATTERNS_CC),
+        '|'.join('(?:' + pattern + ')' for pattern in COMPILER_PATTERNS_CXX)))
+
+# User specified compiler executable name patterns (shell wildcards) by
+# language. (See the `register_compiler_patterns` method.)
+COMPILER_GLOBS_USER = {'c': (), 'c++': ()}
+COMPILER_PATTERNS_USER = {'c': None, 'c++': None}
+
+# The recent decisions of `compiler_language` method. (Key is the executable
+# name and the user specified compiler names.)
+COMPILER_DECISIONS = collections.OrderedDict()
+COMPILER_DECISIONS_LIMIT = 1024
+COMPILER_DECISIONS_LOCK = threading.Lock()
+
+# Source file extension to language mapping for C and C++ compilers.
+SOURCE_LANGUAGES_C = {
+    '.c': 'c',
+    '.i': 'c-cpp-output',
+    '.ii': 'c++-cpp-output',
+    '.m': 'objective-c',
+    '.mi': 'objective-c-cpp-output',
+    '.mm': 'objective-c++',
+    '.mii': 'objective-c++-cpp-output',
+    '.C': 'c++',
+    '.cc': 'c++',
+    '.CC': 'c++',
+    '.cp': 'c++',
+    '.cpp': 'c++',
+    '.cxx': 'c++',
+    '.c++': 'c++',
+    '.C++': 'c++',
+    '.txx': 'c++'
+}
+SOURCE_LANGUAGES_CXX = dict(SOURCE_LANGUAGES_C, **{
+    '.c': 'c++',
+    '.i': 'c++-cpp-output'
+})
+
+# Shell wildcard patterns, which match (at least) every executable name the
+# patterns above would match. These are used by the interception library to
+# filter out the non compiler calls, before those are reported. (False
+# positives are fine, those are filtered out by the `_split_compiler` method.)
+COMPILER_GLOBS = frozenset([
+    '*cc', '*cc-[0-9]*',
+    '*clang', '*clang-[0-9]*',
+    '*++', '*++-[0-9]*',
+    'cxx', 'CC', 'icpc', 'mpiCC', 'mpicxx',
+    '*xlc', '*xlC',
+    'ccache'
 ])
 
 CompilationCommand = collections.namedtuple(
     'CompilationCommand', ['compiler', 'flags', 'files'])
 
 
-class Compilation:
+class Compilation(object):
+    # There could be millions of compilation objects. The attributes are
+    # stored in slots, and the flags (as tuple) and the directory values
+    # are shared between the objects with equal values.
+    __slots__ = ('compiler', 'flags', 'source', 'directory', '_digest')
+
     def __init__(self, compiler, flags, source, directory):
         """ Constructor for a single compilation.
 
         This method just normalize the paths and store the values. """
 
         self.compiler = compiler
-        self.flags = flags
-        self.directory = os.path.normpath(directory)
+        self.flags = intern_value(tuple(flags))
+        self.directory = intern_value(os.path.normpath(directory))
         self.source = source if os.path.isabs(source) else \
             os.path.normpath(os.path.join(self.directory, source))
+        self._digest = None
+
+    def __getstate__(self):
+        """ The pickled form is a plain tuple of the values. """
+
+        return self.compiler, self.flags, self.source, self.directory
+
+    def __setstate__(self, state):
+        """ The shared values are looked up again after unpickling. """
+
+        compiler, flags, source, directory = state
+        self.compiler = compiler
+        self.flags = intern_value(tuple(flags))
+        self.source = source
+        self.directory = intern_value(directory)
+        self._digest = None
 
     def _hash_str(self):
         """ Generate unique hash string for compilation entry.
@@ -104,34 +299,66 @@ class Compilation:
         ])
 
     def __hash__(self):
-        """ See comment for _hash_str method. """
+        """ See comment for digest method. """
 
-        return hash(self._hash_str())
+        return hash(self.digest())
 
     def __eq__(self, other):
-        """ See comment for _hash_str method. """
+        """ See comment for digest method. """
 
         return isinstance(other, Compilation) and \
-            self._hash_str() == other._hash_str()
+            self.digest() == other.digest()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def digest(self):
+        """ Generate a compact unique key for compilation entry.
+
+        Equal entries have the same digest. It's cheaper to store and to
+        pass between processes than the entry itself. It's computed once,
+        and used for hashing and comparison too.
+
+        :return: a short byte string. """
+
+        if self._digest is None:
+            key = self._hash_str().encode('utf-8', 'backslashreplace')
+            self._digest = hashlib.sha1(key).digest()
+        return self._digest
 
     def to_analyzer(self):
         """ This method dumps the object attributes into a dictionary. """
 
-        return dict((key, value) for key, value in vars(self).items())
+        return {
+            'compiler': self.compiler,
+            'flags': list(self.flags),
+            'source': self.source,
+            'directory': self.directory
+        }
+
+    def to_db(self, command=False):
+        """ This method creates a compilation database entry.
 
-    def to_db(self):
-        """ This method creates a compilation database entry. """
+        :param command: the compiler call is a shell quoted string in the
+                        'command' field (instead of 'arguments' list). """
 
         relative = os.path.relpath(self.source, self.directory)
         compiler = 'cc' if self.compiler == 'c' else 'c++'
+        arguments = [compiler, '-c'] + list(self.flags) + [relative]
+        if command:
+            return {
+                'file': relative,
+                'command': shell_join(arguments),
+                'directory': self.directory
+            }
         return {
             'file': relative,
-            'arguments': [compiler, '-c'] + self.flags + [relative],
+            'arguments': arguments,
             'directory': self.directory
         }
 
     @staticmethod
-    def from_call(execution, cc='cc', cxx='c++'):
+    def from_call(execution, cc='cc', cxx='c++', exists=os.path.isfile):
         """ Generator method for compilation entries.
 
         From a single compiler call it can generate zero or more entries.
@@ -139,6 +366,7 @@ class Compilation:
         :param execution:   executed command and working directory
         :param cc:          user specified C compiler name
         :param cxx:         user specified C++ compiler name
+        :param exists:      predicate to check the source file exists
         :return: stream of CompilationDbEntry objects """
 
         candidate = Compilation._split_command(execution.cmd, cc, cxx)
@@ -147,22 +375,23 @@ class Compilation:
                                  source=source,
                                  compiler=candidate.compiler,
                                  flags=candidate.flags)
-            if os.path.isfile(result.source):
+            if exists(result.source):
                 yield result
 
     @staticmethod
-    def from_db(entry):
+    def from_db(entry, exists=os.path.isfile):
         """ Factory method for compilation entry.
 
         From compilation database entry it creates the compilation object.
 
         :param entry:   the compilation database entry
+        :param exists:  predicate to check the source file exists
         :return: a single compilation object """
 
         command = shell_split(entry['command']) if 'command' in entry else \
             entry['arguments']
         execution = Execution(cmd=command, cwd=entry['directory'], pid=0)
-        entries = list(Compilation.from_call(execution))
+        entries = list(Compilation.from_call(execution, exists=exists))
         assert len(entries) == 1
         return entries[0]
 
@@ -176,31 +405,19 @@ class Compilation:
         :return: None if the command is not a compilation, or a tuple
                 (compiler_language, rest of the command) otherwise """
 
-        def is_wrapper(cmd):
-            return True if COMPILER_PATTERN_WRAPPER.match(cmd) else False
-
-        def is_c_compiler(cmd):
-            return os.path.basename(cc) == cmd or \
-                any(pattern.match(cmd) for pattern in COMPILER_PATTERNS_CC)
-
-        def is_cxx_compiler(cmd):
-            return os.path.basename(cxx) == cmd or \
-                any(pattern.match(cmd) for pattern in COMPILER_PATTERNS_CXX)
-
         if command:  # not empty list will allow to index '0' and '1:'
             executable = os.path.basename(command[0])
             parameters = command[1:]
+            language = compiler_language(executable, cc, cxx)
             # 'wrapper' 'parameters' and
             # 'wrapper' 'compiler' 'parameters' are valid.
             # plus, a wrapper can wrap wrapper too.
-            if is_wrapper(executable):
+            if language == 'wrapper':
                 result = Compilation._split_compiler(parameters, cc, cxx)
                 return ('c', parameters) if result is None else result
             # and 'compiler' 'parameters' is valid.
-            elif is_c_compiler(executable):
-                return 'c', parameters
-            elif is_cxx_compiler(executable):
-                return 'c++', parameters
+            elif language:
+                return language, parameters
         return None
 
     @staticmethod
@@ -225,42 +442,947 @@ class Compilation:
         # iterate on the compile options
         args = iter(compiler_and_arguments[1])
         for arg in args:
+            action, count = COMPILATION_ARGUMENTS.classify(arg)
             # quit when compilation pass is not involved
-            if arg in {'-E', '-S', '-cc1', '-M', '-MM', '-###'}:
+            if action == STOP:
                 return None
             # ignore some flags
-            elif arg in IGNORED_FLAGS:
-                count = IGNORED_FLAGS[arg]
+            elif action == SKIP:
                 for _ in range(count):
                     next(args)
-            elif re.match(r'^-(l|L|Wl,).+', arg):
-                pass
-            # some parameters could look like filename, take as compile option
-            elif arg in {'-D', '-I'}:
-                result.flags.extend([arg, next(args)])
             # parameter which looks source file is taken...
-            elif re.match(r'^[^-].+', arg) and classify_source(arg):
+            elif action == SOURCE and len(arg) > 1 and classify_source(arg):
                 result.files.append(arg)
             # and consider everything else as compile option.
             else:
                 result.flags.append(arg)
+                for _ in range(count):
+                    result.flags.append(next(args))
         logging.debug('output is: %s', result)
         # do extra check on number of source files
         return result if result.files else None
 
 
 class CompilationDatabase:
+    """ The compilation database file.
+
+    The file format is JSON, or SQLite when the file name has one of the
+    `SQLITE_EXTENSIONS`. The SQLite database has indexes on the source file,
+    the directory and the flags digest columns, so single entries can be
+    found without reading the whole database, and new entries can be added
+    without writing the whole database again. """
+
     @staticmethod
-    def save(filename, iterator):
-        entries = [entry.to_db() for entry in iterator]
-        with open(filename, 'w+') as handle:
-            json.dump(entries, handle, sort_keys=True, indent=4)
+    def save(filename, iterator, compact=False, command=False):
+        """ Write the compilation database file.
+
+        The file is written into a temporary file first, and renamed to the
+        target. This way readers see either the previous or the new content.
+
+        :param filename:    the compilation database file name
+        :param iterator:    the compilations to write
+        :param compact:     write one entry per line, without indentation
+        :param command:     write the compiler calls as 'command' strings
+                            (The last two are ignored by SQLite files.) """
+
+        temporary = '{0}.{1}.tmp'.format(filename, os.getpid())
+        try:
+            if is_sqlite_database(filename):
+                sqlite_insert(sqlite_open(temporary), iterator)
+            else:
+                with open(temporary, 'w+') as handle:
+                    CompilationDatabase.write(handle, iterator, compact,
+                                              command)
+            replace_file(temporary, filename)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
 
     @staticmethod
-    def load(filename):
-        with open(filename, 'r') as handle:
-            for entry in json.load(handle):
+    def write(handle, iterator, compact=False, command=False):
+        """ Write the entries as a JSON array, one entry at a time.
+
+        (The output is the same as `json.dump` would produce from the list
+        of entries, but the list is not built in memory.) """
+
+        handle.write('[')
+        CompilationDatabase.write_elements(handle, iterator, compact,
+                                           command, first=True)
+
+    @staticmethod
+    def write_elements(handle, iterator, compact=False, command=False,
+                       first=True):
+        """ Write the entries as the elements of a JSON array, and close
+        the array.
+
+        :param first:   there are no elements written before these
+        (The other parameters are the same as `write` has.) """
+
+        if compact:
+            options = {'separators': (',', ':')}
+            prefix = '\n'
+        else:
+            options = {'separators': (',', ': '), 'indent': 4}
+            prefix = '\n    '
+        for entry in iterator:
+            text = json.dumps(entry.to_db(command), sort_keys=True, **options)
+            if not compact:
+                text = text.replace('\n', prefix)
+            handle.write((prefix if first else ',' + prefix) + text)
+            first = False
+        handle.write(']' if first else '\n]')
+
+    @staticmethod
+    def append(filename, iterator, compact=False, command=False):
+        """ Append the entries to the JSON array of the compilation database
+        file in place.
+
+        The file is not replaced, readers (which do not take the lock) might
+        see the array incomplete while it's written.
+
+        :param filename:    the compilation database file name
+        :param iterator:    the compilations to append (at least one)
+        :param compact:     write one entry per line, without indentation
+        :param command:     write the compiler calls as 'command' strings """
+
+        with open(filename, 'rb+') as handle:
+            end, empty = json_array_end(handle)
+            handle.seek(end)
+            handle.truncate()
+        with open(filename, 'a') as handle:
+            CompilationDatabase.write_elements(handle, iterator, compact,
+                                               command, first=empty)
+
+    @staticmethod
+    def upsert(filename, iterator, replace=False):
+        """ Add the compilations to an SQLite compilation database file.
+
+        The entries which are already in the database are left untouched,
+        the file is created when it does not exist.
+
+        :param filename:    the compilation database file name
+        :param iterator:    the compilations to add
+        :param replace:     remove the other entries of the same sources
+        :return: the number of added and removed entries. """
+
+        return sqlite_insert(sqlite_open(filename), iterator, replace)
+
+    @staticmethod
+    def merge(filename, iterator, replace=False, compact=False,
+              command=False):
+        """ Add the compilations to the compilation database file.
+
+        The previous content of the file is read while an exclusive lock
+        is held (see `database_lock`), so concurrent merges do not lose each
+        others entries. The entries are matched by their directory, source
+        file and flags. The file is written only if it had changed.
+
+        The new entries are appended to the JSON array in place. Only when
+        previous entries shall be removed (with `replace`), the file is
+        rewritten: the previous entries are copied into a temporary file,
+        which replaces the database. The new entries are read from a
+        `CompilationStore`, so only the digests of the entries are held in
+        memory.
+
+        :param filename:    the compilation database file name
+        :param iterator:    the compilations to add (a `CompilationStore` is
+                            used as it is, it's iterated more than once)
+        :param replace:     remove the previous entries of the sources which
+                            are in the new compilations (with other flags)
+        :param compact:     write one entry per line, without indentation
+        :param command:     write the compiler calls as 'command' strings
+        :return: True if the file was written. """
+
+        if is_sqlite_database(filename):
+            return CompilationDatabase.upsert(filename, iterator,
+                                              replace) > 0
+
+        store = iterator
+        if not isinstance(store, CompilationStore):
+            store = CompilationStore()
+            for entry in iterator:
+                store.add(entry)
+        current = frozenset(merge_key(entry) for entry in store)
+        sources = frozenset(source_key(entry.source) for entry in store) \
+            if replace else frozenset()
+
+        def missing(found):
+            written = set(found)
+            for entry in store:
+                key = merge_key(entry)
+                if key not in written:
+                    written.add(key)
+                    yield entry
+
+        with database_lock(filename):
+            if not os.path.exists(filename):
+                CompilationDatabase.save(filename, missing(()), compact,
+                                         command)
+                return True
+            found = set()
+            stale = False
+            for entry in CompilationDatabase.load(filename):
+                key = merge_key(entry)
+                if key in current:
+                    found.add(key)
+                elif source_key(entry.source) in sources:
+                    stale = True
+            if stale:
+                def merged():
+                    for entry in CompilationDatabase.load(filename):
+                        if merge_key(entry) in current or \
+                                source_key(entry.source) not in sources:
+                            yield entry
+                    for entry in missing(found):
+                        yield entry
+
+                CompilationDatabase.save(filename, merged(), compact,
+                                         command)
+                return True
+            entries = missing(found)
+            first = next(entries, None)
+            if first is None:
+                return False
+            try:
+                CompilationDatabase.append(
+                    filename, itertools.chain([first], entries), compact,
+                    command)
+            except ValueError:
+                logging.debug('rewrite the database: %s', filename)
+                CompilationDatabase.save(
+                    filename, itertools.chain(
+                        CompilationDatabase.load(filename), missing(found)),
+                    compact, command)
+            return True
+
+    @staticmethod
+    def entries(filename):
+        """ Generates the compilation database entries (dictionaries with
+        'directory', 'file' and 'arguments' or 'command' keys).
+
+        :param filename:    the compilation database file name """
+
+        if is_sqlite_database(filename):
+            for compilation in CompilationDatabase.load(filename):
+                yield compilation.to_db()
+        else:
+            with open(filename, 'r') as handle:
+                for entry in json_array_items(handle):
+                    yield entry
+
+    @staticmethod
+    def find(filename, source):
+        """ Generates the compilations of the given source file.
+
+        :param filename:    the compilation database file name
+        :param source:      the source file name (relative to the current
+                            working directory, or absolute)
+        :return: generator of the compilations. """
+
+        source = os.path.abspath(source)
+        if is_sqlite_database(filename):
+            for compilation in sqlite_select(filename, 'WHERE file = ?',
+                                             (source, )):
+                yield compilation
+            return
+        entries = index_lookup(filename, source)
+        if entries is not None:
+            for entry in entries:
                 yield Compilation.from_db(entry)
+            return
+        for entry in CompilationDatabase.entries(filename):
+            path = os.path.join(entry['directory'], entry['file'])
+            if os.path.normpath(path) == source:
+                yield Compilation.from_db(entry)
+
+    @staticmethod
+    def load(filename, processes=1):
+        """ Generates the compilations from the compilation database file.
+
+        The file is parsed incrementally, the first entry is generated
+        before the whole file is read. The entries are converted into
+        compilation objects by a process pool, when it was requested and
+        the file has more than a batch of entries. The order of the entries
+        is kept.
+
+        :param filename:    the compilation database file name
+        :param processes:   number of worker processes (None means as many
+                            as CPUs)
+        :return: generator of the compilations. """
+
+        if is_sqlite_database(filename):
+            for compilation in sqlite_select(filename):
+                yield compilation
+            return
+
+        processes = processes or multiprocessing.cpu_count()
+        with open(filename, 'r') as handle:
+            batches = batched(json_array_items(handle), LOAD_BATCH_SIZE)
+            first = next(batches, [])
+            if processes == 1 or len(first) < LOAD_BATCH_SIZE:
+                for batch in itertools.chain([first], batches):
+                    for compilation in compilations_from_db(batch):
+                        yield compilation
+                return
+
+            patterns = (COMPILER_GLOBS_USER['c'], COMPILER_GLOBS_USER['c++'])
+            # the pool would read the whole input at once, limit it
+            window = threading.Semaphore(processes * 2)
+
+            def tasks():
+                for batch in itertools.chain([first], batches):
+                    window.acquire()
+                    yield batch, patterns
+
+            pool = multiprocessing.Pool(processes)
+            try:
+                for result in pool.imap(load_db_entries, tasks()):
+                    window.release()
+                    for compilation in result:
+                        yield compilation
+            finally:
+                pool.terminate()
+                pool.join()
+
+
+def flags_digest(flags):
+    """ Returns the digest of a compilation flag set. """
+
+    return hashlib.sha1(json.dumps(list(flags)).encode('utf-8')).digest()
+
+
+def merge_key(entry):
+    """ Returns the digest which identifies an entry while merging. """
+
+    key = json.dumps([entry.directory, entry.source, list(entry.flags)])
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+
+def source_key(source):
+    """ Returns the digest of a source file name. """
+
+    return hashlib.sha1(source.encode('utf-8', 'backslashreplace')).digest()
+
+
+@contextlib.contextmanager
+def database_lock(filename):
+    """ Holds an exclusive advisory lock on the compilation database.
+
+    The lock is taken on a separate file (next to the compilation
+    database), because the compilation database itself is replaced on
+    write. Without `fcntl` module (on Windows) the lock is not taken.
+
+    :param filename:    the compilation database file name """
+
+    if fcntl is None:
+        yield
+        return
+    with open(filename + LOCK_EXTENSION, 'a') as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def is_sqlite_database(filename):
+    """ Returns True if the compilation database file is an SQLite one. """
+
+    return os.path.splitext(filename)[1].lower() in SQLITE_EXTENSIONS
+
+
+def sqlite_open(filename):
+    """ Open (and create when needed) an SQLite compilation database.
+
+    :param filename:    the database file name
+    :return: the database connection. """
+
+    if sqlite3 is None:
+        raise RuntimeError('SQLite compilation database needs sqlite3 module')
+    connection = sqlite3.connect(filename)
+    with connection:
+        for statement in SQLITE_SCHEMA:
+            connection.execute(statement)
+    return connection
+
+
+def sqlite_insert(connection, iterator, replace=False):
+    """ Insert the compilations which are not in the database yet.
+
+    The insert is done in a single transaction, and the connection is closed
+    at the end.
+
+    :param connection:  the database connection
+    :param iterator:    the compilations to insert
+    :param replace:     remove the other entries of the same sources
+    :return: the number of inserted and removed entries. """
+
+    sources = collections.defaultdict(set)  # source -> digests
+
+    def rows():
+        for entry in iterator:
+            if replace:
+                sources[entry.source].add(entry.digest())
+            yield (sqlite3.Binary(entry.digest()), entry.source,
+                   entry.directory, sqlite3.Binary(flags_digest(entry.flags)),
+                   entry.compiler, json.dumps(list(entry.flags)))
+
+    try:
+        with connection:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO compilations '
+                '(digest, file, directory, flags_digest, compiler, flags) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows())
+            for source, digests in sources.items():
+                stored = connection.execute(
+                    'SELECT digest FROM compilations WHERE file = ?',
+                    (source, )).fetchall()
+                for digest, in stored:
+                    if bytes(digest) not in digests:
+                        connection.execute(
+                            'DELETE FROM compilations WHERE digest = ?',
+                            (digest, ))
+            return connection.total_changes - before
+    finally:
+        connection.close()
+
+
+def sqlite_select(filename, condition='', parameters=()):
+    """ Generates the compilations from an SQLite compilation database.
+
+    :param filename:    the database file name
+    :param condition:   the 'WHERE' clause of the query
+    :param parameters:  the parameters of the query
+    :return: generator of the compilations in insertion order. """
+
+    if sqlite3 is None:
+        raise RuntimeError('SQLite compilation database needs sqlite3 module')
+    connection = sqlite3.connect(filename)
+    try:
+        flag_sets = dict()  # the flags are decoded once per flags digest
+        cursor = connection.execute(
+            'SELECT compiler, flags_digest, flags, file, directory '
+            'FROM compilations ' + condition + ' ORDER BY rowid', parameters)
+        for compiler, flags_digest, flags, source, directory in cursor:
+            flags_digest = bytes(flags_digest)
+            if flags_digest not in flag_sets:
+                flag_sets[flags_digest] = json.loads(flags)
+            yield Compilation(compiler=compiler,
+                              flags=flag_sets[flags_digest],
+                              source=source,
+                              directory=directory)
+    finally:
+        connection.close()
+
+
+def index_file_name(filename):
+    """ Returns the index file name of a JSON compilation database. """
+
+    return filename + INDEX_EXTENSION
+
+
+def index_key(source):
+    """ Returns the index key of a source file (absolute path). """
+
+    key = os.path.normpath(source).encode('utf-8', 'backslashreplace')
+    return hashlib.sha1(key).digest()[:INDEX_KEY_SIZE]
+
+
+def build_index(filename):
+    """ Creates the index file of a JSON compilation database.
+
+    The index maps the source files to the byte ranges of their entries in
+    the compilation database file. The records are sorted by the key of
+    the source file, so a lookup is a binary search. The size and the
+    modification time of the compilation database is stored in the header,
+    that tells when the index is outdated.
+
+    :param filename:    the compilation database file name """
+
+    stat = os.stat(filename)
+    records = []
+    # the 'latin-1' decoding makes the character offsets equal to the
+    # byte offsets. (The JSON syntax characters are all ASCII.)
+    with io.open(filename, 'r', encoding='latin-1', newline='') as handle, \
+            open(filename, 'rb') as raw:
+        for entry, start, end in json_array_items(handle, offsets=True):
+            source = os.path.join(entry['directory'], entry['file'])
+            if any(ord(char) > 127 for char in source):
+                # the non-ASCII characters are either UTF-8 bytes or escape
+                # sequences, only decoding the element as UTF-8 tells.
+                raw.seek(start)
+                entry = json.loads(raw.read(end - start).decode('utf-8'))
+                source = os.path.join(entry['directory'], entry['file'])
+            records.append((index_key(source), start, end - start))
+    records.sort()
+
+    target = index_file_name(filename)
+    temporary = '{0}.{1}.tmp'.format(target, os.getpid())
+    try:
+        with open(temporary, 'wb') as handle:
+            handle.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size,
+                                           stat.st_mtime, len(records)))
+            for record in records:
+                handle.write(INDEX_RECORD.pack(*record))
+        replace_file(temporary, target)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def index_lookup(filename, source):
+    """ Returns the entries of the source file from a JSON compilation
+    database, using (and creating when it's needed) the index file.
+
+    :param filename:    the compilation database file name
+    :param source:      the source file name (absolute path)
+    :return: the list of compilation database entries, or None when the
+    index can not be used. """
+
+    spans = index_spans(filename, source)
+    if spans is None:
+        try:
+            build_index(filename)
+        except (IOError, OSError, ValueError) as error:
+            logging.debug('index was not created: %s', error)
+            return None
+        spans = index_spans(filename, source)
+        if spans is None:
+            return None
+
+    result = []
+    with open(filename, 'rb') as handle:
+        for offset, length in spans:
+            handle.seek(offset)
+            try:
+                entry = json.loads(handle.read(length).decode('utf-8'))
+                path = os.path.join(entry['directory'], entry['file'])
+            except (ValueError, TypeError, KeyError):
+                return None  # the file was changed meanwhile
+            # the keys are truncated digests, they might collide
+            if os.path.normpath(path) == source:
+                result.append(entry)
+    return result
+
+
+def index_spans(filename, source):
+    """ Search the byte ranges of the source file entries in the index.
+
+    :param filename:    the compilation database file name
+    :param source:      the source file name (absolute path)
+    :return: list of (offset, length) tuples in the compilation database
+    file, or None when the index file is missing or outdated. """
+
+    try:
+        stat = os.stat(filename)
+        with open(index_file_name(filename), 'rb') as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        if len(mapped) < INDEX_HEADER.size:
+            return None
+        magic, size, mtime, count = INDEX_HEADER.unpack_from(mapped, 0)
+        if magic != INDEX_MAGIC or size != stat.st_size or \
+                mtime != stat.st_mtime or \
+                len(mapped) != INDEX_HEADER.size + count * INDEX_RECORD.size:
+            return None
+
+        def record(position):
+            return INDEX_RECORD.unpack_from(
+                mapped, INDEX_HEADER.size + position * INDEX_RECORD.size)
+
+        # binary search for the first record with the key
+        key = index_key(source)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        result = []
+        while low < count:
+            current, offset, length = record(low)
+            if current != key:
+                break
+            result.append((offset, length))
+            low += 1
+        return result
+    finally:
+        mapped.close()
+
+
+def batched(iterator, size):
+    """ Generates lists of the given size from the iterator elements. """
+
+    iterator = iter(iterator)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def compilations_from_db(entries):
+    """ Converts compilation database entries into compilation objects.
+
+    :param entries: list of compilation database entries
+    :return: list of compilations. """
+
+    exists = SourceFiles().exists
+    return [Compilation.from_db(entry, exists) for entry in entries]
+
+
+def load_db_entries(task):
+    """ Converts compilation database entries. (Runs in a pool worker.)
+
+    :param task:    tuple of the compilation database entries and the user
+                    specified compiler patterns.
+    :return: list of compilations. """
+
+    entries, patterns = task
+    register_compiler_patterns(*patterns)
+    return compilations_from_db(entries)
+
+
+class SourceFiles(object):
+    """ Checks the existence of source files.
+
+    The directory entries are read at once with `os.scandir`, that makes a
+    single system call for many source files of the same directory. (Instead
+    of a `stat` call for each file.) Names which are not in the listing are
+    checked individually, to get the same answer as `os.path.isfile` would
+    give on case insensitive file systems. """
+
+    def __init__(self, limit=SOURCE_DIRECTORIES_LIMIT):
+        self.limit = limit
+        self.directories = collections.OrderedDict()
+
+    def exists(self, filename):
+        """ Returns True if the file exists and it's a regular file. """
+
+        if not hasattr(os, 'scandir'):
+            return os.path.isfile(filename)
+
+        directory, name = os.path.split(filename)
+        files = self.directories.get(directory)
+        if files is None:
+            files = self._list(directory)
+            self.directories[directory] = files
+            if len(self.directories) > self.limit:
+                self.directories.popitem(last=False)
+        return name in files or os.path.isfile(filename)
+
+    @staticmethod
+    def _list(directory):
+        try:
+            return frozenset(entry.name for entry in os.scandir(directory)
+                             if entry.is_file())
+        except OSError:
+            return frozenset()
+
+
+def json_array_end(handle):
+    """ Finds the end of the last element of the JSON array in the file.
+
+    :param handle:  the file object (opened in binary mode) to read from
+    :return: a tuple of the offset after the last element (or after the
+    opening bracket), and whether the array is empty. """
+
+    size = handle.seek(0, os.SEEK_END) or handle.tell()
+    start = max(0, size - JSON_CHUNK_SIZE)
+    handle.seek(start)
+    tail = handle.read().rstrip()
+    if not tail.endswith(b']'):
+        raise ValueError('JSON array end expected')
+    content = tail[:-1].rstrip()
+    if not content:
+        raise ValueError('JSON array end not found')
+    return start + len(content), content.endswith(b'[')
+
+
+def json_array_items(handle, chunk_size=JSON_CHUNK_SIZE, offsets=False):
+    """ Generates the elements of a JSON array from a file.
+
+    The file is read in chunks, and the elements are decoded as soon as
+    they are complete. So the memory use is proportional to the size of
+    the largest element, not to the size of the file.
+
+    :param handle:      the file object to read from
+    :param chunk_size:  number of characters to read at once
+    :param offsets:     generate the start and end offset of the elements
+                        (in characters) too
+    :return: generator of the decoded elements (or tuples of the element
+    and the offsets). """
+
+    decoder = json.JSONDecoder()
+    state = {'buffer': '', 'position': 0, 'eof': False, 'base': 0}
+
+    def read_more():
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            state['eof'] = True
+            return False
+        # drop the consumed part of the buffer
+        state['base'] += state['position']
+        state['buffer'] = state['buffer'][state['position']:] + chunk
+        state['position'] = 0
+        return True
+
+    def next_token():
+        """ Skip the whitespaces and return the next character. """
+        while True:
+            match = JSON_WHITESPACE.match(state['buffer'], state['position'])
+            state['position'] = match.end()
+            if state['position'] < len(state['buffer']):
+                return state['buffer'][state['position']]
+            if not read_more():
+                raise ValueError('unexpected end of JSON array')
+
+    if next_token() != '[':
+        raise ValueError('JSON array expected')
+    state['position'] += 1
+    if next_token() == ']':
+        return
+    while True:
+        try:
+            element, end = decoder.raw_decode(state['buffer'],
+                                              state['position'])
+            # a number could continue in the next chunk
+            complete = state['eof'] or \
+                state['buffer'][end:end + 1] in JSON_DELIMITERS
+        except ValueError:
+            element, complete = None, False
+        if not complete:
+            if not read_more() and element is None:
+                raise ValueError('malformed JSON array element')
+            continue
+        if offsets:
+            yield (element, state['base'] + state['position'],
+                   state['base'] + end)
+        else:
+            yield element
+        state['position'] = end
+        token = next_token()
+        state['position'] += 1
+        if token == ']':
+            return
+        elif token != ',':
+            raise ValueError('expected , or ] in JSON array')
+        next_token()
+
+
+# The recently used shared values of the compilation objects. (The least
+# recently used ones are dropped, because per file flags make most of the
+# flag sets unique, and those shall not be kept alive by this table.)
+INTERNED_VALUES = collections.OrderedDict()
+INTERNED_VALUES_LIMIT = 4096
+INTERNED_VALUES_LOCK = threading.Lock()
+
+
+def intern_value(value):
+    """ Returns the shared instance of an equal value.
+
+    :param value:   a hashable value (string or tuple of strings)
+    :return: the recently used equal value, or the given one. """
+
+    with INTERNED_VALUES_LOCK:
+        shared = INTERNED_VALUES.pop(value, value)
+        INTERNED_VALUES[shared] = shared
+        if len(INTERNED_VALUES) > INTERNED_VALUES_LIMIT:
+            INTERNED_VALUES.popitem(last=False)
+        return shared
+
+
+class CompilationStore(object):
+    """ Set of unique compilations with bounded memory use.
+
+    The entries are identified by their digest. Up to the memory limit the
+    entries are kept in memory. When the limit is reached, the entries are
+    moved into a temporary SQLite database (which is removed when the store
+    is garbage collected), and from then on the memory holds only a batch of
+    the new entries.
+
+    It's safe to use it from multiple threads. """
+
+    def __init__(self, limit=STORE_MEMORY_LIMIT):
+        self.limit = limit
+        self.memory = dict()  # digest -> compilation
+        self.database = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, entry, key=None):
+        """ Add the compilation to the store, unless it's already there.
+
+        :param entry:   the compilation to add
+        :param key:     the digest of the compilation (when it's known)
+        :return: True if the compilation was not in the store. """
+
+        key = key or entry.digest()
+        with self.lock:
+            if key in self.memory or self._stored(key):
+                return False
+            self.memory[key] = entry
+            self.count += 1
+            if len(self.memory) >= self.limit:
+                self._spill()
+            return True
+
+    def __iter__(self):
+        """ Generates the compilations. The entries which were added while
+        the iteration is running might not be generated. """
+
+        with self.lock:
+            if self.database is None:
+                entries = list(self.memory.values())
+            else:
+                entries = []
+                self._spill()
+        for entry in entries:
+            yield entry
+        position = 0
+        while self.database is not None:
+            with self.lock:
+                rows = self.database.execute(
+                    'SELECT rowid, entry FROM entries WHERE rowid > ? '
+                    'ORDER BY rowid LIMIT ?',
+                    (position, STORE_PAGE_SIZE)).fetchall()
+            if not rows:
+                break
+            for position, data in rows:
+                yield pickle.loads(bytes(data))
+
+    def _stored(self, key):
+        if self.database is None:
+            return False
+        cursor = self.database.execute(
+            'SELECT 1 FROM entries WHERE digest = ?', (sqlite3.Binary(key), ))
+        return cursor.fetchone() is not None
+
+    def _spill(self):
+        if self.database is None:
+            if sqlite3 is None:
+                logging.debug('sqlite3 is missing, keep entries in memory')
+                self.limit = float('inf')
+                return
+            # empty file name makes a temporary database, which is removed
+            # when the connection is closed.
+            self.database = sqlite3.connect('', check_same_thread=False)
+            self.database.execute('PRAGMA journal_mode = OFF')
+            self.database.execute('PRAGMA synchronous = OFF')
+            self.database.execute('PRAGMA cache_size = -8192')
+            self.database.execute(
+                'CREATE TABLE entries (digest BLOB PRIMARY KEY, entry BLOB)')
+            logging.debug('compilations are moved to disk')
+        rows = ((sqlite3.Binary(key),
+                 sqlite3.Binary(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)))
+                for key, entry in self.memory.items())
+        self.database.executemany(
+            'INSERT OR IGNORE INTO entries VALUES (?, ?)', rows)
+        self.memory.clear()
+
+
+def replace_file(source, destination):
+    """ Rename the source file to the destination, even if it exists.
+
+    On POSIX systems this is an atomic operation. (On Windows with python 2
+    the destination is removed first.)
+
+    :param source:      the file name to rename
+    :param destination: the new file name """
+
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    elif sys.platform == 'win32' and os.path.exists(destination):
+        os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
+
+
+def compiler_globs(cc, cxx):
+    """ Returns the executable name patterns of the compilers.
+
+    :param cc:          user specified C compiler name
+    :param cxx:         user specified C++ compiler name
+    :return: sorted list of shell wildcard patterns. """
+
+    user_specified = set(os.path.basename(compiler) for compiler in [cc, cxx])
+    user_specified.update(COMPILER_GLOBS_USER['c'])
+    user_specified.update(COMPILER_GLOBS_USER['c++'])
+    return sorted(COMPILER_GLOBS | user_specified)
+
+
+def register_compiler_patterns(cc_patterns, cxx_patterns):
+    """ Set the user specified compiler executable name patterns.
+
+    These are for compilers with names, which are not recognized by the
+    known patterns. (Eg.: wrappers of cross compilers.)
+
+    :param cc_patterns:     shell wildcard patterns of C compilers
+    :param cxx_patterns:    shell wildcard patterns of C++ compilers """
+
+    def compile_globs(patterns):
+        if not patterns:
+            return None
+        expression = '|'.join(fnmatch.translate(glob) for glob in patterns)
+        return re.compile(expression)
+
+    globs = {'c': tuple(cc_patterns or ()), 'c++': tuple(cxx_patterns or ())}
+    if globs == COMPILER_GLOBS_USER:
+        return
+    with COMPILER_DECISIONS_LOCK:
+        for language in globs:
+            COMPILER_GLOBS_USER[language] = globs[language]
+            COMPILER_PATTERNS_USER[language] = compile_globs(globs[language])
+        COMPILER_DECISIONS.clear()
+
+
+def compiler_language(executable, cc, cxx):
+    """ Classify the executable name as compiler.
+
+    The decisions are kept in a LRU cache, because the same few executables
+    are classified for every execution.
+
+    :param executable:  the executable name (without directory)
+    :param cc:          user specified C compiler name
+    :param cxx:         user specified C++ compiler name
+    :return: 'wrapper', 'c', 'c++' or None """
+
+    key = (executable, cc, cxx)
+    with COMPILER_DECISIONS_LOCK:
+        if key in COMPILER_DECISIONS:
+            language = COMPILER_DECISIONS.pop(key)
+            COMPILER_DECISIONS[key] = language
+            return language
+
+    def matches(language):
+        pattern = COMPILER_PATTERNS_USER[language]
+        return pattern is not None and pattern.match(executable) is not None
+
+    match = COMPILER_PATTERN.match(executable)
+    kind = match.lastgroup if match else None
+    if kind == 'wrapper':
+        language = 'wrapper'
+    elif kind == 'c' or os.path.basename(cc) == executable or matches('c'):
+        language = 'c'
+    elif kind == 'cxx' or os.path.basename(cxx) == executable or \
+            matches('c++'):
+        language = 'c++'
+    else:
+        language = None
+
+    with COMPILER_DECISIONS_LOCK:
+        COMPILER_DECISIONS[key] = language
+        if len(COMPILER_DECISIONS) > COMPILER_DECISIONS_LIMIT:
+            COMPILER_DECISIONS.popitem(last=False)
+    return language
 
 
 def classify_source(filename, c_compiler=True):
@@ -271,24 +1393,6 @@ def classify_source(filename, c_compiler=True):
     :param c_compiler:  indicate that the compiler is a C compiler,
     :return: the language from file name extension. """
 
-    mapping = {
-        '.c': 'c' if c_compiler else 'c++',
-        '.i': 'c-cpp-output' if c_compiler else 'c++-cpp-output',
-        '.ii': 'c++-cpp-output',
-        '.m': 'objective-c',
-        '.mi': 'objective-c-cpp-output',
-        '.mm': 'objective-c++',
-        '.mii': 'objective-c++-cpp-output',
-        '.C': 'c++',
-        '.cc': 'c++',
-        '.CC': 'c++',
-        '.cp': 'c++',
-        '.cpp': 'c++',
-        '.cxx': 'c++',
-        '.c++': 'c++',
-        '.C++': 'c++',
-        '.txx': 'c++'
-    }
-
+    mapping = SOURCE_LANGUAGES_C if c_compiler else SOURCE_LANGUAGES_CXX
     __, extension = os.path.splitext(os.path.basename(filename))
     return mapping.get(extension)
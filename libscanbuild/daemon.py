@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" This module implements the daemon mode of the compiler wrappers.
+
+In daemon mode the compiler wrappers are small scripts, which do not import
+this package. They run the real compiler, and hand the call over to a server
+(run by 'intercept-build' or 'scan-build') over a Unix domain socket. The
+server does the rest of the wrapper work: it records the execution or runs
+the analyzer. So, the package import and the parameter parsing is done once
+per build, and not once per compiler call.
+
+The scripts are generated into a temporary directory at the start of the
+build. The parameters (like the real compiler or the server address) are
+written into the scripts, instead of passing them in environment variables.
+"""
+
+import json
+import logging
+import os
+import os.path
+import select
+import socket
+import stat
+import sys
+import threading
+
+__all__ = ['is_daemon_supported', 'install_clients', 'Server']
+
+CLIENT_TEMPLATE = os.path.join(os.path.dirname(__file__), 'resources',
+                               'wrapper_client.py')
+CLIENT_DIRECTORY = 'bin'
+SERVER_SOCKET_FILE = 'wrapper.sock'
+# the kernel truncates the interpreter line of the scripts above this.
+SHEBANG_LIMIT = 127
+UNSUPPORTED_PLATFORMS = frozenset({'win32', 'cygwin'})
+
+
+def is_daemon_supported():
+    """ The daemon mode needs Unix domain sockets and an interpreter which
+    can be written into the interpreter line of a script. """
+
+    interpreter = sys.executable
+    return sys.platform not in UNSUPPORTED_PLATFORMS and \
+        hasattr(socket, 'AF_UNIX') and \
+        bool(interpreter) and \
+        not any(char.isspace() for char in interpreter) and \
+        len(interpreter) + len('#! -S') < SHEBANG_LIMIT
+
+
+def install_clients(directory, names, compilers, mode, address,
+                    fallback=None):
+    """ Writes the compiler wrapper scripts into the given directory.
+
+    :param directory:   the directory where the scripts shall go,
+    :param names:       the file names of the C and C++ compiler wrappers,
+    :param compilers:   the C and C++ compiler commands (as lists),
+    :param mode:        'intercept' or 'analyze',
+    :param address:     the server address (None when the server is not
+                        needed, the scripts will just execute the compiler),
+    :param fallback:    the trace log file to append the execution report,
+                        when the server is not reachable,
+    :return: the paths of the C and C++ compiler wrapper scripts. """
+
+    target_dir = os.path.join(directory, CLIENT_DIRECTORY)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    with open(CLIENT_TEMPLATE, 'r') as handle:
+        template = handle.read()
+
+    def install(filename, name, compiler):
+        constants = [('NAME', name), ('COMPILER', compiler), ('MODE', mode),
+                     ('ADDRESS', address), ('FALLBACK', fallback)]
+        lines = ['#!{0} -S'.format(sys.executable),
+                 '# -*- coding: utf-8 -*-']
+        lines.extend('{0} = {1!r}'.format(key, value)
+                     for key, value in constants)
+        path = os.path.join(target_dir, filename)
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n' + template)
+        mode_bits = os.stat(path).st_mode
+        os.chmod(path, mode_bits | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        return path
+
+    (cc_name, cxx_name), (cc, cxx) = names, compilers
+    logging.debug('compiler wrapper scripts are written into: %s', target_dir)
+    return install(cc_name, 'cc', cc), install(cxx_name, 'c++', cxx)
+
+
+class Server(object):
+    """ Serves the compiler wrapper scripts over a Unix domain socket.
+
+    Every script sends a single request (a JSON object in a line), and waits
+    for the connection to be closed, when it needs the result. The requests
+    are served on their own thread, because the handler might run long (like
+    the analyzer does). The connection is closed after the handler returns.
+    """
+
+    def __init__(self, address, handler):
+        self.address = address
+        self.handler = handler
+        self.count = 0
+        self.workers = []
+        self.stopped = threading.Event()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(address)
+        self.socket.listen(128)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+
+    def start(self):
+        """ Start to accept requests on the background thread. """
+
+        logging.debug('server is listening on: %s', self.address)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the background thread. The connections which are already
+        made are served, and the handlers are finished before this returns.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        self.socket.close()
+        for worker in self.workers:
+            worker.join()
+        logging.debug('server received %d requests', self.count)
+
+    def _serve(self):
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.socket], [], [], 0.1)
+            if readable:
+                self._accept()
+        # drain the pending connections
+        self.socket.setblocking(False)
+        while self._accept():
+            pass
+
+    def _accept(self):
+        try:
+            connection, _ = self.socket.accept()
+        except socket.error:
+            return False
+        connection.setblocking(True)
+        self.count += 1
+        # forget the finished workers, to keep the list short.
+        self.workers = [worker for worker in self.workers
+                        if worker.is_alive()]
+        worker = threading.Thread(target=self._handle, args=(connection, ))
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+        return True
+
+    def _handle(self, connection):
+        try:
+            chunks = []
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            for line in b''.join(chunks).decode('utf-8').splitlines():
+                if line.strip():
+                    self.handler(json.loads(line))
+        except Exception:
+            logging.warning('failed to serve compiler wrapper request',
+                            exc_info=True)
+        finally:
+            connection.close()
@@ -14,33 +14,67 @@ The 'libear' library is capturing all child process creation and logging the
 relevant information about it into separate files in a specified directory.
 The parameter of this process is the output directory name, where the report
 files shall be placed. This parameter is passed as an environment variable.
-
-The module also implements compiler wrappers to intercept the compiler calls.
+With the 'log' transport the reports are not written into separate files,
+but appended into a single log file (one JSON object per line) inside the
+same directory. With the 'socket' transport the reports are sent to a
+collector, which listens on a Unix domain socket inside the same directory,
+and classifies the executions while the build is running. With the 'arena'
+transport the reports are binary records in a memory mapped file, which is
+shared by all processes of the build. The reports are read on a background
+thread while the build is running, so the post-processing does not start
+with all the reports at the end of the build.
+
+The compiler wrappers to intercept the compiler calls are implemented in the
+'wrapper' module.
 
 The module implements the build command execution and the post-processing of
 the output files, which will condensates into a compilation database. """
 
+import codecs
+import contextlib
 import itertools
 import json
 import logging
+import mmap
+import multiprocessing
 import os
 import os.path
 import re
+import select
+import socket
+import struct
 import sys
-import uuid
+import threading
+import time
 
 from libear import build_libear, temporary_directory
-from libscanbuild import command_entry_point, wrapper_entry_point, \
-    wrapper_environment, run_build, run_command, Execution
+from libscanbuild import command_entry_point, wrapper_environment, \
+    run_build, run_command, shell_split, Execution
 from libscanbuild.arguments import parse_args_for_intercept_build
-from libscanbuild.compilation import Compilation, CompilationDatabase
+from libscanbuild.compilation import Compilation, CompilationDatabase, \
+    CompilationStore, compiler_globs, register_compiler_patterns, \
+    COMPILER_GLOBS_USER
+from libscanbuild.daemon import install_clients
+from libscanbuild.wrapper import intercept_compiler_wrapper, \
+    TRACE_FILE_EXTENSION, TRACE_LOG_FILE, TRACE_SOCKET_FILE
 
 __all__ = ['capture', 'intercept_build', 'intercept_compiler_wrapper']
 
 COMPILER_WRAPPER_CC = 'intercept-cc'
 COMPILER_WRAPPER_CXX = 'intercept-c++'
-TRACE_FILE_EXTENSION = '.json'  # same as in ear.c
+TRACE_ARENA_FILE = 'execution.arena'  # same as in ear.c
+TRACE_ARENA_SIZE = 256 * 1024 * 1024
+# The arena file layout. (Shall be sync with the writer in ear.c.)
+ARENA_MAGIC = 0x41524145
+ARENA_VERSION = 2
+ARENA_COMMITTED = 0x43524145
+ARENA_HEADER = struct.Struct('=IIII')  # magic, version, capacity, offset
+ARENA_RECORD = struct.Struct('=IIIIII')  # size, state, pid, argc, length, _
 WRAPPER_ONLY_PLATFORMS = frozenset({'win32', 'cygwin'})
+POLL_INTERVAL = 1.0  # seconds between two reads of the trace files
+# above this many trace files the parsing is done by a process pool.
+PARALLEL_PARSE_THRESHOLD = 2000
+PARALLEL_PARSE_CHUNK = 500
 
 
 @command_entry_point
@@ -48,35 +82,279 @@ def intercept_build():
     """ Entry point for 'intercept-build' command. """
 
     args = parse_args_for_intercept_build()
-    exit_code, current = capture(args)
-
-    # To support incremental builds, it is desired to read elements from
-    # an existing compilation database from a previous run.
-    if args.append and os.path.isfile(args.cdb):
-        previous = CompilationDatabase.load(args.cdb)
-        entries = iter(set(itertools.chain(previous, current)))
-        CompilationDatabase.save(args.cdb, entries)
-    else:
-        CompilationDatabase.save(args.cdb, current)
+
+    # queries of an existing compilation database (no build to run)
+    if args.export:
+        CompilationDatabase.save(args.export,
+                                 CompilationDatabase.load(args.cdb),
+                                 args.compact, args.use_command)
+        return 0
+    if args.find:
+        entries = [entry.to_db(args.use_command)
+                   for entry in CompilationDatabase.find(args.cdb, args.find)]
+        print(json.dumps(entries, sort_keys=True, indent=4))
+        return 0 if entries else 1
+
+    def write(current):
+        # To support incremental builds, it is desired to keep the elements
+        # of an existing compilation database from a previous run. They
+        # are read at write time (under lock), to pick up the results of
+        # the concurrently running builds too.
+        if args.append:
+            CompilationDatabase.merge(args.cdb, current, args.replace_stale,
+                                      args.compact, args.use_command)
+        else:
+            CompilationDatabase.save(args.cdb, current, args.compact,
+                                     args.use_command)
+
+    exit_code, current = capture(args, write, args.flush_interval)
+    write(current)
 
     return exit_code
 
 
-def capture(args):
+def capture(args, flush=None, flush_interval=None, listener=None):
     """ Implementation of compilation database generation.
 
-    :param args:    the parsed and validated command line arguments
-    :return:        the exit status of build process. """
-
+    The execution reports are read while the build is running. The flush
+    method is called periodically with the compilations found so far, so
+    the caller can save a partial result. (Which is useful if the build
+    is killed or timed out.) The listener is called with every new
+    compilation as soon as it's found. (It's called from background
+    threads.)
+
+    :param args:            the parsed and validated command line arguments
+    :param flush:           method to call with the compilations found so far
+    :param flush_interval:  seconds between two flush calls (None disables
+                            it)
+    :param listener:        method to call with each new compilation
+    :return:        the exit status of build process, and the unique
+                    compilations (a `CompilationStore`). """
+
+    register_compiler_patterns(args.cc_patterns, args.cxx_patterns)
     with temporary_directory(prefix='intercept-') as tmp_dir:
+        classifier = Classifier(args.cc, args.cxx, listener)
         # run the build command
         environment = setup_environment(args, tmp_dir)
-        exit_code = run_build(args.build, env=environment)
-        # read the intercepted exec calls
-        calls = (parse_exec_trace(file) for file in exec_trace_files(tmp_dir))
-        current = compilations(calls, args.cc, args.cxx)
+        with parse_pool(args) as pool:
+            consumer = Consumer(TraceReader(tmp_dir, remove=True), classifier,
+                                flush, flush_interval, pool)
+            with consume(consumer), collect(args, tmp_dir, classifier):
+                exit_code = run_build(args.build, env=environment)
+
+        return exit_code, classifier.entries
+
+
+@contextlib.contextmanager
+def parse_pool(args):
+    """ Runs a process pool to parse the trace files, when every execution
+    is reported in a separate file.
+
+    The pool is started before the reader threads, because forking a
+    multi-threaded process is not safe. (When other threads are running
+    already, the trace files are parsed on the current process.)
+
+    :param args:    command line arguments
+    :return: a process pool or None. """
+
+    if args.transport != 'file' or use_daemon(args) or \
+            threading.active_count() > 1:
+        yield None
+        return
+
+    pool = multiprocessing.Pool()
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+@contextlib.contextmanager
+def collect(args, destination, classifier):
+    """ Runs the execution report collector when the transport requires it.
+
+    The compiler wrappers in daemon mode are reporting to the collector,
+    regardless of the transport. The reporters fall back to the trace log
+    file when the collector is not reachable. So, failing to start the
+    collector is not fatal.
+
+    :param args:        command line arguments
+    :param destination: directory path for the collector socket
+    :param classifier:  the Classifier object to feed with the received
+                        execution reports. """
+
+    if args.transport != 'socket' and not use_daemon(args):
+        yield
+        return
+
+    try:
+        collector = Collector(os.path.join(destination, TRACE_SOCKET_FILE),
+                              classifier)
+    except (AttributeError, socket.error):
+        logging.warning('could not start collector', exc_info=True)
+        yield
+        return
+
+    collector.start()
+    try:
+        yield
+    finally:
+        collector.stop()
+
+
+@contextlib.contextmanager
+def consume(consumer):
+    """ Runs the execution report consumer while the context is active.
+
+    When the context exits, the remaining reports are read.
 
-        return exit_code, iter(set(current))
+    :param consumer:    the Consumer object to run. """
+
+    consumer.start()
+    try:
+        yield
+    finally:
+        consumer.stop()
+
+
+class Classifier(object):
+    """ Collects the unique compilations from the execution reports.
+
+    The reports are fed by multiple threads (the collector and the consumer)
+    while the build is running. The compilations are kept in a thread safe
+    store, which moves them to the disk when there are too many of them.
+    The listener (if given) is called with each new compilation, duplicates
+    are not passed to it. """
+
+    def __init__(self, cc, cxx, listener=None):
+        self.cc = cc
+        self.cxx = cxx
+        self.listener = listener
+        self.entries = CompilationStore()
+
+    def feed(self, executions):
+        """ Classify the executions and add the new compilations.
+
+        :param executions:  iterator of Execution objects
+        :return: the number of new compilations. """
+
+        entries = compilations(executions, self.cc, self.cxx)
+        return self.merge((entry.digest(), entry) for entry in entries)
+
+    def feed_trace_files(self, pool, filenames, final):
+        """ Parse and classify the trace files on a process pool.
+
+        :param pool:        the process pool to run the parsing
+        :param filenames:   list of trace file names
+        :param final:       the writers are finished (see TraceReader)
+        :return: the list of trace files which were processed. """
+
+        patterns = (COMPILER_GLOBS_USER['c'], COMPILER_GLOBS_USER['c++'])
+        chunks = [(filenames[index:index + PARALLEL_PARSE_CHUNK],
+                   self.cc, self.cxx, patterns, final)
+                  for index in range(0, len(filenames), PARALLEL_PARSE_CHUNK)]
+        done = []
+        for pairs, processed in pool.imap_unordered(classify_trace_files,
+                                                    chunks):
+            self.merge(pairs)
+            done.extend(processed)
+        return done
+
+    def merge(self, pairs):
+        """ Add the new compilations.
+
+        :param pairs:   iterator of (digest, compilation) tuples
+        :return: the number of new compilations. """
+
+        count = 0
+        for key, entry in pairs:
+            if not self.entries.add(entry, key):
+                continue
+            count += 1
+            if self.listener:
+                self.listener(entry)
+        return count
+
+
+class Consumer(object):
+    """ Reads the execution reports while the build is running.
+
+    The trace files are polled on a background thread. The time spent on
+    reading is kept below a fraction of the elapsed time, by making the
+    polling interval longer when reading takes long. When stopped, the
+    remaining reports are read (including the ones which were not found
+    complete during the build). Many trace files are parsed on the process
+    pool (if given). """
+
+    def __init__(self, reader, classifier, flush=None, flush_interval=None,
+                 pool=None):
+        self.reader = reader
+        self.classifier = classifier
+        self.pool = pool
+        self.flush = flush
+        self.flush_interval = flush_interval
+        self.flushed = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        """ Start to read reports on the background thread. """
+
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the background thread and read the remaining reports. """
+
+        self.stopped.set()
+        self.thread.join()
+        count = self._read(final=True)
+        logging.debug('consumer found %d entries after the build', count)
+
+    def _run(self):
+        interval = POLL_INTERVAL
+        last_flush = time.time()
+        while not self.stopped.wait(interval):
+            started = time.time()
+            try:
+                self._read(final=False)
+            except Exception:
+                logging.warning('failed to read execution reports',
+                                exc_info=True)
+            finished = time.time()
+            interval = max(POLL_INTERVAL, 10 * (finished - started))
+            if self.flush_interval and \
+                    self.flush_interval <= finished - last_flush:
+                self._flush()
+                last_flush = finished
+
+    def _read(self, final):
+        count = self.classifier.feed(self.reader.read_reports(final))
+        trace_files = self.reader.trace_files()
+        if self.pool and len(trace_files) >= PARALLEL_PARSE_THRESHOLD:
+            before = len(self.classifier.entries)
+            done = self.classifier.feed_trace_files(self.pool, trace_files,
+                                                    final)
+            self.reader.release(done)
+            count += len(self.classifier.entries) - before
+        else:
+            executions = self.reader.parse_trace_files(trace_files, final)
+            count += self.classifier.feed(executions)
+        return count
+
+    def _flush(self):
+        if not self.flush:
+            return
+        count = len(self.classifier.entries)
+        if count == self.flushed:
+            return
+        try:
+            self.flush(self.classifier.entries)
+            self.flushed = count
+            logging.debug('flushed %d entries', count)
+        except (IOError, OSError):
+            logging.warning('failed to write partial result', exc_info=True)
 
 
 def compilations(exec_calls, cc, cxx):
@@ -106,18 +384,35 @@ def setup_environment(args, destination):
     :param destination: directory path for the execution trace files
     :return: a prepared set of environment variables. """
 
-    use_wrapper = args.override_compiler or is_preload_disabled(sys.platform)
-
     environment = dict(os.environ)
-    environment.update({'INTERCEPT_BUILD_TARGET_DIR': destination})
-
-    if use_wrapper:
+    environment.update({
+        'INTERCEPT_BUILD_TARGET_DIR': destination,
+        'INTERCEPT_BUILD_TRANSPORT': args.transport
+    })
+
+    if use_daemon(args):
+        cc, cxx = install_clients(
+            destination, (COMPILER_WRAPPER_CC, COMPILER_WRAPPER_CXX),
+            (shell_split(args.cc), shell_split(args.cxx)), 'intercept',
+            os.path.join(destination, TRACE_SOCKET_FILE),
+            os.path.join(destination, TRACE_LOG_FILE))
+        environment.update({'CC': cc, 'CXX': cxx})
+    elif use_compiler_wrapper(args):
         environment.update(wrapper_environment(args))
         environment.update({
             'CC': COMPILER_WRAPPER_CC,
             'CXX': COMPILER_WRAPPER_CXX,
         })
     else:
+        if args.transport == 'arena':
+            create_exec_arena(os.path.join(destination, TRACE_ARENA_FILE),
+                              TRACE_ARENA_SIZE)
+        if args.compiler_filter:
+            # the library does not report the non compiler calls.
+            patterns = compiler_globs(args.cc, args.cxx)
+            environment.update({
+                'INTERCEPT_BUILD_COMPILERS': ':'.join(patterns)
+            })
         intercept_library = build_libear(args.cc, destination)
         if sys.platform == 'darwin':
             environment.update({
@@ -130,42 +425,93 @@ def setup_environment(args, destination):
     return environment
 
 
-@command_entry_point
-@wrapper_entry_point
-def intercept_compiler_wrapper(_, execution):
-    """ Entry point for `intercept-cc` and `intercept-c++` compiler wrappers.
-
-    It does generate execution report into target directory.
-    The target directory name is from environment variables. """
-
-    message_prefix = 'execution report might be incomplete: %s'
-
-    target_dir = os.getenv('INTERCEPT_BUILD_TARGET_DIR')
-    if not target_dir:
-        logging.warning(message_prefix, 'missing target directory')
-        return
-    # write current execution info to the pid file
-    try:
-        target_file_name = str(uuid.uuid4()) + TRACE_FILE_EXTENSION
-        target_file = os.path.join(target_dir, target_file_name)
-        logging.debug('writing execution report to: %s', target_file)
-        write_exec_trace(target_file, execution)
-    except IOError:
-        logging.warning(message_prefix, 'io problem')
-
-
-def write_exec_trace(filename, entry):
-    """ Write execution report file.
-
-    This method shall be sync with the execution report writer in interception
-    library. The entry in the file is a JSON objects.
-
-    :param filename:    path to the output execution trace file,
-    :param entry:       the Execution object to append to that file. """
+class Collector(object):
+    """ Receives execution reports over a Unix domain socket.
+
+    The collector runs on a background thread. The received executions are
+    classified as they arrive, therefore the compilations are known when the
+    build finished. Every connection carries one or more reports (one JSON
+    object per line), and is closed by the reporter. The connections are
+    served on their own thread, so a stalled reporter does not block the
+    others. """
+
+    def __init__(self, address, classifier):
+        self.address = address
+        self.classifier = classifier
+        self.count = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        self.stopped = threading.Event()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(address)
+        self.socket.listen(128)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+
+    def start(self):
+        """ Start to receive reports on the background thread. """
+
+        logging.debug('collector is listening on: %s', self.address)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the background thread. The connections which are already
+        made are processed before this returns. """
+
+        self.stopped.set()
+        self.thread.join()
+        self.socket.close()
+        for worker in self.workers:
+            worker.join()
+        logging.debug('collector received %d entries', self.count)
+
+    def _serve(self):
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.socket], [], [], 0.1)
+            if readable:
+                self._accept()
+        # drain the pending connections
+        self.socket.setblocking(False)
+        while self._accept():
+            pass
+
+    def _accept(self):
+        try:
+            connection, _ = self.socket.accept()
+        except socket.error:
+            return False
+        # forget the finished workers, to keep the list short.
+        self.workers = [worker for worker in self.workers
+                        if worker.is_alive()]
+        worker = threading.Thread(target=self._handle, args=(connection, ))
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+        return True
 
-    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
-    with open(filename, 'w') as handler:
-        json.dump(call, handler)
+    def _handle(self, connection):
+        try:
+            connection.settimeout(10)
+            chunks = []
+            while True:
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self._receive(b''.join(chunks))
+        except Exception:
+            logging.warning('failed to receive execution report',
+                            exc_info=True)
+        finally:
+            connection.close()
+
+    def _receive(self, data):
+        lines = data.decode('utf-8', 'replace').splitlines()
+        executions = (decode_exec_report(line) for line in lines)
+        count = self.classifier.feed(
+            execution for execution in executions if execution)
+        with self.lock:
+            self.count += count
 
 
 def parse_exec_trace(filename):
@@ -186,17 +532,339 @@ def parse_exec_trace(filename):
             cmd=entry['cmd'])
 
 
+def decode_exec_report(line):
+    """ Decode an execution report, which is a JSON object in a line.
+
+    :param line:    the text of the report
+    :return: an Execution object, or None if the line can't be decoded. """
+
+    if not line.strip():
+        return None
+    try:
+        entry = json.loads(line)
+        return Execution(
+            pid=entry['pid'],
+            cwd=entry['cwd'],
+            cmd=entry['cmd'])
+    except (ValueError, KeyError, TypeError):
+        logging.warning('malformed execution report: %s', line)
+        return None
+
+
+def parse_exec_log(filename):
+    """ Parse execution trace log file.
+
+    Given filename points to a file which contains one execution report per
+    line. Lines which can't be parsed (eg.: the writer process was killed
+    while writing it) are skipped.
+
+    :param filename: path to an execution trace log file to read from,
+    :return: a generator of Execution objects. """
+
+    return ExecLogReader(filename).read(final=True)
+
+
+class ExecLogReader(object):
+    """ Reads the execution trace log file incrementally.
+
+    Only the complete lines are consumed while the build is running. The
+    position after the last consumed line is kept for the next read. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+
+    def read(self, final=True):
+        """ Generates the execution reports appended since the last read.
+
+        :param final:   the writers are finished, so an incomplete line at
+                        the end of the file is consumed too.
+        :return: a generator of Execution objects. """
+
+        if not os.path.isfile(self.filename):
+            return
+        logging.debug(self.filename)
+        with open(self.filename, 'rb') as handler:
+            handler.seek(self.offset)
+            for line in handler:
+                if not final and not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                execution = decode_exec_report(line.decode('utf-8', 'replace'))
+                if execution:
+                    yield execution
+
+
+def create_exec_arena(filename, capacity):
+    """ Create an empty execution trace arena file.
+
+    The file is created with the given size (sparse file on most file
+    systems), and the header is initialized. The interception library
+    appends the binary execution records to it.
+
+    :param filename:    path to the arena file,
+    :param capacity:    the size of the arena in bytes. """
+
+    with open(filename, 'wb') as handler:
+        handler.write(ARENA_HEADER.pack(
+            ARENA_MAGIC, ARENA_VERSION, capacity, ARENA_HEADER.size))
+        handler.truncate(capacity)
+
+
+def parse_exec_arena(filename):
+    """ Parse execution trace arena file.
+
+    The records are decoded from the memory mapped file, without reading
+    the whole file into memory. Records which were not committed by the
+    writer (eg.: the writer process was killed) are skipped. (The size of
+    the records is written at the reservation, so the records after those
+    are found.)
+
+    :param filename: path to an execution trace arena file to read from,
+    :return: a generator of Execution objects. """
+
+    return ExecArenaReader(filename).read(final=True)
+
+
+class ExecArenaReader(object):
+    """ Reads the execution trace arena file incrementally.
+
+    The records which are not yet committed (while the build is running)
+    are skipped by their size, and their position is kept to check them
+    again at the next read. The end of the records is the first position
+    where the record size is not written (not reserved). """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.position = ARENA_HEADER.size
+        self.pending = []
+
+    def read(self, final=True):
+        """ Generates the execution reports committed since the last read.
+
+        :param final:   the writers are finished, so the records which are
+                        not committed are skipped.
+        :return: a generator of Execution objects. """
+
+        if not os.path.isfile(self.filename):
+            return
+        logging.debug(self.filename)
+        with open(self.filename, 'rb') as handler:
+            mapped = mmap.mmap(handler.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mapped)
+            except TypeError:
+                # python 2 mmap does not support the new buffer protocol.
+                view = mapped
+            try:
+                for execution in self._records(mapped, view, final):
+                    yield execution
+            finally:
+                if view is not mapped:
+                    view.release()
+                mapped.close()
+
+    def _records(self, mapped, view, final):
+        magic, version, capacity, _ = ARENA_HEADER.unpack_from(mapped, 0)
+        if magic != ARENA_MAGIC or version != ARENA_VERSION:
+            logging.warning('malformed execution arena: %s', self.filename)
+            return
+        end = min(capacity, len(mapped))
+        # the records which were not committed at the previous read
+        pending, self.pending = self.pending, []
+        for position in pending:
+            execution = self._record(mapped, view, position, final)
+            if execution:
+                yield execution
+        while self.position + ARENA_RECORD.size <= end:
+            position = self.position
+            size = ARENA_RECORD.unpack_from(mapped, position)[0]
+            if not size:
+                return
+            if size < ARENA_RECORD.size or position + size > end:
+                logging.warning('malformed execution report at %d', position)
+                return
+            self.position += size
+            execution = self._record(mapped, view, position, final)
+            if execution:
+                yield execution
+
+    def _record(self, mapped, view, position, final):
+        """ Decodes the record at the given position, or remembers it for
+        the next read when it's not yet committed. """
+
+        _, state, pid, argc, length, _ = \
+            ARENA_RECORD.unpack_from(mapped, position)
+        if state != ARENA_COMMITTED:
+            if final:
+                logging.warning('incomplete execution report at %d', position)
+            else:
+                self.pending.append(position)
+            return None
+        start = position + ARENA_RECORD.size
+        payload = codecs.decode(view[start:start + length], 'utf-8', 'replace')
+        strings = payload.split('\0')
+        return Execution(pid=pid, cwd=strings[0], cmd=strings[1:1 + argc])
+
+
+def exec_traces(directory):
+    """ Generates the execution reports found in the given directory.
+
+    Reads the trace arena file and the trace log file (if those exist) and
+    the separate trace files.
+
+    :param directory:   path to directory which contains the trace files.
+    :return:            a generator of Execution objects. """
+
+    return TraceReader(directory).read(final=True)
+
+
+class TraceReader(object):
+    """ Reads the execution reports from the given directory incrementally.
+
+    The separate trace files which were read are remembered, or removed
+    (when requested) to keep the directory listing short. Trace files which
+    can't be parsed are retried on the next read, because those might be
+    under writing. """
+
+    def __init__(self, directory, remove=False):
+        self.directory = directory
+        self.remove = remove
+        self.seen = set()
+        self.arena = ExecArenaReader(os.path.join(directory, TRACE_ARENA_FILE))
+        self.log = ExecLogReader(os.path.join(directory, TRACE_LOG_FILE))
+
+    def read(self, final=True):
+        """ Generates the execution reports found since the last read.
+
+        :param final:   the writers are finished, so incomplete reports are
+                        skipped instead of waiting for them.
+        :return: a generator of Execution objects. """
+
+        reports = self.read_reports(final)
+        executions = self.parse_trace_files(self.trace_files(), final)
+        return itertools.chain(reports, executions)
+
+    def read_reports(self, final=True):
+        """ Generates the execution reports from the arena and log files. """
+
+        for execution in self.arena.read(final):
+            yield execution
+        for execution in self.log.read(final):
+            yield execution
+
+    def trace_files(self):
+        """ Returns the trace files which were not yet processed. """
+
+        return [trace_file
+                for trace_file in exec_trace_files(self.directory)
+                if trace_file not in self.seen]
+
+    def parse_trace_files(self, filenames, final=True):
+        """ Generates the execution reports from the given trace files. """
+
+        for trace_file in filenames:
+            execution = try_parse_exec_trace(trace_file, final)
+            if execution is not False:
+                self.release([trace_file])
+            if execution:
+                yield execution
+
+    def release(self, filenames):
+        """ Marks the trace files as processed. """
+
+        for trace_file in filenames:
+            if self.remove:
+                os.remove(trace_file)
+            else:
+                self.seen.add(trace_file)
+
+
+def try_parse_exec_trace(filename, final):
+    """ Parse execution report file, which might be under writing.
+
+    :param filename:    path to an execution trace file to read from,
+    :param final:       the writers are finished.
+    :return: an Execution object, None if the file is broken, or False if
+    the file is not yet complete. (It's worth to try it later.) """
+
+    try:
+        return parse_exec_trace(filename)
+    except (IOError, OSError, ValueError, KeyError):
+        if not final:
+            return False
+        logging.warning('malformed execution report: %s', filename)
+        return None
+
+
+def classify_trace_files(task):
+    """ Parse and classify trace files. (Runs in a pool worker process.)
+
+    The duplicates are dropped already here, so less data is passed back
+    to the parent process.
+
+    :param task:    tuple of the trace file names, the C and C++ compiler
+                    names, the user specified compiler patterns and the
+                    final flag.
+    :return: a tuple of the (digest, compilation) pairs and the list of
+    trace files which were processed. """
+
+    filenames, cc, cxx, patterns, final = task
+    register_compiler_patterns(*patterns)
+    entries = dict()
+    done = []
+    for trace_file in filenames:
+        execution = try_parse_exec_trace(trace_file, final)
+        if execution is False:
+            continue
+        done.append(trace_file)
+        if not execution:
+            continue
+        for entry in Compilation.from_call(execution, cc, cxx):
+            entries.setdefault(entry.digest(), entry)
+    return list(entries.items()), done
+
+
 def exec_trace_files(directory):
     """ Generates exec trace file names.
 
+    The trace files are spread into sub-directories. Those are visited
+    with `os.scandir`, when it's available, which does not need a `stat`
+    call to tell the directories apart on most file systems.
+
     :param directory:   path to directory which contains the trace files.
     :return:            a generator of file names (absolute path). """
 
-    for root, _, files in os.walk(directory):
-        for candidate in files:
-            __, extension = os.path.splitext(candidate)
-            if extension == TRACE_FILE_EXTENSION:
-                yield os.path.join(root, candidate)
+    if not hasattr(os, 'scandir'):
+        for root, _, files in os.walk(directory):
+            for candidate in files:
+                if candidate.endswith(TRACE_FILE_EXTENSION):
+                    yield os.path.join(root, candidate)
+        return
+
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.endswith(TRACE_FILE_EXTENSION):
+            yield entry.path
+        elif entry.is_dir(follow_symlinks=False):
+            for trace_file in exec_trace_files(entry.path):
+                yield trace_file
+
+
+def use_compiler_wrapper(args):
+    """ Tells whether the compiler wrappers are used to intercept the
+    compiler calls (instead of the interception library). """
+
+    return args.override_compiler or is_preload_disabled(sys.platform)
+
+
+def use_daemon(args):
+    """ Tells whether the compiler wrappers run in daemon mode. """
+
+    return args.daemon and use_compiler_wrapper(args)
 
 
 def is_preload_disabled(platform):
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" This module implements a client of the GNU make jobserver.
+
+When the build runs with `make -jN`, make shares the N job slots with its
+child processes over a pipe (or a named pipe): a process reads a token from
+it before it starts a new job, and writes the token back when the job is
+finished. Every process started by make has one job slot without a token.
+
+The analyzer processes are jobs too, so with this they are counted in the
+`-j` budget of the build. (This module imports only standard modules,
+because the compiler wrappers use it too.) """
+
+import errno
+import logging
+import os
+import re
+import select
+import stat
+import threading
+import time
+
+__all__ = ['JobServer', 'JobLimit', 'is_overloaded']
+
+# the last one is the effective. the 'fds' is the name before make 4.2.
+JOBSERVER_PATTERN = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+LOAD_POLL_INTERVAL = 0.5  # seconds between two load average checks
+TOKEN_POLL_INTERVAL = 0.1  # seconds between two implicit slot checks
+
+
+class JobServer(object):
+    """ Represents the connection to the GNU make jobserver. """
+
+    def __init__(self, read_fd, write_fd):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+
+    @staticmethod
+    def from_environment(environment=None):
+        """ Connects to the jobserver, which is announced in the MAKEFLAGS
+        environment variable.
+
+        Make does not pass the pipe to commands, which are not recognized as
+        recursive make calls, and those file descriptor numbers might be
+        reused by other pipes. So the announced file descriptors are used
+        only when those are the two ends of the same pipe. (The named pipe
+        is preferred, when it's announced.) The tokens are read in
+        non-blocking mode (other process might take the token between the
+        select and the read), therefore the read end is opened again (when
+        it's possible), because the mode of the inherited file description
+        is shared with the other jobs.
+
+        :param environment: the environment variables (default is current)
+        :return: a JobServer object or None. """
+
+        if environment is None:
+            environment = os.environ
+        flags = environment.get('MAKEFLAGS', '')
+        matches = JOBSERVER_PATTERN.findall(flags)
+        if not matches:
+            return None
+        fifos = [match for match in matches if match.startswith('fifo:')]
+        value = (fifos or matches)[-1]
+        try:
+            if value.startswith('fifo:'):
+                handle = os.open(value[len('fifo:'):],
+                                 os.O_RDWR | os.O_NONBLOCK)
+                return JobServer(handle, handle)
+            read_fd, write_fd = [int(fd) for fd in value.split(',')]
+            if is_same_pipe(read_fd, write_fd):
+                return JobServer(open_nonblocking(read_fd), write_fd)
+        except (ValueError, OSError):
+            pass
+        logging.debug('jobserver is not available: %s', value)
+        return None
+
+    def acquire(self):
+        """ Reads a token from the jobserver, it blocks till one is free.
+
+        :return: the token, which shall be given back by release. """
+
+        while True:
+            token = self.try_acquire(None)
+            if token:
+                return token
+
+    def try_acquire(self, timeout=0):
+        """ Reads a token from the jobserver, when there is one available.
+
+        :param timeout: seconds to wait for a token (None waits forever)
+        :return: the token or None. """
+
+        readable, _, _ = select.select([self.read_fd], [], [], timeout)
+        if not readable:
+            return None
+        try:
+            token = os.read(self.read_fd, 1)
+        except OSError as error:
+            # other process took the token meanwhile.
+            if error.errno in {errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR}:
+                return None
+            raise
+        if not token:
+            raise OSError(errno.EPIPE, 'jobserver is closed')
+        return token
+
+    def release(self, token):
+        """ Gives the token back to the jobserver. """
+
+        os.write(self.write_fd, token)
+
+
+class JobLimit(object):
+    """ Limits the number of concurrent jobs of this process by the
+    jobserver and the load average of the machine.
+
+    The process itself has a job slot (without a token), so one job runs
+    without reading a token from the jobserver. While waiting for a token,
+    the implicit slot is checked periodically too. When reading the
+    jobserver fails, the new jobs are not limited by it, but the tokens
+    which were taken are still given back when the jobs finish. After the
+    limit is closed, every token is given back, and the new jobs are not
+    limited. The method calls are thread safe. """
+
+    def __init__(self, jobserver=None, load_average=None):
+        self.jobserver = jobserver
+        self.load_average = load_average
+        self.lock = threading.Lock()
+        self.failed = False
+        self.closed = False
+        self.implicit_slot = True
+        self.tokens = []
+
+    def acquire(self):
+        """ Blocks till a new job can start. """
+
+        while not self.closed and is_overloaded(self.load_average):
+            time.sleep(LOAD_POLL_INTERVAL)
+        if self.jobserver is None:
+            return
+        while not (self.failed or self.closed):
+            with self.lock:
+                if self.implicit_slot:
+                    self.implicit_slot = False
+                    return
+            try:
+                token = self.jobserver.try_acquire(TOKEN_POLL_INTERVAL)
+            except (OSError, select.error):
+                logging.warning('jobserver failed, jobs are not limited by it',
+                                exc_info=True)
+                self.failed = True
+                return
+            if token:
+                with self.lock:
+                    if not self.closed:
+                        self.tokens.append(token)
+                        return
+                # the limit was closed meanwhile.
+                self._give_back(token)
+                return
+
+    def release(self):
+        """ Marks a job finished. """
+
+        if self.jobserver is None:
+            return
+        with self.lock:
+            if not self.tokens:
+                self.implicit_slot = True
+                return
+            token = self.tokens.pop()
+        self._give_back(token)
+
+    def close(self):
+        """ Gives back every token, which is held by the running jobs. (It
+        shall be called when the jobs are finished or abandoned.) """
+
+        if self.jobserver is None:
+            return
+        with self.lock:
+            self.closed = True
+            tokens, self.tokens = self.tokens, []
+        for token in tokens:
+            self._give_back(token)
+
+    def _give_back(self, token):
+        try:
+            self.jobserver.release(token)
+        except OSError:
+            logging.warning('failed to give back jobserver token',
+                            exc_info=True)
+
+
+def open_nonblocking(fd):
+    """ Opens the pipe of the file descriptor again in non-blocking mode.
+    (It works where the /proc file system is available. Otherwise the given
+    file descriptor is returned.) """
+
+    try:
+        return os.open('/proc/self/fd/{0}'.format(fd),
+                       os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return fd
+
+
+def is_same_pipe(read_fd, write_fd):
+    """ Tells whether the file descriptors are open, and are the ends of
+    the same pipe. """
+
+    try:
+        if read_fd < 0 or write_fd < 0:
+            return False
+        read_stat, write_stat = os.fstat(read_fd), os.fstat(write_fd)
+    except OSError:
+        return False
+    return stat.S_ISFIFO(read_stat.st_mode) and \
+        (read_stat.st_dev, read_stat.st_ino) == \
+        (write_stat.st_dev, write_stat.st_ino)
+
+
+def is_overloaded(load_average):
+    """ Tells whether the load average of the machine is above the limit.
+
+    :param load_average: the limit (None means no limit) """
+
+    if not load_average:
+        return False
+    try:
+        return os.getloadavg()[0] >= load_average
+    except (AttributeError, OSError):
+        return False
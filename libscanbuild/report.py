@@ -16,10 +16,10 @@ import shutil
 import itertools
 import plistlib
 import glob
-import json
 import logging
 import datetime
 from libscanbuild.clang import get_version
+from libscanbuild.compilation import CompilationDatabase
 
 __all__ = ['document']
 
@@ -41,7 +41,11 @@ def document(args):
 
         logging.debug('generate index.html file')
         # common prefix for source files to have sorter path
-        prefix = commonprefix_from(args.cdb) if use_cdb else os.getcwd()
+        if args.files:
+            prefix = commonprefix(os.path.abspath(source)
+                                  for source in args.files)
+        else:
+            prefix = commonprefix_from(args.cdb) if use_cdb else os.getcwd()
         # assemble the cover from multiple fragments
         fragments = []
         try:
@@ -506,8 +510,8 @@ def comment(name, opts=dict()):
 def commonprefix_from(filename):
     """ Create file prefix from a compilation database entries. """
 
-    with open(filename, 'r') as handle:
-        return commonprefix(item['file'] for item in json.load(handle))
+    return commonprefix(item['file']
+                        for item in CompilationDatabase.entries(filename))
 
 
 def commonprefix(files):
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" The compiler wrapper of the daemon mode. (See `libscanbuild.daemon`.)
+
+This file is a template. The wrapper scripts are made of the parameters
+(written as Python literals) and the content of this file. The scripts are
+run without the site packages, therefore only standard modules are used. """
+
+import json
+import os
+import socket
+import sys
+
+# these are written in front of the template.
+# NAME = 'cc'                 the compiler name in the execution report
+# COMPILER = ['gcc']          the real compiler command
+# MODE = 'intercept'          'intercept' or 'analyze'
+# ADDRESS = '/tmp/x/x.sock'   the server socket (None when not needed)
+# FALLBACK = '/tmp/x/x.log'   the trace log, when the server is unreachable
+
+
+def main():
+    arguments = sys.argv[1:]
+    command = COMPILER + arguments
+    execution = {'pid': os.getpid(),
+                 'cwd': os.getcwd(),
+                 'cmd': [NAME] + arguments}
+    if MODE == 'intercept':
+        # the report does not depend on the compilation result.
+        if not send(execution, wait=False):
+            append(FALLBACK, execution)
+        execute(command)
+    elif not ADDRESS:
+        # the analyzer is not requested.
+        execute(command)
+    result = os.spawnvp(os.P_WAIT, command[0], command)
+    if not result:
+        execution['environment'] = dict(os.environ)
+        if not send(execution, wait=True):
+            sys.stderr.write('{0}: analyzer server is not reachable\n'.format(
+                os.path.basename(sys.argv[0])))
+    return result
+
+
+def execute(command):
+    """ Replace the current process with the real compiler. """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(command[0], command)
+
+
+def send(execution, wait):
+    """ Send the execution to the server. (When wait is requested, it
+    returns after the server closed the connection.) """
+
+    record = (json.dumps(execution) + '\n').encode('utf-8')
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(ADDRESS)
+        connection.sendall(record)
+        if wait:
+            connection.shutdown(socket.SHUT_WR)
+            while connection.recv(4096):
+                pass
+        return True
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+
+
+def append(filename, execution):
+    """ Append the execution to the trace log file. (Same as the
+    `libscanbuild.wrapper.append_exec_trace` method.) """
+
+    record = (json.dumps(execution) + '\n').encode('utf-8')
+    handle = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(handle, record)
+    finally:
+        os.close(handle)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
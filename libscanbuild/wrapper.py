@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" This module implements the compiler wrappers.
+
+The 'intercept-cc' and 'analyze-cc' (and the C++ variants) are called by the
+build instead of the real compiler, therefore these run once for every
+compiler call. To keep the start of the wrappers fast, this module imports
+only the standard modules it needs. The rest of the package is imported only
+when the analyzer has to run.
+
+When there is nothing to do after the compilation, the wrapper process is
+replaced by the real compiler (exec). The intercept wrapper writes the
+execution report before that. The analyzer wrapper does it when the analyzer
+is not requested (like at the configure step) or when the command is not a
+compilation.
+
+With speculative analysis, the analyzer wrapper runs the analyzer while the
+compiler is running. The number of these wrappers is limited per machine
+(per user), to not oversubscribe the machine. """
+
+import binascii
+import json
+import logging
+import os
+import os.path
+import re
+import subprocess
+import sys
+from libscanbuild import command_entry_point, reconfigure_logging, \
+    Execution, ENVIRONMENT_KEY
+
+__all__ = ['intercept_compiler_wrapper', 'analyze_compiler_wrapper']
+
+TRACE_FILE_EXTENSION = '.json'  # same as in ear.c
+TRACE_LOG_FILE = 'execution.log'  # same as in ear.c
+TRACE_SOCKET_FILE = 'intercept.sock'  # same as in ear.c
+ANALYZE_ENVIRONMENT_KEY = 'ANALYZE_BUILD'
+SPECULATIVE_ENVIRONMENT_KEY = 'ANALYZE_BUILD_SPECULATIVE'
+LOAD_AVERAGE_ENVIRONMENT_KEY = 'ANALYZE_BUILD_LOAD_AVERAGE'
+SPECULATIVE_SLOTS_DIRECTORY = 'scan-build-slots-{0}'
+# On these platforms the exec system call starts a new process, and the
+# caller of the wrapper would not wait for the compiler to finish.
+EXEC_UNSUPPORTED_PLATFORMS = frozenset({'win32'})
+
+
+@command_entry_point
+def intercept_compiler_wrapper():
+    """ Entry point for `intercept-cc` and `intercept-c++` compiler wrappers.
+
+    The execution report does not depend on the compilation result, so it's
+    written before the real compiler is executed. """
+
+    command, execution = wrapped_compiler()
+    try:
+        report_execution(execution)
+    except Exception:
+        logging.exception('Compiler wrapper failed complete.')
+    return exec_compiler(command)
+
+
+@command_entry_point
+def analyze_compiler_wrapper():
+    """ Entry point for `analyze-cc` and `analyze-c++` compiler wrappers. """
+
+    command, execution = wrapped_compiler()
+    # don't run analyzer when it's not requested.
+    if not os.getenv(ANALYZE_ENVIRONMENT_KEY):
+        return exec_compiler(command)
+    # imported here, because it's not needed when the analyzer does not run.
+    from libscanbuild.compilation import Compilation
+    # don't run analyzer when the command is not a compilation.
+    compilations = list(Compilation.from_call(execution))
+    if not compilations:
+        return exec_compiler(command)
+    # run the analyzer with the compiler, when there is a free slot for it.
+    release = speculative_slot(os.getenv(SPECULATIVE_ENVIRONMENT_KEY))
+    if release is not None:
+        try:
+            return run_compiler_with_analyzer(command, compilations)
+        finally:
+            release()
+    result = run_compiler(command)
+    # don't run analyzer when compilation fails.
+    if not result:
+        try:
+            from libscanbuild.analyze import analyze_compilations
+            analyze_compilations(compilations)
+        except Exception:
+            logging.exception('Compiler wrapper failed complete.')
+    # always return the real compiler exit code
+    return result
+
+
+def wrapped_compiler():
+    """ Returns the real compiler command and the execution to report.
+
+    The real compiler and the verbosity are taken from the environment.
+    Compiler wrapper names contain the compiler type. C++ compiler wrappers
+    ends with `c++`, but might have `.exe` extension on windows. """
+
+    parameters = json.loads(os.environ[ENVIRONMENT_KEY])
+    reconfigure_logging(parameters['verbose'])
+
+    cxx = re.match(r'(.+)c\+\+(.*)', os.path.basename(sys.argv[0]))
+    compiler = parameters['cxx'] if cxx else parameters['cc']
+    execution = Execution(
+        pid=os.getpid(),
+        cwd=os.getcwd(),
+        cmd=['c++' if cxx else 'cc'] + sys.argv[1:])
+    return compiler + sys.argv[1:], execution
+
+
+def run_compiler(command):
+    """ Execute compilation with the real compiler. """
+
+    logging.debug('compilation: %s', command)
+    result = subprocess.call(command)
+    logging.debug('compilation exit code: %d', result)
+    return result
+
+
+def run_compiler_with_analyzer(command, compilations):
+    """ Execute compilation and the analyzer at the same time.
+
+    The analyzer result is discarded when the compilation fails.
+
+    :param command:         the compiler command to execute
+    :param compilations:    the compilations of the command to analyze
+    :return: the exit code of the compiler. """
+
+    logging.debug('compilation (with analyzer): %s', command)
+    process = subprocess.Popen(command)
+    try:
+        from libscanbuild.analyze import analyze_compilations_speculatively
+        result = analyze_compilations_speculatively(compilations,
+                                                    process.wait)
+    except Exception:
+        logging.exception('Compiler wrapper failed complete.')
+        result = process.wait()
+    logging.debug('compilation exit code: %d', result)
+    return result
+
+
+def speculative_slot(slots):
+    """ Acquire a slot to run the analyzer speculatively.
+
+    The slots are lock files in a directory, which is shared by the wrapper
+    processes of the user. When the build runs with the GNU make jobserver,
+    a job token is needed too (the compiler runs in the job slot of the
+    wrapper). And the load average of the machine shall be below the limit
+    (when it was given).
+
+    :param slots:   the number of slots (from the environment, might be None)
+    :return: a method to release the slot, or None when every slot is taken
+    (or the speculative analysis is not requested). """
+
+    if not slots:
+        return None
+    # imported here, because only the speculative analysis needs it.
+    import tempfile
+    from libscanbuild.jobserver import JobServer, is_overloaded
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    load_average = os.getenv(LOAD_AVERAGE_ENVIRONMENT_KEY)
+    if load_average and is_overloaded(float(load_average)):
+        logging.debug('load is too high for speculative analysis')
+        return None
+    directory = os.path.join(
+        tempfile.gettempdir(),
+        SPECULATIVE_SLOTS_DIRECTORY.format(os.getuid()))
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        # other wrapper process might created it meanwhile.
+        if not os.path.isdir(directory):
+            return None
+    for index in range(int(slots)):
+        name = os.path.join(directory, 'slot.{0}'.format(index))
+        try:
+            handle = os.open(name, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(handle)
+            continue
+        jobserver = JobServer.from_environment()
+        try:
+            token = jobserver.try_acquire() if jobserver else None
+        except OSError:
+            token = None
+        if jobserver and not token:
+            logging.debug('no job token for speculative analysis')
+            os.close(handle)
+            return None
+
+        def release():
+            if token:
+                jobserver.release(token)
+            os.close(handle)
+
+        return release
+    logging.debug('no free slot for speculative analysis')
+    return None
+
+
+def exec_compiler(command):
+    """ Replace the current process with the real compiler.
+
+    :param command: the compiler command to execute
+    :return: the exit code of the compiler (on platforms where the process
+    can not be replaced). """
+
+    if sys.platform in EXEC_UNSUPPORTED_PLATFORMS:
+        return run_compiler(command)
+
+    logging.debug('compilation (exec): %s', command)
+    # the buffered output would be lost
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(command[0], command)
+
+
+def report_execution(execution):
+    """ Write the execution report into the target directory.
+
+    The target directory name and the transport are taken from environment
+    variables. """
+
+    message_prefix = 'execution report might be incomplete: %s'
+
+    target_dir = os.getenv('INTERCEPT_BUILD_TARGET_DIR')
+    if not target_dir:
+        logging.warning(message_prefix, 'missing target directory')
+        return
+    # write current execution info to the log or to the pid file
+    try:
+        transport = os.getenv('INTERCEPT_BUILD_TRANSPORT')
+        if transport == 'socket':
+            target_file = os.path.join(target_dir, TRACE_SOCKET_FILE)
+            logging.debug('sending execution report to: %s', target_file)
+            if not send_exec_trace(target_file, execution):
+                fallback_file = os.path.join(target_dir, TRACE_LOG_FILE)
+                append_exec_trace(fallback_file, execution)
+        elif transport in {'log', 'arena'}:
+            # the arena is written only by the interception library.
+            target_file = os.path.join(target_dir, TRACE_LOG_FILE)
+            logging.debug('appending execution report to: %s', target_file)
+            append_exec_trace(target_file, execution)
+        else:
+            unique = binascii.hexlify(os.urandom(16)).decode('ascii')
+            target_file_name = unique + TRACE_FILE_EXTENSION
+            # spread the files into sub-directories (same as in ear.c)
+            shard_dir = os.path.join(target_dir, target_file_name[0],
+                                     target_file_name[1])
+            if not os.path.isdir(shard_dir):
+                try:
+                    os.makedirs(shard_dir)
+                except OSError:
+                    # other wrapper process might created it meanwhile.
+                    if not os.path.isdir(shard_dir):
+                        raise
+            target_file = os.path.join(shard_dir, target_file_name)
+            logging.debug('writing execution report to: %s', target_file)
+            write_exec_trace(target_file, execution)
+    except (IOError, OSError):
+        logging.warning(message_prefix, 'io problem')
+
+
+def write_exec_trace(filename, entry):
+    """ Write execution report file.
+
+    This method shall be sync with the execution report writer in interception
+    library. The entry in the file is a JSON objects.
+
+    :param filename:    path to the output execution trace file,
+    :param entry:       the Execution object to append to that file. """
+
+    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
+    with open(filename, 'w') as handler:
+        json.dump(call, handler)
+
+
+def append_exec_trace(filename, entry):
+    """ Append execution report to the trace log file.
+
+    This method shall be sync with the execution report writer in interception
+    library. The entry is a JSON object in a single line, which is written
+    by a single system call to a file opened in append mode. This makes it
+    safe to be called from concurrent processes.
+
+    :param filename:    path to the execution trace log file,
+    :param entry:       the Execution object to append to that file. """
+
+    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
+    record = (json.dumps(call) + '\n').encode('utf-8')
+    handle = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(handle, record)
+    finally:
+        os.close(handle)
+
+
+def send_exec_trace(address, entry):
+    """ Send execution report to the collector.
+
+    This method shall be sync with the execution report sender in interception
+    library. The entry is the same JSON object, which is written into the
+    trace log file.
+
+    :param address:     path to the Unix domain socket of the collector,
+    :param entry:       the Execution object to send.
+    :return: True if the report was sent, False otherwise. """
+
+    # imported here, because only this transport needs it.
+    import socket
+
+    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
+    record = (json.dumps(call) + '\n').encode('utf-8')
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except (AttributeError, socket.error):
+        return False
+    try:
+        connection.connect(address)
+        connection.sendall(record)
+        return True
+    except socket.error:
+        logging.debug('collector is not reachable', exc_info=True)
+        return False
+    finally:
+        connection.close()
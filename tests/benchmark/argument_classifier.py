@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" Measures the throughput of the compiler argument classification.
+
+The command lines are taken from real world builds. The compilation
+database creation (`Compilation._split_command`) and the analyzer flag
+filtering (`classify_parameters`) are measured, and compared with the
+regular expression based implementation they replaced.
+
+Usage: python argument_classifier.py [number of rounds] """
+
+import os.path
+import re
+import sys
+import timeit
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(this_dir)))
+
+import libscanbuild.analyze as analyze  # noqa: E402
+import libscanbuild.compilation as compilation  # noqa: E402
+
+COMMANDS = [
+    # llvm
+    ['/usr/bin/c++', '-DGTEST_HAS_RTTI=0', '-D_GNU_SOURCE',
+     '-D__STDC_CONSTANT_MACROS', '-D__STDC_FORMAT_MACROS',
+     '-D__STDC_LIMIT_MACROS', '-Ilib/Support', '-I/src/llvm/lib/Support',
+     '-Iinclude', '-I/src/llvm/include', '-fPIC',
+     '-fvisibility-inlines-hidden',
+     '-Werror=date-time', '-std=c++11', '-Wall', '-W', '-Wno-unused-parameter',
+     '-Wwrite-strings', '-Wcast-qual', '-Wno-missing-field-initializers',
+     '-pedantic', '-Wno-long-long', '-Wno-maybe-uninitialized',
+     '-Wdelete-non-virtual-dtor', '-Wno-comment', '-fdiagnostics-color',
+     '-ffunction-sections', '-fdata-sections', '-O3', '-DNDEBUG',
+     '-fno-exceptions', '-fno-rtti', '-MD', '-MT',
+     'lib/Support/CMakeFiles/LLVMSupport.dir/APFloat.cpp.o', '-MF',
+     'lib/Support/CMakeFiles/LLVMSupport.dir/APFloat.cpp.o.d', '-o',
+     'lib/Support/CMakeFiles/LLVMSupport.dir/APFloat.cpp.o', '-c',
+     '/src/llvm/lib/Support/APFloat.cpp'],
+    # linux kernel
+    ['gcc', '-Wp,-MD,kernel/.fork.o.d', '-nostdinc', '-isystem',
+     '/usr/lib/gcc/x86_64-linux-gnu/9/include', '-I./arch/x86/include',
+     '-I./arch/x86/include/generated', '-I./include', '-include',
+     './include/linux/kconfig.h', '-D__KERNEL__', '-Wall', '-Wundef',
+     '-Werror=strict-prototypes', '-Wno-trigraphs', '-fno-strict-aliasing',
+     '-fno-common', '-fshort-wchar', '-fno-PIE', '-std=gnu89', '-mno-sse',
+     '-mno-mmx', '-mno-sse2', '-mno-3dnow', '-mno-avx', '-m64',
+     '-falign-jumps=1', '-falign-loops=1', '-mno-80387', '-mno-fp-ret-in-387',
+     '-mpreferred-stack-boundary=3', '-mskip-rax-setup', '-mtune=generic',
+     '-mno-red-zone', '-mcmodel=kernel', '-O2', '-fno-stack-protector',
+     '-DKBUILD_BASENAME="fork"', '-DKBUILD_MODNAME="fork"', '-c', '-o',
+     'kernel/fork.o', 'kernel/fork.c'],
+    # autotools
+    ['ccache', 'x86_64-linux-gnu-gcc-9', '-DHAVE_CONFIG_H', '-I.', '-I..',
+     '-g', '-O2', '-fstack-protector-strong', '-Wformat',
+     '-Werror=format-security', '-c', '-o', 'util.o', 'util.c'],
+    # not a compilation
+    ['/usr/bin/ld', '-o', 'program', 'main.o', 'util.o', '-L/usr/lib', '-lm'],
+]
+
+LEGACY_WRAPPER = re.compile('^(' + compilation.COMPILER_PATTERN_WRAPPER + ')$')
+LEGACY_PATTERNS_CC = [re.compile('^' + pattern + '$')
+                      for pattern in compilation.COMPILER_PATTERNS_CC]
+LEGACY_PATTERNS_CXX = [re.compile('^' + pattern + '$')
+                       for pattern in compilation.COMPILER_PATTERNS_CXX]
+
+
+def legacy_split_command(command, cc, cxx):
+    """ The regular expression based implementation (for comparison). """
+
+    def split_compiler(command):
+        if command:
+            executable = os.path.basename(command[0])
+            parameters = command[1:]
+            if LEGACY_WRAPPER.match(executable):
+                result = split_compiler(parameters)
+                return ('c', parameters) if result is None else result
+            elif os.path.basename(cc) == executable or \
+                    any(p.match(executable) for p in LEGACY_PATTERNS_CC):
+                return 'c', parameters
+            elif os.path.basename(cxx) == executable or \
+                    any(p.match(executable) for p in LEGACY_PATTERNS_CXX):
+                return 'c++', parameters
+        return None
+
+    compiler_and_arguments = split_compiler(command)
+    if compiler_and_arguments is None:
+        return None
+    flags, files = [], []
+    args = iter(compiler_and_arguments[1])
+    for arg in args:
+        if arg in {'-E', '-S', '-cc1', '-M', '-MM', '-###'}:
+            return None
+        elif arg in compilation.IGNORED_FLAGS:
+            for _ in range(compilation.IGNORED_FLAGS[arg]):
+                next(args)
+        elif re.match(r'^-(l|L|Wl,).+', arg):
+            pass
+        elif arg in {'-D', '-I'}:
+            flags.extend([arg, next(args)])
+        elif re.match(r'^[^-].+', arg) and compilation.classify_source(arg):
+            files.append(arg)
+        else:
+            flags.append(arg)
+    return files and (compiler_and_arguments[0], flags, files)
+
+
+def legacy_classify_parameters(flags):
+    """ The regular expression based implementation (for comparison). """
+
+    result = []
+    args = iter(flags)
+    for arg in args:
+        if arg in {'-arch', '-x'}:
+            next(args)
+        elif arg in analyze.IGNORED_FLAGS:
+            for _ in range(analyze.IGNORED_FLAGS[arg]):
+                next(args)
+        elif re.match(r'^-W.+', arg) and not re.match(r'^-Wno-.+', arg):
+            pass
+        else:
+            result.append(arg)
+    return result
+
+
+def classify_parameters(flags):
+    return analyze.classify_parameters({'flags': flags}, lambda opts: opts)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    arguments = sum(len(command) for command in COMMANDS) * rounds
+    flags = [command[1:] for command in COMMANDS]
+
+    def measure(name, method, inputs):
+        elapsed = timeit.timeit(
+            lambda: [method(current) for current in inputs], number=rounds)
+        print('{0:>30} {1:>14.0f}'.format(name, arguments / elapsed))
+
+    print('{0:>30} {1:>14}'.format('method', 'arguments/s'))
+    measure('legacy split command',
+            lambda cmd: legacy_split_command(cmd, 'cc', 'c++'), COMMANDS)
+    measure('split command',
+            lambda cmd: compilation.Compilation._split_command(cmd, 'cc',
+                                                               'c++'),
+            COMMANDS)
+    measure('legacy classify parameters', legacy_classify_parameters, flags)
+    measure('classify parameters', classify_parameters, flags)
+
+
+if __name__ == '__main__':
+    main()
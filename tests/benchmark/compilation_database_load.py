@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" Measures the compilation database loading.
+
+A CMake like compilation database is generated (with 'command' fields and
+quoted macro definitions), and loaded by the previous implementation
+(`json.load`, `shlex.split` and a `stat` call for every entry), and by the
+current one with a single and with multiple processes.
+
+Usage: python compilation_database_load.py [number of entries] """
+
+import json
+import os
+import os.path
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(this_dir)))
+
+import libscanbuild.compilation as compilation  # noqa: E402
+
+DIRECTORIES = 100
+FILES_PER_DIRECTORY = 50
+
+
+def legacy_shell_split(string):
+    """ The `shlex` based implementation (for comparison). """
+
+    def unescape(arg):
+        if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] == '"':
+            return re.sub(r'\\(["\\])', r'\1', arg[1:-1])
+        return re.sub(r'\\([\\ $%&\(\)\[\]\{\}\*|<>@?!])', r'\1', arg)
+
+    return [unescape(token) for token in shlex.split(string)]
+
+
+def legacy_load(filename):
+    """ The previous implementation (for comparison). """
+
+    with open(filename, 'r') as handle:
+        for entry in json.load(handle):
+            command = legacy_shell_split(entry['command'])
+            execution = compilation.Execution(cmd=command,
+                                              cwd=entry['directory'], pid=0)
+            for result in compilation.Compilation.from_call(execution):
+                yield result
+
+
+def generate(root, filename, count):
+    entries = []
+    for index in range(count):
+        directory = os.path.join(
+            root, 'module{0}'.format(index % DIRECTORIES))
+        source = 'file{0}.cpp'.format(
+            (index // DIRECTORIES) % FILES_PER_DIRECTORY)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if index < DIRECTORIES * FILES_PER_DIRECTORY:
+            open(os.path.join(directory, source), 'w').close()
+        entries.append({
+            'directory': directory,
+            'file': source,
+            'command': '/usr/bin/c++ -DNAME=\\"module{0}\\" -I{1}/include '
+                       '-I"{1}/third party" -O2 -Wall -std=c++11 -fPIC '
+                       '-o {2}.o -c {2}'.format(index, root, source)
+        })
+    with open(filename, 'w') as handle:
+        json.dump(entries, handle, indent=4)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    root = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(root, 'compile_commands.json')
+        generate(root, filename, count)
+
+        print('{0:>20} {1:>10} {2:>14}'.format(
+            'method', 'seconds', 'entries/s'))
+        for name, method in [
+                ('legacy', lambda: legacy_load(filename)),
+                ('single process',
+                 lambda: compilation.CompilationDatabase.load(filename, 1)),
+                ('process pool',
+                 lambda: compilation.CompilationDatabase.load(filename, None))
+        ]:
+            started = time.time()
+            loaded = sum(1 for _ in method())
+            elapsed = time.time() - started
+            assert loaded == count
+            print('{0:>20} {1:>10.2f} {2:>14.0f}'.format(
+                name, elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" Measures the memory use of many compilation objects.
+
+The entries are created the same way as the interception does: the flags
+are parsed (new list) for every entry. In the 'shared' case most entries
+share the flags and the directory with others, in the 'unique' case almost
+every entry has its own flags (like per file '-o' and '-MF' flags). The
+result is compared with plain objects, which hold the same values in a
+dictionary.
+
+Usage: python compilation_memory.py [number of entries] """
+
+import gc
+import os.path
+import pickle
+import sys
+import time
+import tracemalloc
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(this_dir)))
+
+from libscanbuild.compilation import Compilation, \
+    INTERNED_VALUES  # noqa: E402
+
+DIRECTORIES = 200
+FLAG_SETS = {'shared': 50, 'unique': None}
+
+
+class PlainCompilation(object):
+    def __init__(self, compiler, flags, source, directory):
+        self.compiler = compiler
+        self.flags = flags
+        self.directory = os.path.normpath(directory)
+        self.source = os.path.normpath(os.path.join(self.directory, source))
+
+
+def generate(factory, count, flag_sets):
+    for index in range(count):
+        directory = '/home/user/project/module{0}/src'.format(
+            index % DIRECTORIES)
+        variant = index % flag_sets if flag_sets else index
+        flags = ['-O2', '-Wall', '-DVARIANT={0}'.format(variant),
+                 '-I/home/user/project/include', '-std=c++11',
+                 '-o', 'file{0}.o'.format(variant)]
+        yield factory(compiler='c++',
+                      flags=flags,
+                      source='file{0}.cpp'.format(index),
+                      directory=directory)
+
+
+def measure(factory, count, flag_sets):
+    INTERNED_VALUES.clear()
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    entries = list(generate(factory, count, flag_sets))
+    elapsed = time.time() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sample = entries[:1000]
+    pickled = len(pickle.dumps(sample, pickle.HIGHEST_PROTOCOL))
+    del entries
+    return current, elapsed, pickled / float(len(sample))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print('{0:>8} {1:>20} {2:>12} {3:>14} {4:>10} {5:>14}'.format(
+        'flags', 'class', 'total MiB', 'bytes/entry', 'seconds',
+        'pickled/entry'))
+    for case in sorted(FLAG_SETS):
+        for factory in [PlainCompilation, Compilation]:
+            memory, elapsed, pickled = measure(factory, count,
+                                               FLAG_SETS[case])
+            print('{0:>8} {1:>20} {2:>12.1f} {3:>14.1f} {4:>10.2f} '
+                  '{5:>14.1f}'.format(case, factory.__name__,
+                                      memory / 1048576.0,
+                                      memory / float(count), elapsed,
+                                      pickled))
+    # the shared values are not kept alive after the entries are dropped
+    print('interned values left: {0}'.format(len(INTERNED_VALUES)))
+
+
+if __name__ == '__main__':
+    main()
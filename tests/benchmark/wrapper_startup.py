@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" Measures the overhead of the compiler wrappers per compiler call.
+
+The real compiler is replaced by the `true` command, so the measured time
+is the time of the wrapper itself. The wrappers are compared with the bare
+interpreter start, and with the import of the whole package (which was the
+cost of the wrappers before they had their own module). The daemon mode
+wrapper script is measured without the server (it falls back to the trace
+log file).
+
+Usage: python wrapper_startup.py [number of calls] """
+
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(os.path.dirname(this_dir))
+sys.path.insert(0, root_dir)
+
+from libscanbuild.daemon import install_clients  # noqa: E402
+
+WRAPPER = 'import sys; from libscanbuild.wrapper import {0} as wrapper; ' \
+          'sys.exit(wrapper())'
+
+
+def measure(command, environment, count):
+    started = time.time()
+    for _ in range(count):
+        subprocess.check_call(command, env=environment)
+    return (time.time() - started) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    target_dir = tempfile.mkdtemp()
+    try:
+        environment = dict(os.environ)
+        environment.update({
+            'PYTHONPATH': root_dir,
+            'INTERCEPT_BUILD': json.dumps({'verbose': 0,
+                                           'cc': ['true'],
+                                           'cxx': ['true']}),
+            'INTERCEPT_BUILD_TARGET_DIR': target_dir
+        })
+        arguments = ['-c', '-O2', '-o', 'main.o', 'main.c']
+        client, _ = install_clients(
+            target_dir, ('intercept-cc', 'intercept-c++'),
+            (['true'], ['true']), 'intercept',
+            os.path.join(target_dir, 'missing.sock'),
+            os.path.join(target_dir, 'execution.log'))
+        cases = [
+            ('compiler', ['true'] + arguments),
+            ('interpreter', [sys.executable, '-c', 'pass']),
+            ('package import', [sys.executable, '-c',
+                                'import libscanbuild.analyze, '
+                                'libscanbuild.intercept']),
+            ('intercept wrapper', [sys.executable, '-c',
+                                   WRAPPER.format(
+                                       'intercept_compiler_wrapper')] +
+             arguments),
+            ('analyze wrapper', [sys.executable, '-c',
+                                 WRAPPER.format('analyze_compiler_wrapper')] +
+             arguments),
+            ('daemon wrapper', [client] + arguments)
+        ]
+        print('{0:>20} {1:>14}'.format('case', 'ms/call'))
+        for name, command in cases:
+            elapsed = measure(command, environment, count)
+            print('{0:>20} {1:>14.1f}'.format(name, elapsed * 1000))
+    finally:
+        shutil.rmtree(target_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 
 # RUN: bash %s %T/runs_analyzer
 # RUN: cd %T/runs_analyzer; %{scan-build} -o . --intercept-first ./run.sh | ./check.sh
+# RUN: cd %T/runs_analyzer; %{scan-build} -o . --intercept-first --pipelined ./run.sh | ./check.sh
 # RUN: cd %T/runs_analyzer; %{scan-build} -o . --intercept-first  --override-compiler ./run.sh | ./check.sh
 # RUN: cd %T/runs_analyzer; %{scan-build} -o . --override-compiler ./run.sh | ./check.sh
 
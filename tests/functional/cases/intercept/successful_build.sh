@@ -8,6 +8,25 @@
 #
 # RUN: cd %T/successful_build; %{intercept-build} --cdb preload.json ./run.sh
 # RUN: cd %T/successful_build; cdb_diff preload.json expected.json
+#
+# the same with the single trace log file transport
+#
+# RUN: cd %T/successful_build; %{intercept-build} --cdb wrapper_log.json --transport log --override-compiler ./run.sh
+# RUN: cd %T/successful_build; cdb_diff wrapper_log.json expected.json
+# RUN: cd %T/successful_build; %{intercept-build} --cdb preload_log.json --transport log ./run.sh
+# RUN: cd %T/successful_build; cdb_diff preload_log.json expected.json
+#
+# the same with the collector transport
+#
+# RUN: cd %T/successful_build; %{intercept-build} --cdb wrapper_socket.json --transport socket --override-compiler ./run.sh
+# RUN: cd %T/successful_build; cdb_diff wrapper_socket.json expected.json
+# RUN: cd %T/successful_build; %{intercept-build} --cdb preload_socket.json --transport socket ./run.sh
+# RUN: cd %T/successful_build; cdb_diff preload_socket.json expected.json
+#
+# the same with the memory mapped arena transport
+#
+# RUN: cd %T/successful_build; %{intercept-build} --cdb preload_arena.json --transport arena ./run.sh
+# RUN: cd %T/successful_build; cdb_diff preload_arena.json expected.json
 
 set -o errexit
 set -o nounset
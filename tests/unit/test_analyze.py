@@ -8,11 +8,14 @@
 
 import libear
 import libscanbuild.analyze as sut
+from libscanbuild.arguments import create_analyze_parser
 import unittest
 import os
 import os.path
 import glob
 import platform
+import subprocess
+import threading
 
 IS_WINDOWS = os.getenv('windows')
 
@@ -341,5 +344,116 @@ class ReportDirectoryTest(unittest.TestCase):
             self.assertLess(report_dir2, report_dir3)
 
 
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class AnalyzerServerTest(unittest.TestCase):
+
+    def test_compilations_are_submitted(self):
+        parser = create_analyze_parser(True)
+        args = parser.parse_args(['--daemon', '--use-cc', 'true', 'make'])
+        submitted = []
+
+        def submit(compilation, environment):
+            submitted.append((compilation, environment))
+
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'a.c')
+            open(source, 'w').close()
+            with sut.analyzer_server(args, submit) as environment:
+                for command in [['-c', '-DX', 'a.c'], ['-o', 'a', 'a.o']]:
+                    self.assertEqual(0, subprocess.call(
+                        [environment['CC']] + command, cwd=tmp_dir,
+                        env=environment))
+        self.assertEqual(1, len(submitted))
+        compilation, build_environment = submitted[0]
+        self.assertEqual(source, compilation.source)
+        self.assertEqual(['-DX'], list(compilation.flags))
+        self.assertEqual(environment['CC'], build_environment['CC'])
+
+
+def failing_run(opts):
+    raise AssertionError('analyzer failed')
+
+
+def passing_run(opts):
+    return {'error_output': [], 'exit_code': 0}
+
+
+def failing_output(opts):
+    raise RuntimeError('interrupted')
+
+
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class AnalyzerPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = create_analyze_parser(True).parse_args(
+            ['--jobs', '2', 'make'])
+        # the jobserver has no tokens, only the implicit slot can be used
+        self.read_fd, self.write_fd = os.pipe()
+        self.original_flags = os.environ.get('MAKEFLAGS')
+        os.environ['MAKEFLAGS'] = ' -j2 --jobserver-auth={0},{1}'.format(
+            self.read_fd, self.write_fd)
+        self.original_run = sut.run
+        self.original_output = sut.logging_analyzer_output
+
+    def tearDown(self):
+        sut.run = self.original_run
+        sut.logging_analyzer_output = self.original_output
+        if self.original_flags is None:
+            del os.environ['MAKEFLAGS']
+        else:
+            os.environ['MAKEFLAGS'] = self.original_flags
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def run_in_thread(self, target):
+        errors = []
+
+        def guarded():
+            try:
+                target()
+            except Exception as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=guarded)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        return errors
+
+    def test_failed_runs_give_back_the_job_slot(self):
+        sut.run = failing_run
+        with libear.temporary_directory() as tmp_dir:
+            self.args.output = tmp_dir
+            compilation = sut.Compilation(
+                'c', ['-DX'], os.path.join(tmp_dir, 'a.c'), tmp_dir)
+
+            def pipeline():
+                with sut.analyzer_pipeline(self.args) as submit:
+                    for _ in range(3):
+                        submit(compilation)
+
+            self.assertEqual([], self.run_in_thread(pipeline))
+
+    def test_interrupted_analysis_gives_back_the_tokens(self):
+        os.write(self.write_fd, b'+')
+        sut.run = passing_run
+        sut.logging_analyzer_output = failing_output
+        with libear.temporary_directory() as tmp_dir:
+            self.args.output = tmp_dir
+            compilations = [
+                sut.Compilation('c', ['-DX={0}'.format(index)],
+                                os.path.join(tmp_dir, 'a.c'), tmp_dir)
+                for index in range(10)]
+
+            errors = self.run_in_thread(
+                lambda: sut.run_analyzer_parallel(compilations, self.args))
+            self.assertEqual(1, len(errors))
+            self.assertIsInstance(errors[0], RuntimeError)
+        # the token is in the jobserver again
+        self.assertEqual(b'+', os.read(self.read_fd, 1))
+
+
 if __name__ == '__main__':
     unittest.main()
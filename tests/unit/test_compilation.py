@@ -6,7 +6,13 @@
 #
 # RUN: %{python} %s
 
+import libear
 import libscanbuild.compilation as sut
+import fnmatch
+import io
+import json
+import os
+import threading
 import unittest
 
 
@@ -90,6 +96,48 @@ class CompilerTest(unittest.TestCase):
         self.assert_cxx_compiler(['./nope++'], cxx='nope++')
         self.assert_cxx_compiler(['/path/nope++'], cxx='nope++')
 
+    def test_compiler_language(self):
+        def language(name):
+            return sut.compiler_language(name, 'nope', 'nope++')
+
+        self.assertEqual('wrapper', language('ccache'))
+        self.assertEqual('c', language('gcc-4.9'))
+        self.assertEqual('c++', language('x86_64-linux-gnu-g++'))
+        self.assertEqual('c++', language('nope++'))
+        self.assertIsNone(language('ld'))
+        # memoized decision is the same
+        self.assertIsNone(language('ld'))
+        self.assertEqual('c', sut.compiler_language('ld', 'ld', 'nope++'))
+
+    def test_user_compiler_patterns(self):
+        try:
+            sut.register_compiler_patterns(['arm-*-wrap'], ['xt*plus'])
+            self.assertEqual(['c', 'c++'],
+                             [sut.compiler_language(name, 'cc', 'c++')
+                              for name in ['arm-none-eabi-wrap', 'xtplus']])
+            self.assertIn('arm-*-wrap', sut.compiler_globs('cc', 'c++'))
+        finally:
+            sut.register_compiler_patterns([], [])
+        self.assertIsNone(
+            sut.compiler_language('arm-none-eabi-wrap', 'cc', 'c++'))
+
+    def test_compiler_globs_cover_compilers(self):
+        globs = sut.compiler_globs('nope', 'nope++')
+        names = ['cc', 'CC', 'c++', 'cxx', 'clang', 'clang-3.6', 'clang++',
+                 'clang++-3.5.1', 'gcc', 'g++', 'gcc-4.9', 'g++-6',
+                 'icc', 'icpc', 'xlc', 'xlc++', 'xlC', 'gxlc', 'gxlc++',
+                 'mpicc', 'mpiCC', 'mpicxx', 'mpic++', 'distcc', 'ccache',
+                 'armv7_neno-linux-gnueabi-g++', 'x86_64-linux-gnu-gcc-7',
+                 'nope', 'nope++']
+        for name in names:
+            self.assertIsNotNone(
+                sut.Compilation._split_compiler([name], 'nope', 'nope++'))
+            self.assertTrue(any(fnmatch.fnmatchcase(name, glob)
+                                for glob in globs), name)
+        for name in ['ld', 'as', 'sh', 'make', 'sed', 'ar']:
+            self.assertFalse(any(fnmatch.fnmatchcase(name, glob)
+                                 for glob in globs), name)
+
     def assert_arguments_equal(self, expected, command):
         value = sut.Compilation._split_compiler(command, 'nope', 'nope')
         self.assertIsNotNone(value)
@@ -212,5 +260,385 @@ class SourceClassifierTest(unittest.TestCase):
         self.assert_c_source('/file.c', True)
         self.assert_c_source('./file.c', True)
 
+
+class ArgumentTableTest(unittest.TestCase):
+    def test_classify(self):
+        table = sut.ArgumentTable(
+            exact={'-o': (sut.SKIP, 1), '-E': (sut.STOP, 0)},
+            prefixes=[('-W', (sut.SKIP, 0)), ('-Wno-', (sut.KEEP, 0))],
+            default=sut.KEEP,
+            positional=sut.SOURCE)
+        self.assertEqual((sut.SKIP, 1), table.classify('-o'))
+        self.assertEqual((sut.STOP, 0), table.classify('-E'))
+        self.assertEqual((sut.SKIP, 0), table.classify('-Wall'))
+        self.assertEqual((sut.KEEP, 0), table.classify('-Wno-error'))
+        # the argument shall be longer than the prefix
+        self.assertEqual((sut.KEEP, 0), table.classify('-W'))
+        self.assertEqual((sut.SKIP, 0), table.classify('-Wno-'))
+        self.assertEqual((sut.KEEP, 0), table.classify('-O2'))
+        self.assertEqual((sut.SOURCE, 0), table.classify('main.c'))
+        self.assertEqual((sut.SOURCE, 0), table.classify(''))
+
+
+class CompilationTest(unittest.TestCase):
+    def test_equal_values_are_shared(self):
+        one = sut.Compilation('c', ['-DX'], 'a.c', '/src/./')
+        two = sut.Compilation('c', ['-DX'], 'b.c', '/src')
+        self.assertIs(one.flags, two.flags)
+        self.assertIs(one.directory, two.directory)
+
+    def test_pickle_round_trip(self):
+        import pickle
+        entry = sut.Compilation('c++', ['-DX', '-O2'], 'a.cpp', '/src')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(entry, protocol))
+            self.assertEqual(entry, copy)
+            self.assertFalse(entry != copy)
+            self.assertEqual(entry.to_db(), copy.to_db())
+            self.assertIs(entry.flags, copy.flags)
+
+    def test_shared_values_are_limited(self):
+        for index in range(sut.INTERNED_VALUES_LIMIT + 10):
+            sut.Compilation('c', ['-DX={0}'.format(index)], 'a.c', '/src')
+        self.assertEqual(sut.INTERNED_VALUES_LIMIT, len(sut.INTERNED_VALUES))
+        # the recently used values are still shared
+        one = sut.Compilation('c', ['-DX=1'], 'a.c', '/src')
+        two = sut.Compilation('c', ['-DX=1'], 'b.c', '/src')
+        self.assertIs(one.flags, two.flags)
+
+    def test_to_analyzer(self):
+        entry = sut.Compilation('c', ['-DX'], 'a.c', '/src')
+        self.assertEqual({'compiler': 'c',
+                          'flags': ['-DX'],
+                          'source': '/src/a.c',
+                          'directory': '/src'}, entry.to_analyzer())
+
+
+class CompilationDatabaseTest(unittest.TestCase):
+    entries = [
+        sut.Compilation('c', ['-DX="a b"', '-O2'], 'a.c', '/src'),
+        sut.Compilation('c++', ["-Dv='q'"], 'b.cpp', '/src/sub')
+    ]
+
+    def test_same_as_json_dump(self):
+        with libear.temporary_directory() as tmp_dir:
+            for entries in [[], self.entries]:
+                filename = os.path.join(tmp_dir, 'compile_commands.json')
+                sut.CompilationDatabase.save(filename, iter(entries))
+                with open(filename, 'r') as handle:
+                    content = handle.read()
+                expected = json.dumps([entry.to_db() for entry in entries],
+                                      sort_keys=True, indent=4,
+                                      separators=(',', ': '))
+                self.assertEqual(expected, content)
+                self.assertEqual(['compile_commands.json'],
+                                 os.listdir(tmp_dir))
+
+    def test_compact_and_command_round_trip(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            os.mkdir(os.path.join(tmp_dir, 'sub'))
+            entries = [
+                sut.Compilation('c', ['-DX="a b"', '-O2'], 'a.c', tmp_dir),
+                sut.Compilation('c++', ["-Dv='q'"], 'sub/b.cpp', tmp_dir)
+            ]
+            for entry in entries:
+                open(entry.source, 'w').close()
+            for compact in [True, False]:
+                for command in [True, False]:
+                    sut.CompilationDatabase.save(filename, iter(entries),
+                                                 compact, command)
+                    with open(filename, 'r') as handle:
+                        content = json.load(handle)
+                    self.assertEqual(command, 'command' in content[0])
+                    self.assertEqual(
+                        entries,
+                        [sut.Compilation.from_db(entry) for entry in content])
+                    with open(filename, 'r') as handle:
+                        lines = handle.readlines()
+                    if compact:
+                        self.assertEqual(len(entries) + 2, len(lines))
+                    self.assertEqual(
+                        entries,
+                        list(sut.CompilationDatabase.load(filename)))
+
+    def test_parallel_load(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            entries = []
+            for index in range(50):
+                source = os.path.join(tmp_dir, 'f{0}.c'.format(index % 7))
+                open(source, 'w').close()
+                flags = ['-DX={0}'.format(index), '-DY="a b"']
+                entries.append(sut.Compilation('c', flags, source, tmp_dir))
+            sut.CompilationDatabase.save(filename, iter(entries),
+                                         command=True)
+            batch_size = sut.LOAD_BATCH_SIZE
+            sut.LOAD_BATCH_SIZE = 4
+            try:
+                result = list(sut.CompilationDatabase.load(filename, 3))
+            finally:
+                sut.LOAD_BATCH_SIZE = batch_size
+            self.assertEqual(entries, result)
+
+    def test_sqlite_database(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.sqlite')
+            entries = [
+                sut.Compilation('c', ['-DX="a b"'], 'a.c', tmp_dir),
+                sut.Compilation('c', ['-O2'], 'a.c', tmp_dir),
+                sut.Compilation('c++', ['-O2'], 'sub/b.cpp', tmp_dir)
+            ]
+            sut.CompilationDatabase.save(filename, iter(entries[:2]))
+            self.assertEqual(['compile_commands.sqlite'],
+                             os.listdir(tmp_dir))
+            self.assertEqual(entries[:2],
+                             list(sut.CompilationDatabase.load(filename)))
+            # only the new entries are added
+            self.assertEqual(
+                1, sut.CompilationDatabase.upsert(filename, iter(entries)))
+            self.assertEqual(entries,
+                             list(sut.CompilationDatabase.load(filename)))
+            self.assertEqual(
+                entries[:2],
+                list(sut.CompilationDatabase.find(
+                    filename, os.path.join(tmp_dir, 'a.c'))))
+            self.assertEqual(
+                [entry.to_db() for entry in entries],
+                list(sut.CompilationDatabase.entries(filename)))
+
+    def test_find_in_json_database(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            entries = [
+                sut.Compilation('c', ['-O2'], 'a.c', tmp_dir),
+                sut.Compilation('c', ['-O2'], 'b.c', tmp_dir)
+            ]
+            for entry in entries:
+                open(entry.source, 'w').close()
+            sut.CompilationDatabase.save(filename, iter(entries))
+            self.assertEqual(
+                entries[1:],
+                list(sut.CompilationDatabase.find(
+                    filename, os.path.join(tmp_dir, 'b.c'))))
+            self.assertEqual(
+                [],
+                list(sut.CompilationDatabase.find(
+                    filename, os.path.join(tmp_dir, 'c.c'))))
+
+
+class MergeTest(unittest.TestCase):
+    @staticmethod
+    def entries(tmp_dir):
+        for name in ['a.c', 'b.c']:
+            open(os.path.join(tmp_dir, name), 'w').close()
+        return [
+            sut.Compilation('c', ['-O1'], 'a.c', tmp_dir),
+            sut.Compilation('c', ['-O2'], 'a.c', tmp_dir),
+            sut.Compilation('c', ['-O1'], 'b.c', tmp_dir)
+        ]
+
+    def test_merge(self):
+        for name in ['compile_commands.json', 'compile_commands.sqlite']:
+            with libear.temporary_directory() as tmp_dir:
+                filename = os.path.join(tmp_dir, name)
+                one, two, three = self.entries(tmp_dir)
+                load = sut.CompilationDatabase.load
+                merge = sut.CompilationDatabase.merge
+                self.assertTrue(merge(filename, iter([one])))
+                self.assertTrue(merge(filename, iter([three, one])))
+                self.assertEqual([one, three], list(load(filename)))
+                # nothing is written when there is nothing new
+                self.assertFalse(merge(filename, iter([three])))
+                self.assertTrue(merge(filename, iter([two])))
+                self.assertEqual([one, three, two], list(load(filename)))
+                # the other variants of the source are removed
+                self.assertTrue(merge(filename, iter([one]), replace=True))
+                self.assertEqual([one, three], list(load(filename)))
+                self.assertFalse(merge(filename, iter([one]), replace=True))
+
+    def test_merge_appends_in_place(self):
+        for compact in [False, True]:
+            with libear.temporary_directory() as tmp_dir:
+                filename = os.path.join(tmp_dir, 'compile_commands.json')
+                expected = os.path.join(tmp_dir, 'expected.json')
+                one, two, three = self.entries(tmp_dir)
+                sut.CompilationDatabase.save(filename, iter([]), compact)
+                inode = os.stat(filename).st_ino
+                merge = sut.CompilationDatabase.merge
+                self.assertTrue(merge(filename, iter([one]), False, compact))
+                self.assertTrue(
+                    merge(filename, iter([two, one, three]), False, compact))
+                self.assertEqual(inode, os.stat(filename).st_ino)
+                # the result is the same as the whole file was written
+                sut.CompilationDatabase.save(expected, iter([one, two, three]),
+                                             compact)
+                with open(filename) as result, open(expected) as handle:
+                    self.assertEqual(handle.read(), result.read())
+
+    def test_merge_from_store(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            one, two, three = self.entries(tmp_dir)
+            sut.CompilationDatabase.save(filename, iter([one]))
+            # the entries are moved to the disk after the first one
+            store = sut.CompilationStore(limit=1)
+            for entry in [two, one, three]:
+                store.add(entry)
+            self.assertTrue(sut.CompilationDatabase.merge(filename, store))
+            self.assertEqual([one, two, three],
+                             list(sut.CompilationDatabase.load(filename)))
+            self.assertFalse(sut.CompilationDatabase.merge(filename, store))
+            self.assertEqual([], [name for name in os.listdir(tmp_dir)
+                                  if name.endswith('.tmp')])
+
+    def test_merge_waits_for_the_lock(self):
+        if sut.fcntl is None:
+            self.skipTest('no file locking on this platform')
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            entries = self.entries(tmp_dir)
+            sut.CompilationDatabase.save(filename, iter(entries[:1]))
+            with sut.database_lock(filename):
+                thread = threading.Thread(
+                    target=sut.CompilationDatabase.merge,
+                    args=(filename, iter(entries[1:])))
+                thread.start()
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive())
+                self.assertEqual(entries[:1],
+                                 list(sut.CompilationDatabase.load(filename)))
+            thread.join()
+            self.assertEqual(entries,
+                             list(sut.CompilationDatabase.load(filename)))
+
+
+class IndexTest(unittest.TestCase):
+    def assert_lookup(self, ensure_ascii):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            sources = [os.path.join(tmp_dir, name)
+                       for name in [u'a.c', u'\u00e1.c', u'b.c']]
+            entries = [{'directory': tmp_dir,
+                        'file': os.path.basename(source),
+                        'arguments': ['cc', '-DX={0}'.format(index), source]}
+                       for index, source in enumerate(sources * 3)]
+            with io.open(filename, 'w', encoding='utf-8') as handle:
+                handle.write(u'' + json.dumps(entries, indent=2,
+                                              ensure_ascii=ensure_ascii))
+            # the index is created at the first lookup
+            self.assertIsNone(sut.index_spans(filename, sources[0]))
+            for source in sources:
+                expected = [entry for entry in entries
+                            if entry['file'] == os.path.basename(source)]
+                self.assertEqual(expected,
+                                 sut.index_lookup(filename, source))
+            self.assertEqual(
+                [], sut.index_lookup(filename, os.path.join(tmp_dir, 'c.c')))
+            self.assertTrue(os.path.exists(sut.index_file_name(filename)))
+            self.assertEqual(3, len(sut.index_spans(filename, sources[1])))
+
+    def test_lookup(self):
+        self.assert_lookup(ensure_ascii=False)
+
+    def test_lookup_with_escaped_names(self):
+        self.assert_lookup(ensure_ascii=True)
+
+    def test_outdated_index(self):
+        with libear.temporary_directory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'compile_commands.json')
+            source = os.path.join(tmp_dir, 'a.c')
+            entry = {'directory': tmp_dir, 'file': 'a.c',
+                     'arguments': ['cc', '-c', 'a.c']}
+            with open(filename, 'w') as handle:
+                json.dump([entry], handle)
+            sut.build_index(filename)
+            self.assertEqual(1, len(sut.index_spans(filename, source)))
+            with open(filename, 'w') as handle:
+                json.dump([entry, entry], handle)
+            self.assertIsNone(sut.index_spans(filename, source))
+            self.assertEqual([entry, entry],
+                             sut.index_lookup(filename, source))
+
+
+class SourceFilesTest(unittest.TestCase):
+    def test_exists(self):
+        with libear.temporary_directory() as tmp_dir:
+            os.mkdir(os.path.join(tmp_dir, 'sub'))
+            open(os.path.join(tmp_dir, 'a.c'), 'w').close()
+            files = sut.SourceFiles()
+            self.assertFalse(files.exists(os.path.join(tmp_dir, 'b.c')))
+            self.assertTrue(files.exists(os.path.join(tmp_dir, 'a.c')))
+            self.assertFalse(files.exists(os.path.join(tmp_dir, 'sub')))
+            self.assertFalse(
+                files.exists(os.path.join(tmp_dir, 'missing', 'a.c')))
+            # files created after the directory was listed
+            open(os.path.join(tmp_dir, 'b.c'), 'w').close()
+            self.assertTrue(files.exists(os.path.join(tmp_dir, 'b.c')))
+
+
+class JsonArrayItemsTest(unittest.TestCase):
+    @staticmethod
+    def items(content, chunk_size):
+        handle = io.StringIO(u'' + content)
+        return list(sut.json_array_items(handle, chunk_size))
+
+    def test_same_as_json_load(self):
+        documents = [
+            '[]',
+            ' [ ] ',
+            '[{"a": "b"}]',
+            '[\n  {"a": "]}", "b": [1, 2]},\n  {"c": "\\"x\\""}\n]\n',
+            '[12345, 1.5e10, "s", true, null, [], {}]',
+            '[{"a": "\u00e1rv\u00edz"},{"b":{"c":{"d":[]}}}]',
+        ]
+        for content in documents:
+            for chunk_size in [1, 2, 3, 7, 64 * 1024]:
+                self.assertEqual(json.loads(content),
+                                 self.items(content, chunk_size))
+
+    def test_yields_before_the_end(self):
+        handle = io.StringIO(u'[{"a": 1}, {"b": 2}, ')
+        items = sut.json_array_items(handle, 4)
+        self.assertEqual({'a': 1}, next(items))
+        self.assertEqual({'b': 2}, next(items))
+        self.assertRaises(ValueError, next, items)
+
+    def test_malformed(self):
+        for content in ['', '{}', '[1 2]', '[{"a": }]', '[1,', '[{"a"']:
+            for chunk_size in [1, 5, 64 * 1024]:
+                self.assertRaises(ValueError, self.items, content, chunk_size)
+
+
+class CompilationStoreTest(unittest.TestCase):
+    @staticmethod
+    def compilation(index):
+        return sut.Compilation(compiler='c',
+                               flags=['-DX={0}'.format(index)],
+                               source='/src/file.c',
+                               directory='/src')
+
+    def test_keeps_unique_entries(self):
+        store = sut.CompilationStore(limit=100)
+        self.assertTrue(store.add(self.compilation(1)))
+        self.assertTrue(store.add(self.compilation(2)))
+        self.assertFalse(store.add(self.compilation(1)))
+        self.assertEqual(2, len(store))
+        self.assertEqual({self.compilation(1), self.compilation(2)},
+                         set(store))
+
+    @unittest.skipIf(sut.sqlite3 is None, 'sqlite3 is not available')
+    def test_spills_to_disk(self):
+        store = sut.CompilationStore(limit=3)
+        for index in range(10):
+            self.assertTrue(store.add(self.compilation(index)))
+        for index in range(10):
+            self.assertFalse(store.add(self.compilation(index)))
+        self.assertIsNotNone(store.database)
+        self.assertEqual(10, len(store))
+        expected = set(self.compilation(index) for index in range(10))
+        self.assertEqual(expected, set(store))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+#
+# RUN: %{python} %s
+
+import json
+import os
+import os.path
+import subprocess
+import unittest
+
+import libear
+import libscanbuild.daemon as sut
+
+IS_WINDOWS = os.getenv('windows')
+
+
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class DaemonTest(unittest.TestCase):
+    # the compiler fails with a specific exit code
+    failing = ['sh', '-c', 'exit 3', 'sh']
+    passing = ['sh', '-c', 'exit 0', 'sh']
+
+    def install(self, tmp_dir, compiler, mode, address, fallback=None):
+        return sut.install_clients(tmp_dir, ('x-cc', 'x-c++'),
+                                   (compiler, compiler), mode, address,
+                                   fallback)
+
+    def test_install_clients(self):
+        with libear.temporary_directory() as tmp_dir:
+            cc, cxx = self.install(tmp_dir, self.failing, 'analyze', None)
+            self.assertEqual('x-cc', os.path.basename(cc))
+            self.assertEqual('x-c++', os.path.basename(cxx))
+            self.assertTrue(os.access(cc, os.X_OK))
+            self.assertEqual(3, subprocess.call([cc, '-c', 'a.c']))
+
+    def test_intercept_client_falls_back_to_log(self):
+        with libear.temporary_directory() as tmp_dir:
+            address = os.path.join(tmp_dir, 'missing.sock')
+            log_file = os.path.join(tmp_dir, 'execution.log')
+            _, cxx = self.install(tmp_dir, self.failing, 'intercept',
+                                  address, log_file)
+            self.assertEqual(3, subprocess.call([cxx, '-c', 'a.cpp']))
+            with open(log_file, 'r') as handle:
+                report = json.loads(handle.readline())
+            self.assertEqual(['c++', '-c', 'a.cpp'], report['cmd'])
+
+    def test_server_receives_successful_compilations(self):
+        with libear.temporary_directory() as tmp_dir:
+            requests = []
+            address = os.path.join(tmp_dir, sut.SERVER_SOCKET_FILE)
+            server = sut.Server(address, requests.append)
+            server.start()
+            try:
+                cc, _ = self.install(tmp_dir, self.passing, 'analyze',
+                                     address)
+                self.assertEqual(0, subprocess.call([cc, '-c', 'a.c']))
+                # the client waits for the request to be served
+                self.assertEqual(1, len(requests))
+                self.assertEqual(['cc', '-c', 'a.c'], requests[0]['cmd'])
+                self.assertEqual(os.getcwd(), requests[0]['cwd'])
+                self.assertIn('PATH', requests[0]['environment'])
+
+                cc, _ = self.install(tmp_dir, self.failing, 'analyze',
+                                     address)
+                self.assertEqual(3, subprocess.call([cc, '-c', 'a.c']))
+            finally:
+                server.stop()
+            self.assertEqual(1, len(requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,17 +6,33 @@
 #
 # RUN: %{python} %s
 
+import multiprocessing
 import os
 import os.path
+import socket
+import threading
 import unittest
 
 import libear
 import libscanbuild.intercept as sut
 from libscanbuild import Execution
+from libscanbuild.wrapper import write_exec_trace, append_exec_trace, \
+    send_exec_trace
 
 IS_WINDOWS = os.getenv('windows')
 
 
+def arena_record(execution, state=sut.ARENA_COMMITTED):
+    """ Creates an arena record (the same way as ear.c writes it). """
+
+    payload = '\0'.join([execution.cwd] + execution.cmd) + '\0'
+    payload = payload.encode('utf-8')
+    size = (sut.ARENA_RECORD.size + len(payload) + 7) & ~7
+    header = sut.ARENA_RECORD.pack(size, state, execution.pid,
+                                   len(execution.cmd), len(payload), 0)
+    return (header + payload).ljust(size, b'\0')
+
+
 class InterceptUtilTest(unittest.TestCase):
 
     def test_read_write_exec_trace(self):
@@ -26,10 +42,263 @@ class InterceptUtilTest(unittest.TestCase):
             cmd=['cc', '-c', 'this.c'])
         with libear.temporary_directory() as tmp_dir:
             temp_file = os.path.join(tmp_dir, 'single_report.cmd')
-            sut.write_exec_trace(temp_file, input_one)
+            write_exec_trace(temp_file, input_one)
             result = sut.parse_exec_trace(temp_file)
             self.assertEqual(input_one, result)
 
+    def test_append_parse_exec_log(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        input_two = Execution(
+            pid=456,
+            cwd='/path/to/there',
+            cmd=['c++', '-c', 'that with space.cpp', '-Dv="quoted"'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            append_exec_trace(temp_file, input_one)
+            append_exec_trace(temp_file, input_two)
+            result = list(sut.parse_exec_log(temp_file))
+            self.assertEqual([input_one, input_two], result)
+
+    def test_parse_exec_log_skips_broken_record(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            append_exec_trace(temp_file, input_one)
+            with open(temp_file, 'a') as handle:
+                handle.write('{ "pid": 42, "cmd": ["cc", "-')
+            result = list(sut.parse_exec_log(temp_file))
+            self.assertEqual([input_one], result)
+
+    def test_exec_traces_reads_log_and_files(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        input_two = Execution(
+            pid=456,
+            cwd='/path/to/there',
+            cmd=['cc', '-c', 'that.c'])
+        with libear.temporary_directory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            append_exec_trace(log_file, input_one)
+            trace_file = os.path.join(tmp_dir, '456_0.json')
+            write_exec_trace(trace_file, input_two)
+            result = list(sut.exec_traces(tmp_dir))
+            self.assertEqual([input_one, input_two], result)
+
+    def test_exec_trace_files_finds_nested_files(self):
+        with libear.temporary_directory() as tmp_dir:
+            expected = set()
+            for shard in [['a', 'b'], ['a', 'c'], ['d']]:
+                shard_dir = os.path.join(tmp_dir, *shard)
+                os.makedirs(shard_dir)
+                trace_file = os.path.join(shard_dir, '1_0.json')
+                open(trace_file, 'w').close()
+                expected.add(trace_file)
+            open(os.path.join(tmp_dir, sut.TRACE_LOG_FILE), 'w').close()
+            self.assertEqual(expected, set(sut.exec_trace_files(tmp_dir)))
+
+    def test_log_reader_waits_for_complete_line(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        with libear.temporary_directory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            reader = sut.ExecLogReader(log_file)
+            self.assertEqual([], list(reader.read(final=False)))
+            append_exec_trace(log_file, input_one)
+            with open(log_file, 'a') as handle:
+                handle.write('{"pid": 456, "cwd": "/pa')
+            self.assertEqual([input_one], list(reader.read(final=False)))
+            self.assertEqual([], list(reader.read(final=False)))
+            with open(log_file, 'a') as handle:
+                handle.write('th/to/there", "cmd": ["cc"]}\n')
+            result = list(reader.read(final=False))
+            self.assertEqual([456], [entry.pid for entry in result])
+
+    def test_trace_reader_retries_incomplete_files(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        with libear.temporary_directory() as tmp_dir:
+            reader = sut.TraceReader(tmp_dir, remove=True)
+            trace_file = os.path.join(tmp_dir, '123_0.json')
+            with open(trace_file, 'w') as handle:
+                handle.write('{"pid": 123, ')
+            self.assertEqual([], list(reader.read(final=False)))
+            write_exec_trace(trace_file, input_one)
+            self.assertEqual([input_one], list(reader.read(final=False)))
+            self.assertFalse(os.path.exists(trace_file))
+            self.assertEqual([], list(reader.read(final=True)))
+
+    def test_classifier_notifies_about_new_entries(self):
+        notified = []
+        with libear.temporary_directory() as tmp_dir:
+            open(os.path.join(tmp_dir, 'this.c'), 'w').close()
+            open(os.path.join(tmp_dir, 'that.c'), 'w').close()
+            classifier = sut.Classifier('cc', 'c++', notified.append)
+            calls = [['cc', '-c', 'this.c'],
+                     ['cc', '-c', 'that.c'],
+                     ['cc', '-c', 'this.c']]
+            count = classifier.feed(
+                Execution(pid=1, cwd=tmp_dir, cmd=call) for call in calls)
+            self.assertEqual(2, count)
+            self.assertEqual(set(list(classifier.entries)), set(notified))
+            self.assertEqual(2, len(notified))
+
+    def test_classifier_parses_trace_files_in_parallel(self):
+        with libear.temporary_directory() as tmp_dir:
+            open(os.path.join(tmp_dir, 'this.c'), 'w').close()
+            execution = Execution(pid=1, cwd=tmp_dir,
+                                  cmd=['cc', '-c', 'this.c'])
+            trace_files = []
+            for index in range(3):
+                trace_file = os.path.join(tmp_dir, '1_{0}.json'.format(index))
+                write_exec_trace(trace_file, execution)
+                trace_files.append(trace_file)
+            broken_file = os.path.join(tmp_dir, '2_0.json')
+            with open(broken_file, 'w') as handle:
+                handle.write('{"pid": ')
+            trace_files.append(broken_file)
+
+            classifier = sut.Classifier('cc', 'c++')
+            pool = multiprocessing.Pool(2)
+            try:
+                done = classifier.feed_trace_files(pool, trace_files,
+                                                   final=False)
+                self.assertEqual(sorted(trace_files[:3]), sorted(done))
+                self.assertEqual(1, len(list(classifier.entries)))
+                done = classifier.feed_trace_files(pool, trace_files,
+                                                   final=True)
+                self.assertEqual(sorted(trace_files), sorted(done))
+                self.assertEqual(1, len(list(classifier.entries)))
+            finally:
+                pool.close()
+                pool.join()
+
+    def test_consumer_reads_and_flushes(self):
+        flushed = []
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'this.c')
+            open(source, 'w').close()
+            log_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            classifier = sut.Classifier('cc', 'c++')
+            consumer = sut.Consumer(sut.TraceReader(tmp_dir), classifier,
+                                    flushed.append, 1)
+            consumer.start()
+            for call in [['cc', '-c', 'this.c'], ['cc', '-c', 'this.c']]:
+                execution = Execution(pid=1, cwd=tmp_dir, cmd=call)
+                append_exec_trace(log_file, execution)
+            consumer.stop()
+            self.assertEqual(1, len(list(classifier.entries)))
+            # flush only when there is something new
+            consumer._flush()
+            consumer._flush()
+            self.assertEqual(1, len(flushed))
+
+    def test_parse_exec_arena(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        input_two = Execution(
+            pid=456,
+            cwd='/path/to/there',
+            cmd=['c++', '-c', 'that with space.cpp', '-Dv="quoted"'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_ARENA_FILE)
+            sut.create_exec_arena(temp_file, 4096)
+            records = arena_record(input_one) + arena_record(input_two, 0) + \
+                arena_record(input_two)
+            with open(temp_file, 'r+b') as handle:
+                handle.seek(sut.ARENA_HEADER.size)
+                handle.write(records)
+                handle.seek(0)
+                handle.write(sut.ARENA_HEADER.pack(
+                    sut.ARENA_MAGIC, sut.ARENA_VERSION, 4096,
+                    sut.ARENA_HEADER.size + len(records)))
+            result = list(sut.parse_exec_arena(temp_file))
+            self.assertEqual([input_one, input_two], result)
+
+    def test_exec_arena_reader_revisits_uncommitted_records(self):
+        input_one = Execution(pid=1, cwd='/here', cmd=['cc', '-c', 'a.c'])
+        input_two = Execution(pid=2, cwd='/here', cmd=['cc', '-c', 'b.c'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_ARENA_FILE)
+            sut.create_exec_arena(temp_file, 4096)
+            first = arena_record(input_one, 0)
+            second = arena_record(input_two, sut.ARENA_COMMITTED)
+            with open(temp_file, 'r+b') as handle:
+                handle.seek(sut.ARENA_HEADER.size)
+                handle.write(first + second)
+            reader = sut.ExecArenaReader(temp_file)
+            # the uncommitted record does not hold back the next one
+            self.assertEqual([input_two], list(reader.read(final=False)))
+            with open(temp_file, 'r+b') as handle:
+                handle.seek(sut.ARENA_HEADER.size)
+                handle.write(arena_record(input_one, sut.ARENA_COMMITTED))
+            self.assertEqual([input_one], list(reader.read(final=False)))
+            self.assertEqual([], list(reader.read(final=True)))
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_collector_receives_executions(self):
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'this.c')
+            open(source, 'w').close()
+            address = os.path.join(tmp_dir, sut.TRACE_SOCKET_FILE)
+            classifier = sut.Classifier('cc', 'c++')
+            collector = sut.Collector(address, classifier)
+            collector.start()
+            try:
+                for call in [['cc', '-c', 'this.c'],
+                             ['cc', '-c', 'this.c'],
+                             ['ld', 'this.o']]:
+                    execution = Execution(pid=1, cwd=tmp_dir, cmd=call)
+                    self.assertTrue(send_exec_trace(address, execution))
+            finally:
+                collector.stop()
+            entries = list(classifier.entries)
+            self.assertEqual(1, len(entries))
+            self.assertEqual(source, entries[0].source)
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_collector_is_not_blocked_by_stalled_reporter(self):
+        with libear.temporary_directory() as tmp_dir:
+            open(os.path.join(tmp_dir, 'this.c'), 'w').close()
+            address = os.path.join(tmp_dir, sut.TRACE_SOCKET_FILE)
+            received = threading.Event()
+            classifier = sut.Classifier('cc', 'c++',
+                                        lambda entry: received.set())
+            collector = sut.Collector(address, classifier)
+            collector.start()
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                # this reporter neither finishes the report, nor closes
+                stalled.connect(address)
+                stalled.sendall(b'{"pid": ')
+                execution = Execution(pid=1, cwd=tmp_dir,
+                                      cmd=['cc', '-c', 'this.c'])
+                self.assertTrue(send_exec_trace(address, execution))
+                self.assertTrue(received.wait(5))
+            finally:
+                stalled.close()
+                collector.stop()
+            self.assertEqual(1, len(classifier.entries))
+
+    def test_send_exec_trace_without_collector(self):
+        with libear.temporary_directory() as tmp_dir:
+            address = os.path.join(tmp_dir, sut.TRACE_SOCKET_FILE)
+            execution = Execution(pid=1, cwd=tmp_dir, cmd=['cc', 'this.c'])
+            self.assertFalse(send_exec_trace(address, execution))
+
     @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
     def test_sip(self):
         def create_status_report(filename, message):
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+#
+# RUN: %{python} %s
+
+import errno
+import os
+import os.path
+import threading
+import unittest
+
+import libear
+import libscanbuild.jobserver as sut
+
+IS_WINDOWS = os.getenv('windows')
+
+
+class BrokenJobServer(object):
+    """ Fails to read tokens after it was broken. """
+
+    def __init__(self, jobserver):
+        self.jobserver = jobserver
+        self.broken = False
+
+    def try_acquire(self, timeout=0):
+        if self.broken:
+            raise OSError(errno.EBADF, 'broken')
+        return self.jobserver.try_acquire(timeout)
+
+    def release(self, token):
+        self.jobserver.release(token)
+
+
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class JobServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def makeflags(self, flags):
+        return {'MAKEFLAGS': flags.format(self.read_fd, self.write_fd)}
+
+    def test_not_announced(self):
+        self.assertIsNone(sut.JobServer.from_environment({}))
+        self.assertIsNone(sut.JobServer.from_environment(
+            {'MAKEFLAGS': 'k -j4'}))
+
+    def test_pipe(self):
+        for flags in [' -j4 --jobserver-auth={0},{1}',
+                      ' -j4 --jobserver-fds={0},{1}',
+                      ' --jobserver-fds=-1,-1 --jobserver-auth={0},{1}']:
+            jobserver = sut.JobServer.from_environment(self.makeflags(flags))
+            self.assertIsNotNone(jobserver)
+            try:
+                self.assertEqual(self.write_fd, jobserver.write_fd)
+                jobserver.release(b'+')
+                self.assertEqual(b'+', jobserver.try_acquire())
+            finally:
+                if jobserver.read_fd != self.read_fd:
+                    os.close(jobserver.read_fd)
+
+    @unittest.skipIf(not os.path.isdir('/proc/self/fd'), 'no /proc')
+    def test_pipe_is_read_in_non_blocking_mode(self):
+        import fcntl
+        flags = ' -j4 --jobserver-auth={0},{1}'
+        jobserver = sut.JobServer.from_environment(self.makeflags(flags))
+        try:
+            flags = fcntl.fcntl(jobserver.read_fd, fcntl.F_GETFL)
+            self.assertTrue(flags & os.O_NONBLOCK)
+            # the inherited file description is not changed
+            flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+            self.assertFalse(flags & os.O_NONBLOCK)
+        finally:
+            os.close(jobserver.read_fd)
+
+    def test_closed_pipe(self):
+        flags = ' -j4 --jobserver-auth=1023,1022'
+        self.assertIsNone(sut.JobServer.from_environment({'MAKEFLAGS': flags}))
+
+    def test_ends_of_different_pipes(self):
+        other_read_fd, other_write_fd = os.pipe()
+        try:
+            flags = ' -j4 --jobserver-auth={0},' + str(other_write_fd)
+            self.assertIsNone(
+                sut.JobServer.from_environment(self.makeflags(flags)))
+        finally:
+            os.close(other_read_fd)
+            os.close(other_write_fd)
+
+    def test_fifo(self):
+        with libear.temporary_directory() as tmp_dir:
+            fifo = os.path.join(tmp_dir, 'jobserver')
+            os.mkfifo(fifo)
+            flags = ' -j4 --jobserver-auth=fifo:' + fifo + \
+                ' --jobserver-fds={0},{1}'.format(self.read_fd, self.write_fd)
+            jobserver = sut.JobServer.from_environment({'MAKEFLAGS': flags})
+            self.assertIsNotNone(jobserver)
+            try:
+                # the named pipe is used instead of the file descriptors
+                self.assertEqual(jobserver.read_fd, jobserver.write_fd)
+                jobserver.release(b'+')
+                self.assertEqual(b'+', jobserver.acquire())
+                self.assertIsNone(jobserver.try_acquire())
+            finally:
+                os.close(jobserver.read_fd)
+
+    def test_tokens(self):
+        jobserver = sut.JobServer(self.read_fd, self.write_fd)
+        self.assertIsNone(jobserver.try_acquire())
+        jobserver.release(b'+')
+        self.assertEqual(b'+', jobserver.try_acquire())
+        self.assertIsNone(jobserver.try_acquire())
+
+    def test_limit_uses_the_implicit_slot_first(self):
+        jobserver = sut.JobServer(self.read_fd, self.write_fd)
+        jobserver.release(b'+')
+        limit = sut.JobLimit(jobserver)
+        limit.acquire()
+        limit.acquire()
+        # both the implicit slot and the token are taken
+        self.assertIsNone(jobserver.try_acquire())
+        limit.release()
+        limit.release()
+        # only the token is given back
+        self.assertEqual(b'+', jobserver.try_acquire())
+        self.assertIsNone(jobserver.try_acquire())
+
+    def test_limit_waits_for_the_implicit_slot(self):
+        jobserver = sut.JobServer(self.read_fd, self.write_fd)
+        limit = sut.JobLimit(jobserver)
+        limit.acquire()
+        thread = threading.Thread(target=limit.acquire)
+        thread.daemon = True
+        thread.start()
+        thread.join(0.3)
+        self.assertTrue(thread.is_alive())
+        # there is no token, but the implicit slot is free again
+        limit.release()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_limit_close_gives_back_the_tokens(self):
+        jobserver = sut.JobServer(self.read_fd, self.write_fd)
+        jobserver.release(b'+')
+        limit = sut.JobLimit(jobserver)
+        limit.acquire()
+        limit.acquire()
+        self.assertIsNone(jobserver.try_acquire())
+        limit.close()
+        self.assertEqual(b'+', jobserver.try_acquire())
+        # the jobs are not limited after it was closed
+        limit.acquire()
+        self.assertIsNone(jobserver.try_acquire())
+
+    def test_limit_gives_back_the_tokens_after_failure(self):
+        jobserver = BrokenJobServer(sut.JobServer(self.read_fd, self.write_fd))
+        jobserver.release(b'+')
+        limit = sut.JobLimit(jobserver)
+        limit.acquire()
+        limit.acquire()
+        jobserver.broken = True
+        # the jobs are not limited after the failure
+        limit.acquire()
+        limit.acquire()
+        for _ in range(4):
+            limit.release()
+        jobserver.broken = False
+        self.assertEqual(b'+', jobserver.try_acquire())
+        self.assertIsNone(jobserver.try_acquire())
+
+
+class LoadAverageTest(unittest.TestCase):
+
+    def test_no_limit(self):
+        self.assertFalse(sut.is_overloaded(None))
+
+    @unittest.skipIf(not hasattr(os, 'getloadavg'), 'no load average')
+    def test_limit(self):
+        self.assertTrue(sut.is_overloaded(0.0000001) or
+                        os.getloadavg()[0] < 0.0000001)
+        self.assertFalse(sut.is_overloaded(1000000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,8 @@
 
 import libear as sut
 import unittest
+import json
+import os
 import os.path
 
 
@@ -31,6 +33,115 @@ class TemporaryDirectoryTest(unittest.TestCase):
             self.assertIsNotNone(dir_name)
             self.assertFalse(os.path.exists(dir_name))
 
+    def test_removes_nested_directories(self):
+        dir_name = None
+        with sut.temporary_directory() as tmpdir:
+            for first in 'abc':
+                for second in 'xyz':
+                    sub_dir = os.path.join(tmpdir, first, second)
+                    os.makedirs(sub_dir)
+                    open(os.path.join(sub_dir, 'file'), 'w').close()
+            dir_name = tmpdir
+        self.assertFalse(os.path.exists(dir_name))
+
+
+class CacheEntryTest(unittest.TestCase):
+    def test_populates_once(self):
+        calls = []
+
+        def build(directory):
+            calls.append(directory)
+            with open(os.path.join(directory, 'content'), 'w') as handle:
+                handle.write('built')
+
+        with sut.temporary_directory() as tmpdir:
+            first = sut.cache_entry(tmpdir, 'key', build)
+            second = sut.cache_entry(tmpdir, 'key', build)
+            self.assertEqual(first, second)
+            self.assertEqual(1, len(calls))
+            self.assertTrue(os.path.isfile(os.path.join(first, 'content')))
+            self.assertEqual(['key'], os.listdir(tmpdir))
+
+    def test_concurrent_population_wins(self):
+        def build(directory):
+            # other process populated the entry meanwhile
+            os.makedirs(os.path.join(os.path.dirname(directory), 'key'))
+            with open(os.path.join(directory, 'content'), 'w') as handle:
+                handle.write('built')
+
+        with sut.temporary_directory() as tmpdir:
+            entry = sut.cache_entry(tmpdir, 'key', build)
+            self.assertEqual(os.path.join(tmpdir, 'key'), entry)
+            self.assertEqual(['key'], os.listdir(tmpdir))
+
+    def test_failed_build_leaves_nothing(self):
+        def build(directory):
+            raise RuntimeError('compilation failed')
+
+        with sut.temporary_directory() as tmpdir:
+            self.assertRaises(RuntimeError, sut.cache_entry, tmpdir, 'key',
+                              build)
+            self.assertEqual([], os.listdir(tmpdir))
+
+    def test_prune_removes_old_entries(self):
+        with sut.temporary_directory() as tmpdir:
+            old = os.path.join(tmpdir, 'old')
+            new = os.path.join(tmpdir, 'new')
+            os.makedirs(old)
+            os.makedirs(new)
+            os.utime(old, (0, 0))
+            sut.prune_cache(tmpdir, 60)
+            self.assertEqual(['new'], os.listdir(tmpdir))
+
+
+class ConfigureTest(unittest.TestCase):
+    @staticmethod
+    def create_toolset():
+        toolset = sut.make_toolset(os.getcwd())
+        toolset.set_compiler('this-compiler-does-not-exist')
+        return toolset
+
+    def test_results_are_cached(self):
+        with sut.temporary_directory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'cache', 'configure.json')
+            configure = sut.Configure(self.create_toolset(), cache_file)
+            # fake the successful checks, to see those are cached
+            configure._try_to_compile_and_link = lambda source: True
+            configure.check_function_exists('execve', 'HAVE_EXECVE')
+            configure.check_function_exists('execv', 'HAVE_EXECV')
+            configure.wait()
+            with open(cache_file, 'r') as handle:
+                self.assertEqual(2, len(json.load(handle)))
+
+            configure = sut.Configure(self.create_toolset(), cache_file)
+            configure.check_function_exists('execve', 'HAVE_EXECVE')
+            configure.check_function_exists('execv', 'HAVE_EXECV')
+            configure.wait()
+            self.assertTrue(configure.results['HAVE_EXECVE'])
+            self.assertTrue(configure.results['HAVE_EXECV'])
+
+    def test_failed_checks_are_not_cached(self):
+        with sut.temporary_directory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'cache', 'configure.json')
+            configure = sut.Configure(self.create_toolset(), cache_file)
+            configure.check_function_exists('execve', 'HAVE_EXECVE')
+            configure.wait()
+            self.assertFalse(configure.results['HAVE_EXECVE'])
+            with open(cache_file, 'r') as handle:
+                self.assertEqual({}, json.load(handle))
+
+    def test_write_by_template_waits_for_checks(self):
+        with sut.temporary_directory() as tmpdir:
+            template = os.path.join(tmpdir, 'config.h.in')
+            output = os.path.join(tmpdir, 'config.h')
+            with open(template, 'w') as handle:
+                handle.write('#cmakedefine HAVE_EXECVE\n')
+            configure = sut.Configure(self.create_toolset())
+            configure.check_function_exists('execve', 'HAVE_EXECVE')
+            configure.write_by_template(template, output)
+            with open(output, 'r') as handle:
+                self.assertIn('#undef HAVE_EXECVE', handle.read())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,9 @@
 # RUN: %{python} %s
 
 import libscanbuild as sut
+import random
+import re
+import shlex
 import unittest
 
 
@@ -36,5 +39,46 @@ class ShellSplitTest(unittest.TestCase):
                          sut.shell_split('clang -c file.c -Dv=\(word\)'))
 
 
+class ShellSplitCompatibilityTest(unittest.TestCase):
+    """ The tokenizer shall give the same result as the `shlex` based
+    implementation did. """
+
+    @staticmethod
+    def reference(string):
+        def unescape(arg):
+            if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] == '"':
+                return re.sub(r'\\(["\\])', r'\1', arg[1:-1])
+            return re.sub(r'\\([\\ $%&\(\)\[\]\{\}\*|<>@?!])', r'\1', arg)
+
+        return [unescape(token) for token in shlex.split(string)]
+
+    def assert_compatible(self, string):
+        try:
+            expected = self.reference(string)
+        except ValueError:
+            self.assertRaises(ValueError, sut.shell_split, string)
+        else:
+            self.assertEqual(expected, sut.shell_split(string), repr(string))
+
+    def test_known_cases(self):
+        for string in [
+                '', ' ', 'a', ' a  b ', 'a\tb\nc\rd', 'a\x0bb',
+                "''", '""', "a '' b", 'a""b', "a'b c'd", 'a"b c"d',
+                '"a\\"b"', '"a\\\\b"', '"a\\$b"', "'a\\b'", 'a\\ b',
+                'a\\\\b', 'a\\\nb', '-DX=\\"y z\\"', '"-DX=\\"y\\""',
+                'a # b', '\\#a', '-Dv=\\(w\\)', '"\\"a\\""',
+                '"a', "'a", 'a\\', '"a\\', 'a "b\\" c']:
+            self.assert_compatible(string)
+
+    def test_random_strings(self):
+        alphabet = ['a', 'b', '-', '=', ' ', '\t', '\n', '\\', '"', "'",
+                    '$', '(', '#', '\u00e9']
+        generator = random.Random(0)
+        for _ in range(20000):
+            length = generator.randint(0, 12)
+            self.assert_compatible(
+                ''.join(generator.choice(alphabet) for _ in range(length)))
+
+
 if __name__ == '__main__':
     unittest.main()
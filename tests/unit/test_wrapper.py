@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+#
+# RUN: %{python} %s
+
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import libear
+import libscanbuild.intercept as intercept
+import libscanbuild.wrapper as sut
+
+IS_WINDOWS = os.getenv('windows')
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+# prints the invocation (like 'clang -###' does), or writes a report.
+STUB_ANALYZER = '''#!/bin/sh
+if [ "$1" = "-###" ]; then
+    shift
+    for arg in "$0" "$@"; do printf '"%s" ' "$arg"; done
+    echo
+    exit 0
+fi
+sleep "$STUB_ANALYZER_DELAY"
+while [ $# -gt 1 ]; do
+    if [ "$1" = "-o" ]; then echo report > "$2"; fi
+    shift
+done
+'''
+
+
+def run_wrapper(name, arguments, compiler, **environment):
+    """ Runs the wrapper in a new process and returns the exit code. """
+
+    command = [sys.executable, '-c',
+               'import sys; from libscanbuild.wrapper import {0} as w; '
+               'sys.exit(w())'.format(name)] + arguments
+    env = dict(os.environ)
+    env.update(environment)
+    env['PYTHONPATH'] = PROJECT_DIR
+    env['INTERCEPT_BUILD'] = json.dumps(
+        {'verbose': 0, 'cc': compiler, 'cxx': compiler})
+    return subprocess.call(command, env=env)
+
+
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class WrapperTest(unittest.TestCase):
+    # the compiler fails with a specific exit code
+    compiler = ['sh', '-c', 'exit 3', 'sh']
+
+    def test_intercept_wrapper_reports_the_call(self):
+        with libear.temporary_directory() as tmp_dir:
+            result = run_wrapper('intercept_compiler_wrapper',
+                                 ['-c', 'a.c'], self.compiler,
+                                 INTERCEPT_BUILD_TARGET_DIR=tmp_dir)
+            self.assertEqual(3, result)
+            executions = list(intercept.exec_traces(tmp_dir))
+            self.assertEqual(1, len(executions))
+            self.assertEqual(['cc', '-c', 'a.c'], executions[0].cmd)
+
+    def test_intercept_wrapper_reports_into_log(self):
+        with libear.temporary_directory() as tmp_dir:
+            result = run_wrapper('intercept_compiler_wrapper',
+                                 ['-c', 'a.c'], self.compiler,
+                                 INTERCEPT_BUILD_TARGET_DIR=tmp_dir,
+                                 INTERCEPT_BUILD_TRANSPORT='log')
+            self.assertEqual(3, result)
+            self.assertEqual([sut.TRACE_LOG_FILE], os.listdir(tmp_dir))
+
+    def test_analyze_wrapper_without_analyzer(self):
+        result = run_wrapper('analyze_compiler_wrapper', ['-c', 'a.c'],
+                             self.compiler)
+        self.assertEqual(3, result)
+
+    def test_analyze_wrapper_with_non_compilation(self):
+        result = run_wrapper('analyze_compiler_wrapper', ['-o', 'a', 'a.o'],
+                             self.compiler, ANALYZE_BUILD='{}')
+        self.assertEqual(3, result)
+
+    def run_speculative_wrapper(self, tmp_dir, compiler, delay):
+        source = os.path.join(tmp_dir, 'a.c')
+        open(source, 'w').close()
+        # the analyzer writes a report after the given delay
+        analyzer = os.path.join(tmp_dir, 'clang')
+        with open(analyzer, 'w') as handle:
+            handle.write(STUB_ANALYZER)
+        os.chmod(analyzer, 0o755)
+        output_dir = os.path.join(tmp_dir, 'reports')
+        os.mkdir(output_dir)
+        parameters = {'clang': analyzer, 'direct_args': [],
+                      'excludes': [], 'force_debug': False,
+                      'output_dir': output_dir, 'output_format': 'plist',
+                      'output_failures': False}
+        result = run_wrapper('analyze_compiler_wrapper',
+                             ['-c', source], compiler,
+                             ANALYZE_BUILD=json.dumps(parameters),
+                             ANALYZE_BUILD_SPECULATIVE='1',
+                             STUB_ANALYZER_DELAY=str(delay),
+                             TMPDIR=tmp_dir)
+        return result, os.listdir(output_dir)
+
+    def test_speculative_analyze_wrapper_keeps_reports(self):
+        with libear.temporary_directory() as tmp_dir:
+            passing = ['sh', '-c', 'exit 0', 'sh']
+            # the analyzer finishes after the compiler
+            result, reports = self.run_speculative_wrapper(
+                tmp_dir, passing, 1)
+            self.assertEqual(0, result)
+            self.assertEqual(1, len(reports))
+            self.assertTrue(reports[0].startswith('report-'))
+            with open(os.path.join(tmp_dir, 'reports', reports[0])) as handle:
+                self.assertEqual('report\n', handle.read())
+
+    def test_speculative_analyze_wrapper_discards_reports(self):
+        with libear.temporary_directory() as tmp_dir:
+            started = time.time()
+            result, reports = self.run_speculative_wrapper(
+                tmp_dir, self.compiler, 30)
+            elapsed = time.time() - started
+            self.assertEqual(3, result)
+            self.assertEqual([], reports)
+            # the analyzer is terminated, not waited for
+            self.assertLess(elapsed, 20)
+
+
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class SpeculativeSlotTest(unittest.TestCase):
+
+    def test_not_requested(self):
+        self.assertIsNone(sut.speculative_slot(None))
+
+    def test_slots_are_limited(self):
+        with libear.temporary_directory() as tmp_dir:
+            original, tempfile.tempdir = tempfile.tempdir, tmp_dir
+            try:
+                first = sut.speculative_slot('1')
+                self.assertIsNotNone(first)
+                self.assertIsNone(sut.speculative_slot('1'))
+                first()
+                second = sut.speculative_slot('1')
+                self.assertIsNotNone(second)
+                second()
+            finally:
+                tempfile.tempdir = original
+
+
+if __name__ == '__main__':
+    unittest.main()